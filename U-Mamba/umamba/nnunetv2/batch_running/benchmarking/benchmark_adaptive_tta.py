@@ -0,0 +1,106 @@
+import argparse
+from time import perf_counter
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, load_json
+
+from nnunetv2.evaluation.evaluate_predictions import compute_tp_fp_fn_tn, region_or_label_to_mask
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.paths import nnUNet_preprocessed
+from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
+
+
+def dice_per_label(segmentation: np.ndarray, reference: np.ndarray, labels_or_regions) -> list:
+    """
+    Dice of every label / region, nan where both reference and prediction are empty (like evaluate_predictions).
+    """
+    dice = []
+    for r in labels_or_regions:
+        tp, fp, fn, _ = compute_tp_fp_fn_tn(region_or_label_to_mask(reference, r),
+                                            region_or_label_to_mask(segmentation, r))
+        dice.append(2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else np.nan)
+    return dice
+
+
+def predict_case(predictor: nnUNetPredictor, data: torch.Tensor):
+    """
+    Segmentation (preprocessed space) and time of one sliding window prediction.
+    """
+    if predictor.device.type == 'cuda':
+        torch.cuda.synchronize(predictor.device)
+    start = perf_counter()
+    logits = predictor.predict_sliding_window_return_logits(data)
+    if predictor.device.type == 'cuda':
+        torch.cuda.synchronize(predictor.device)
+    elapsed = perf_counter() - start
+    segmentation = predictor.label_manager.convert_logits_to_segmentation(logits.float().cpu())
+    return np.asarray(segmentation), elapsed
+
+
+if __name__ == '__main__':
+    """
+    Dice and runtime of adaptive mirroring (nnUNetPredictor.adaptive_tta) compared to mirroring every tile, on the
+    validation cases of the given folds (splits_final.json). Predictions are compared in preprocessed space against
+    the preprocessed segmentations, so this needs the preprocessed dataset of the model. Every tta_confidence is one
+    row; 'all' is the full mirroring reference, 'none' no mirroring at all.
+
+    Example: python -m nnunetv2.batch_running.benchmarking.benchmark_adaptive_tta -m MODEL_FOLDER -f 0 1 2 3 4
+    -confidences 0.9 0.99 0.999 -n_cases 10
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', type=str, required=True, help='trained model folder')
+    parser.add_argument('-f', nargs='+', type=int, default=(0,), help='folds, each is evaluated on its validation '
+                                                                       'cases')
+    parser.add_argument('-chk', type=str, default='checkpoint_final.pth')
+    parser.add_argument('-confidences', type=float, nargs='+', default=(0.9, 0.99, 0.999),
+                        help='tta_confidence values to evaluate')
+    parser.add_argument('-n_cases', type=int, default=None, help='max validation cases per fold (default: all)')
+    parser.add_argument('-step_size', type=float, default=0.5)
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    modes = [('all', None), ('none', None)] + [(f'{c}', c) for c in args.confidences]
+    # per mode: dice per case (list of per label lists), seconds per case, tile forward passes run / saved
+    results = {m: {'dice': [], 'time': [], 'run': 0, 'saved': 0, 'changed': []} for m, _ in modes}
+    for fold in args.f:
+        predictor = nnUNetPredictor(tile_step_size=args.step_size, device=device, allow_tqdm=False)
+        predictor.initialize_from_trained_model_folder(args.m, [fold], args.chk)
+        label_manager = predictor.label_manager
+        labels_or_regions = label_manager.foreground_regions if label_manager.has_regions else \
+            label_manager.foreground_labels
+        dataset_folder = join(nnUNet_preprocessed, predictor.plans_manager.dataset_name)
+        keys = load_json(join(dataset_folder, 'splits_final.json'))[fold]['val'][:args.n_cases]
+        dataset = nnUNetDataset(join(dataset_folder, predictor.configuration_manager.data_identifier), keys)
+        print(f'fold {fold}: {len(keys)} validation cases')
+
+        for k in keys:
+            data, seg, _ = dataset.load_case(k)
+            data = torch.from_numpy(np.asarray(data)).float()
+            reference = None
+            for mode, confidence in modes:
+                predictor.use_mirroring = mode != 'none'
+                predictor.adaptive_tta = confidence is not None
+                predictor.tta_confidence = confidence
+                run, saved = predictor.tta_forwards_run, predictor.tta_forwards_saved
+                segmentation, elapsed = predict_case(predictor, data)
+                if reference is None:
+                    reference = segmentation
+                r = results[mode]
+                r['dice'].append(dice_per_label(segmentation, np.asarray(seg[0]), labels_or_regions))
+                r['time'].append(elapsed)
+                r['run'] += predictor.tta_forwards_run - run
+                r['saved'] += predictor.tta_forwards_saved - saved
+                r['changed'].append(np.mean(segmentation != reference))
+
+    print(f'\n{"tta":>8} {"mean dice":>10} {"s/case":>8} {"speedup":>8} {"forwards saved":>15} '
+          f'{"voxels changed":>15}')
+    reference_time = np.mean(results['all']['time'])
+    for mode, confidence in modes:
+        r = results[mode]
+        dice = np.nanmean(np.array(r['dice'], dtype=np.float64), axis=0)
+        saved = f'{100 * r["saved"] / max(r["run"] + r["saved"], 1):.1f} %' if confidence is not None else '-'
+        print(f'{mode:>8} {np.nanmean(dice):>10.4f} {np.mean(r["time"]):>8.2f} '
+              f'{reference_time / np.mean(r["time"]):>7.2f}x {saved:>15} {100 * np.mean(r["changed"]):>14.3f}%'
+              f'   per label: {np.round(dice, 4).tolist()}')
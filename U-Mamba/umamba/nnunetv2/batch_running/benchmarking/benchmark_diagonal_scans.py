@@ -0,0 +1,65 @@
+import argparse
+from time import perf_counter
+
+import torch
+
+from nnunetv2.nets.mamba_layer import AXIS_SCANS, DiagonalScan
+from nnunetv2.utilities.scan_orders import ScanOrderCache
+
+
+def time_call(fn, n_iter: int, device: torch.device) -> float:
+    """
+    Average time per call of fn in seconds (one warmup call).
+    """
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = perf_counter()
+    for _ in range(n_iter):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (perf_counter() - start) / n_iter
+
+
+def round_trip(scan, x, cache):
+    x_flat, unpermute = scan.flatten(x, cache)
+    return unpermute(x_flat)
+
+
+if __name__ == '__main__':
+    """
+    Per shape timings of the diagonal scans: building the orders (what the original flatten_for_scan did on every
+    forward: meshgrid + argsort), and flatten + unpermute with the orders cached (what a forward costs now). Also checks
+    that every scan round trips.
+
+    Example: python -m nnunetv2.batch_running.benchmarking.benchmark_diagonal_scans -shapes 64x64x64 128x128x128
+    160x128x112 -channels 32 -device cuda
+    """
+    diagonal_scans = [n for n, s in AXIS_SCANS.items() if isinstance(s, DiagonalScan)]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-shapes', type=str, nargs='+', default=('32x32x32', '64x64x64', '128x128x128'),
+                        help='spatial shapes, DxHxW')
+    parser.add_argument('-scan_types', type=str, nargs='+', default=('yz-diag', 'xy-diag', 'yz-antidiag'),
+                        help=f'any of {diagonal_scans} or yz-diag-legacy / xy-diag-legacy')
+    parser.add_argument('-channels', type=int, default=32)
+    parser.add_argument('-batch_size', type=int, default=1)
+    parser.add_argument('-n_iter', type=int, default=5)
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    print(f'{args.channels} channels, batch size {args.batch_size}, device {device}, {torch.get_num_threads()} threads')
+    print(f'{"shape":>16} {"scan type":>16} {"build ms":>10} {"flatten + unpermute ms":>24} {"round trip":>10}')
+    for shape in args.shapes:
+        shape = tuple(int(i) for i in shape.split('x'))
+        x = torch.randn((args.batch_size, args.channels, *shape), device=device)
+        for scan_type in args.scan_types:
+            scan = AXIS_SCANS[scan_type]
+            cache = ScanOrderCache()
+            build = time_call(lambda: scan.build(shape, device), args.n_iter, device)
+            with torch.no_grad():
+                cached = time_call(lambda: round_trip(scan, x, cache), args.n_iter, device)
+                ok = torch.equal(round_trip(scan, x, cache), x)
+            print(f'{str(shape):>16} {scan_type:>16} {1000 * build:>10.2f} {1000 * cached:>24.2f} {str(ok):>10}')
@@ -0,0 +1,81 @@
+import argparse
+from time import perf_counter
+
+import numpy as np
+import torch
+from sklearn.decomposition import PCA
+
+from nnunetv2.utilities.pca_utils import extract_patches_and_origins, local_pca_from_mask
+
+
+def sklearn_local_pca(mask: np.ndarray, patch_size, min_voxels: int = 4):
+    """
+    Reference: one sklearn PCA per patch (what nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba used to do).
+    """
+    patches, coords = extract_patches_and_origins(mask[None, None], patch_size)
+    all_vectors, all_coords = [], []
+    for patch, coord in zip(patches, coords):
+        foreground_coords = np.argwhere(patch[0] > 0)
+        if foreground_coords.shape[0] < min_voxels:
+            continue
+        all_vectors.append(PCA(n_components=1).fit(foreground_coords).components_[0])
+        all_coords.append(coord)
+    return np.array(all_coords), np.array(all_vectors)
+
+
+def random_mask(shape, seed: int = 1234) -> np.ndarray:
+    # a few random ellipsoids, similar in spirit to a mean label mask
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(s) for s in shape], indexing='ij'), -1).astype(np.float32)
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(6):
+        center = rng.uniform(0.2, 0.8, 3) * shape
+        rotation = np.linalg.qr(rng.normal(size=(3, 3)))[0]
+        radii = rng.uniform(0.05, 0.3, 3) * min(shape)
+        local = (grid - center) @ rotation
+        mask[np.sum((local / radii) ** 2, -1) <= 1] = 1
+    return mask
+
+
+if __name__ == '__main__':
+    """
+    Compares the per-patch sklearn local PCA with local_pca_from_mask (batched torch PCA) for speed and equality.
+
+    Example: python -m nnunetv2.batch_running.benchmarking.benchmark_local_pca -shape 240 240 180 -patch_size 8 8 8
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-shape', type=int, nargs=3, default=(128, 128, 96))
+    parser.add_argument('-patch_size', type=int, nargs=3, default=(16, 16, 16))
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    mask = random_mask(tuple(args.shape))
+
+    start = perf_counter()
+    ref_coords, ref_vectors = sklearn_local_pca(mask, args.patch_size)
+    time_sklearn = perf_counter() - start
+
+    local_pca_from_mask(mask, args.patch_size, device=device)  # warmup
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = perf_counter()
+    coords, vectors = local_pca_from_mask(mask, args.patch_size, device=device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    time_batched = perf_counter() - start
+
+    coords, vectors = coords.cpu().numpy(), vectors.cpu().numpy()
+    assert np.array_equal(coords, ref_coords), 'patch selection differs'
+    # eigenvectors of (near) degenerate eigenvalues are not unique, only compare well defined directions
+    # the first component is not unique if the largest eigenvalue is degenerate, sklearn's result then depends on its
+    # solver (SVD for < 30 voxels, covariance eigh otherwise), see batched_pca
+    deviation = np.abs(vectors - ref_vectors).max(1)
+    different = deviation > 1e-4
+    n_voxels = np.array([mask[z:z + args.patch_size[0], y:y + args.patch_size[1], x:x + args.patch_size[2]].sum()
+                         for z, y, x in coords])
+    print(f'{len(coords)} patches, max deviation from sklearn {deviation[~different].max(initial=0):.2e}')
+    print(f'{np.sum(different)} patches with a different (degenerate) direction, '
+          f'{np.sum(different & (n_voxels >= 30))} of them with >= 30 voxels')
+    print(f'sklearn (per patch): {time_sklearn * 1000:.1f} ms')
+    print(f'batched ({device}): {time_batched * 1000:.1f} ms ({time_sklearn / time_batched:.1f}x)')
@@ -0,0 +1,75 @@
+import argparse
+from time import perf_counter
+
+import torch
+
+from nnunetv2.nets.mamba_backends import Mamba, available_mamba_backends, resolve_mamba_backend
+
+
+def time_forward(layer, x, n_iter: int, device: torch.device) -> float:
+    """
+    Average time per forward (no grad) of layer in seconds (one warmup run).
+    """
+    with torch.no_grad():
+        layer(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = perf_counter()
+        for _ in range(n_iter):
+            layer(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    return (perf_counter() - start) / n_iter
+
+
+if __name__ == '__main__':
+    """
+    Forward time of the PSU-Mamba stem MambaLayer per Mamba backend and scan type. With the torch backend this runs on
+    CPU-only nodes. If several backends are given, all of them get the weights of the first one and their outputs are
+    compared against it.
+
+    Example: python -m nnunetv2.batch_running.benchmarking.benchmark_mamba_backends -patch_size 128 128 128 -device cpu
+    -backends torch -scan_types x global_pca
+    """
+    from nnunetv2.nets.UMambaFirst_PCA import MambaLayer
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-patch_size', type=int, nargs=3, default=(128, 128, 128))
+    parser.add_argument('-channels', type=int, default=32)
+    parser.add_argument('-batch_size', type=int, default=1)
+    parser.add_argument('-backends', type=str, nargs='+', default=('auto',),
+                        help=f'any of {available_mamba_backends()} or auto')
+    parser.add_argument('-scan_types', type=str, nargs='+', default=('x', 'global_pca'))
+    parser.add_argument('-n_iter', type=int, default=3)
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    x = torch.randn((args.batch_size, args.channels, *args.patch_size), device=device)
+    pca_vector = torch.nn.functional.normalize(torch.tensor([0.2, 0.9, 0.4]), dim=0)
+
+    print(f'patch size {args.patch_size}, {args.channels} channels, batch size {args.batch_size}, device {device}, '
+          f'{torch.get_num_threads()} threads')
+    for scan_type in args.scan_types:
+        reference_state, reference_output = None, None
+        for backend in args.backends:
+            torch.manual_seed(0)
+            layer = MambaLayer(dim=args.channels, scan_type=scan_type)
+            layer.mamba = Mamba(d_model=args.channels, d_state=16, d_conv=4, expand=2, backend=backend)
+            if reference_state is None:
+                reference_state = layer.state_dict()
+            else:
+                layer.load_state_dict(reference_state)
+            layer = layer.to(device).eval()
+            layer.set_global_pca_vectors(pca_vector.to(device))
+            t = time_forward(layer, x, args.n_iter, device)
+            with torch.no_grad():
+                output = layer(x).float()
+            msg = f'{scan_type}, {resolve_mamba_backend(backend)}: {t * 1000:.0f} ms/forward'
+            if reference_output is None:
+                reference_output = output
+            else:
+                msg += f', max abs diff to {resolve_mamba_backend(args.backends[0])}: ' \
+                       f'{(output - reference_output).abs().max().item():.2e}'
+            print(msg)
@@ -0,0 +1,67 @@
+import argparse
+import logging
+import os
+from time import perf_counter
+
+import torch
+
+from nnunetv2.utilities.mamba_logging import set_mamba_log_level
+
+
+def time_mamba_layer(layer, x, n_iter: int, device: torch.device) -> float:
+    """
+    Average time per forward + backward of layer in seconds.
+    """
+    for _ in range(3):
+        layer(x).mean().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = perf_counter()
+    for _ in range(n_iter):
+        layer(x).mean().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (perf_counter() - start) / n_iter
+
+
+if __name__ == '__main__':
+    """
+    Per-iteration cost of the Mamba layer logging. 'verbose' logs every message on every step (what the layers used to
+    do with print, including the device -> host copy of the PCA vector), 'default' is the default log level.
+    Output of the verbose run goes to /dev/null so that terminal speed does not distort the numbers.
+
+    Example: python -m nnunetv2.batch_running.benchmarking.benchmark_mamba_logging -patch_size 64 64 64
+    """
+    from nnunetv2.nets.UMambaFirst_PCA import MambaLayer, logger as pca_logger
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-patch_size', type=int, nargs=3, default=(64, 64, 64))
+    parser.add_argument('-channels', type=int, default=32)
+    parser.add_argument('-batch_size', type=int, default=2)
+    parser.add_argument('-scan_type', type=str, default='global_pca')
+    parser.add_argument('-n_iter', type=int, default=20)
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    layer = MambaLayer(dim=args.channels, scan_type=args.scan_type).to(device)
+    layer.set_global_pca_vectors(torch.nn.functional.normalize(torch.tensor([0.2, 0.9, 0.4]), dim=0))
+    x = torch.randn((args.batch_size, args.channels, *args.patch_size), device=device, requires_grad=True)
+
+    root = logging.getLogger('nnunetv2.mamba')
+    handlers = root.handlers
+    default_interval = pca_logger.interval
+
+    with open(os.devnull, 'w') as devnull:
+        root.handlers = [logging.StreamHandler(devnull)]
+        set_mamba_log_level('DEBUG')
+        pca_logger.interval = 0
+        verbose = time_mamba_layer(layer, x, args.n_iter, device)
+    root.handlers = handlers
+    pca_logger.interval = default_interval
+    set_mamba_log_level('INFO')
+    default = time_mamba_layer(layer, x, args.n_iter, device)
+
+    print(f'{args.scan_type}, patch size {args.patch_size}, batch size {args.batch_size}, device {device}')
+    print(f'verbose logging: {verbose * 1000:.2f} ms/it')
+    print(f'default logging: {default * 1000:.2f} ms/it ({(verbose - default) / verbose * 100:.1f}% less)')
@@ -0,0 +1,302 @@
+import argparse
+import importlib
+import platform
+from time import perf_counter
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import save_json, load_json, isfile
+
+import nnunetv2.nets.mamba_backends as mamba_backends
+from nnunetv2.experiment_planning.experiment_planners.network_topology import get_pool_and_conv_props
+from nnunetv2.training.nnUNetTrainer.variants.benchmarking.nnUNetTrainerBenchmark_5epochs_noDataLoading import \
+    nnUNetTrainerBenchmark_5epochs_noDataLoading
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+LEGACY_SCAN_TYPES = ('x', 'y', 'z', 'yz-diag', 'xy-diag', 'pca')
+PSU_MAMBA_SCAN_TYPES = ('x', 'y', 'z', 'diag', 'yz-diag', 'xy-diag', 'global_pca', 'multi_pca', 'local_pca')
+
+# name: (module in nnunetv2.nets, network builder, scan types, trainer that trains it). Scan type None means the
+# network has no configurable scan (plain x flatten or no Mamba at all)
+NETWORK_VARIANTS = {
+    'UMambaBot_3d': ('UMambaBot_3d', 'get_umamba_bot_3d_from_plans', (None,), 'nnUNetTrainerUMambaBot'),
+    'UMambaBot_3d_copy': ('UMambaBot_3d_copy', 'get_umamba_bot_3d_from_plans', LEGACY_SCAN_TYPES,
+                          'nnUNetTrainerUMambaBot_z'),
+    'UMambaEnc_3d': ('UMambaEnc_3d', 'get_umamba_enc_3d_from_plans', (None,), 'nnUNetTrainerUMambaEnc'),
+    'UMambaEnc_3d_copy': ('UMambaEnc_3d_copy', 'get_umamba_enc_3d_from_plans', (None,),
+                          'nnUNetTrainerUMambaEncNoAMP'),
+    'UMambaFirst': ('UMambaFirst', 'get_umamba_first_3d_from_plans', LEGACY_SCAN_TYPES, 'nnUNetTrainerMambaFistStem'),
+    'UMambaFirst_3d': ('UMambaFirst_3d', 'get_umamba_first_3d_from_plans', LEGACY_SCAN_TYPES,
+                       'nnUNetTrainerUMambaFirst'),
+    'UMambaFirst_z_3d': ('UMambaFirst_z_3d', 'get_umamba_first_3d_from_plans', LEGACY_SCAN_TYPES,
+                         'nnUNetTrainerUMambaFirst_z'),
+    'UMambaFirst_32': ('UMambaFirst_32', 'get_umamba_first_3d_from_plans', ('x', 'pca'), None),
+    'UMambaFirst_patch16': ('UMambaFirst_patch16', 'get_umamba_first_3d_from_plans', ('x', 'pca'), None),
+    'UMambaFirst_global': ('UMambaFirst_global', 'get_umamba_first_3d_from_plans', ('x', 'pca'), None),
+    'UMambaFirst_global32': ('UMambaFirst_global32', 'get_umamba_first_3d_from_plans', ('x', 'pca'), None),
+    'UMambaFirst_PCA': ('UMambaFirst_PCA', 'get_umamba_first_3d_from_plans', PSU_MAMBA_SCAN_TYPES,
+                        'nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba'),
+    'TransUNet3D': ('TransUnet3d', '_build_transunet3d', (None,), 'nnUNetTrainerTransUNet3D'),
+}
+
+
+def _build_transunet3d(plans_manager, dataset_json, configuration_manager, num_input_channels,
+                       deep_supervision: bool = False):
+    # same as nnUNetTrainerTransUNet3D.build_network_architecture (which needs a trainer instance)
+    from nnunetv2.nets.TransUnet3d import TransUNet3D
+    from nnunetv2.training.nnUNetTrainer.nnUNetTrainerTransUNet3D import nnUNetTrainerTransUNet3D
+    return TransUNet3D(in_channels=num_input_channels,
+                       num_classes=plans_manager.get_label_manager(dataset_json).num_segmentation_heads,
+                       img_size=tuple(int(i) for i in configuration_manager.patch_size),
+                       patch_size=nnUNetTrainerTransUNet3D.vit_patch_size, embed_dim=384, depth=8, num_heads=6,
+                       mlp_dim=1536, drop=0.0, decoder_channels=(256, 128, 64, 32))
+
+
+def synthetic_plans(patch_size, base_num_features: int = 32, max_num_features: int = 320, num_labels: int = 3,
+                    num_input_channels: int = 1):
+    """
+    Plans (3d_fullres) and dataset.json for isotropic data with the given patch size, with the network topology the
+    experiment planner would pick for it. patch_size is adapted to be divisible by the pooling like in the planner.
+    """
+    _, pool_op_kernel_sizes, conv_kernel_sizes, patch_size, _ = \
+        get_pool_and_conv_props([1.] * len(patch_size), patch_size, 4, 999999)
+    n_stages = len(pool_op_kernel_sizes)
+    configuration = {
+        'data_identifier': 'nnUNetPlans_3d_fullres', 'preprocessor_name': 'DefaultPreprocessor', 'batch_size': 2,
+        'patch_size': [int(i) for i in patch_size], 'median_image_size_in_voxels': [int(i) for i in patch_size],
+        'spacing': [1.] * len(patch_size), 'normalization_schemes': ['ZScoreNormalization'] * num_input_channels,
+        'use_mask_for_norm': [False] * num_input_channels, 'UNet_class_name': 'PlainConvUNet',
+        'UNet_base_num_features': base_num_features, 'n_conv_per_stage_encoder': [2] * n_stages,
+        'n_conv_per_stage_decoder': [2] * (n_stages - 1), 'pool_op_kernel_sizes': pool_op_kernel_sizes,
+        'conv_kernel_sizes': conv_kernel_sizes, 'unet_max_num_features': max_num_features, 'batch_dice': True,
+    }
+    plans = {
+        'dataset_name': 'Dataset000_Benchmark', 'plans_name': 'nnUNetPlans',
+        'original_median_spacing_after_transp': [1.] * len(patch_size),
+        'original_median_shape_after_transp': [int(i) for i in patch_size], 'image_reader_writer': 'SimpleITKIO',
+        'transpose_forward': list(range(len(patch_size))), 'transpose_backward': list(range(len(patch_size))),
+        'configurations': {'3d_fullres': configuration}, 'experiment_planner_used': 'ExperimentPlanner',
+        'label_manager': 'LabelManager', 'foreground_intensity_properties_per_channel': {},
+    }
+    dataset_json = {'channel_names': {str(i): 'CT' for i in range(num_input_channels)},
+                    'labels': {'background': 0, **{f'label{i}': i for i in range(1, num_labels)}},
+                    'numTraining': 1, 'file_ending': '.nii.gz'}
+    return plans, dataset_json
+
+
+def mamba_layers(network):
+    """
+    The modules that wrap a Mamba block (MambaLayer of all network variants): modules with a child named mamba.
+    """
+    return [m for m in network.modules() if isinstance(getattr(m, 'mamba', None), torch.nn.Module)]
+
+
+def set_scan_type(network, scan_type: str, patch_size):
+    """
+    Switch all Mamba layers of network to scan_type, with random scan vectors for the PCA scans.
+    """
+    layers = [m for m in mamba_layers(network) if hasattr(m, 'scan_type')]
+    if len(layers) == 0:
+        raise NotImplementedError(f'{network.__class__.__name__} has no Mamba layer with a scan type')
+    generator = torch.Generator().manual_seed(0)
+    for m in layers:
+        m.scan_type = scan_type
+        if scan_type == 'pca' and hasattr(m, 'set_scan_vector'):
+            m.set_scan_vector(torch.nn.functional.normalize(torch.randn(3, generator=generator), dim=0))
+    if scan_type in ('global_pca', 'multi_pca'):
+        vectors = torch.linalg.qr(torch.randn(3, 3, generator=generator))[0].T
+        network.set_global_pca_vectors(vectors[:2] if scan_type == 'multi_pca' else vectors[:1])
+    elif scan_type == 'local_pca':
+        pca_patch_size = [max(1, min(16, i)) for i in patch_size]
+        coords = torch.stack(torch.meshgrid(*[torch.arange(0, s - p + 1, p) for s, p in
+                                              zip(patch_size, pca_patch_size)], indexing='ij'), dim=-1).reshape(-1, 3)
+        network.set_local_pca_vectors(torch.nn.functional.normalize(torch.randn(coords.shape[0], 3,
+                                                                                generator=generator), dim=1), coords)
+        network.set_pca_patch_size(pca_patch_size)
+        network.set_pca_reference_shape(patch_size)
+
+
+def _synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _loss(output, target):
+    output = output if isinstance(output, (list, tuple)) else [output]
+    return sum(torch.nn.functional.cross_entropy(o.float(), t[:, 0].long()) for o, t in zip(output, target))
+
+
+def measure_scan_overhead(network, data: torch.Tensor, device: torch.device) -> float:
+    """
+    Forward time (s) the Mamba layers spend outside their Mamba block: scan flatten / permutation, norm and
+    unpermute. Measured with hooks (which synchronize) in a separate no grad forward pass.
+    """
+    times = {}
+
+    def pre(name):
+        def hook(*_):
+            _synchronize(device)
+            times[name] = times.get(name, 0) - perf_counter()
+        return hook
+
+    def post(name):
+        def hook(*_):
+            _synchronize(device)
+            times[name] += perf_counter()
+        return hook
+
+    handles = []
+    for i, m in enumerate(mamba_layers(network)):
+        handles += [m.register_forward_pre_hook(pre(('layer', i))), m.register_forward_hook(post(('layer', i))),
+                    m.mamba.register_forward_pre_hook(pre(('mamba', i))),
+                    m.mamba.register_forward_hook(post(('mamba', i)))]
+    try:
+        with torch.no_grad(), torch.autocast(device.type, enabled=device.type == 'cuda'):
+            network(data)
+    finally:
+        for h in handles:
+            h.remove()
+    return sum(v for k, v in times.items() if k[0] == 'layer') - sum(v for k, v in times.items() if k[0] == 'mamba')
+
+
+def benchmark_network(network, batch: dict, device: torch.device, n_iter: int) -> dict:
+    """
+    Forward (no grad) and training iteration (forward + loss + backward, like nnUNetTrainer.train_step without the
+    optimizer) latency, tokens (voxels) per second of the training iteration, peak allocated memory (cuda) and the
+    scan overhead of the Mamba layers. One warmup iteration each, which also builds cached scan orders.
+    """
+    data, target = batch['data'], batch['target']
+    amp = device.type == 'cuda'
+    network.train()
+
+    def forward():
+        with torch.no_grad(), torch.autocast(device.type, enabled=amp):
+            network(data)
+
+    def forward_backward():
+        network.zero_grad(set_to_none=True)
+        with torch.autocast(device.type, enabled=amp):
+            loss = _loss(network(data), target)
+        loss.backward()
+
+    results = {}
+    for name, fn in (('forward', forward), ('forward_backward', forward_backward)):
+        fn()
+        _synchronize(device)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        start = perf_counter()
+        for _ in range(n_iter):
+            fn()
+        _synchronize(device)
+        results[f'{name}_ms'] = (perf_counter() - start) / n_iter * 1000
+        if device.type == 'cuda':
+            results[f'{name}_peak_memory_mb'] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    results['tokens_per_s'] = data.shape[0] * np.prod(data.shape[2:]) / results['forward_backward_ms'] * 1000
+    results['n_mamba_layers'] = len(mamba_layers(network))
+    if results['n_mamba_layers'] > 0:
+        overhead = measure_scan_overhead(network, data, device)
+        results['scan_overhead_ms'] = overhead * 1000
+        results['scan_overhead_fraction'] = overhead * 1000 / results['forward_ms']
+    return results
+
+
+def run(variant: str, scan_type, patch_size, batch_size: int, device: torch.device, n_iter: int) -> dict:
+    module_name, builder, _, _ = NETWORK_VARIANTS[variant]
+    plans, dataset_json = synthetic_plans(patch_size)
+    plans_manager = PlansManager(plans)
+    configuration_manager = plans_manager.get_configuration('3d_fullres')
+    patch_size = tuple(configuration_manager.patch_size)
+    result = {'variant': variant, 'scan_type': scan_type, 'patch_size': list(patch_size), 'batch_size': batch_size}
+    network = None
+    try:
+        if builder.startswith('_'):
+            build = globals()[builder]
+        else:
+            build = getattr(importlib.import_module(f'nnunetv2.nets.{module_name}'), builder)
+        deep_supervision = variant != 'TransUNet3D'
+        network = build(plans_manager, dataset_json, configuration_manager, 1, deep_supervision=deep_supervision)
+        if scan_type is not None:
+            set_scan_type(network, scan_type, patch_size)
+        network = network.to(device)
+        scales = list(list(i) for i in 1 / np.cumprod(np.vstack(configuration_manager.pool_op_kernel_sizes),
+                                                         axis=0))[:-1] if deep_supervision else None
+        batch = nnUNetTrainerBenchmark_5epochs_noDataLoading.make_dummy_batch(
+            batch_size, 1, patch_size, scales, len(dataset_json['labels']) - 1, device)
+        result.update(benchmark_network(network, batch, device, n_iter))
+    except Exception as e:
+        # like the benchmark trainers: out of memory (or a variant that does not support the scan type) is a result
+        result['error'] = f'{e.__class__.__name__}: {str(e).splitlines()[0] if str(e) else ""}'
+    finally:
+        del network
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+    return result
+
+
+if __name__ == '__main__':
+    """
+    Throughput of the network variants in nnunetv2/nets per scan type and patch size: forward and training iteration
+    latency, tokens/s, peak memory (cuda) and the time the Mamba layers spend on scan permutation. Networks are built
+    with their from_plans functions (what the trainers listed in NETWORK_VARIANTS do) from synthetic plans and run on
+    the dummy batch of nnUNetTrainerBenchmark_5epochs_noDataLoading, so no dataset is needed. -device cpu works
+    without a GPU (with the torch Mamba backend if mamba_ssm is not usable), keep patch sizes small there.
+
+    Results are written as json (-o). Existing results in that file are kept, entries of the same
+    variant / scan type / patch size / batch size / device are replaced.
+
+    Example: python -m nnunetv2.batch_running.benchmarking.benchmark_network_throughput -o throughput.json
+    -variants UMambaFirst_PCA UMambaBot_3d -patch_sizes 64x64x64 128x128x128
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', type=str, required=True, help='output json')
+    parser.add_argument('-variants', type=str, nargs='+', default=list(NETWORK_VARIANTS.keys()),
+                        help=f'any of {list(NETWORK_VARIANTS.keys())}')
+    parser.add_argument('-scan_types', type=str, nargs='+', default=None,
+                        help='restrict to these scan types (default: all scan types of each variant)')
+    parser.add_argument('-patch_sizes', type=str, nargs='+', default=('64x64x64', '128x128x128'), help='DxHxW')
+    parser.add_argument('-batch_size', type=int, default=2)
+    parser.add_argument('-n_iter', type=int, default=5)
+    parser.add_argument('-backend', type=str, default='auto',
+                        help=f'mamba backend, any of {mamba_backends.available_mamba_backends()} or auto')
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    mamba_backends.default_mamba_backend = args.backend
+    environment = {
+        'torch_version': torch.__version__,
+        'cudnn_version': torch.backends.cudnn.version() if device.type == 'cuda' else None,
+        'device_name': torch.cuda.get_device_name(device) if device.type == 'cuda' else
+        platform.processor() or platform.machine(),
+        'num_threads': torch.get_num_threads(),
+        'mamba_backend': mamba_backends.resolve_mamba_backend(args.backend),
+    }
+    output = load_json(args.o) if isfile(args.o) else {'results': []}
+    output['environment'] = environment
+
+    for variant in args.variants:
+        scan_types = NETWORK_VARIANTS[variant][2]
+        if args.scan_types is not None:
+            scan_types = [s for s in scan_types if (s or 'x') in args.scan_types]
+        for patch_size in args.patch_sizes:
+            patch_size = [int(i) for i in patch_size.split('x')]
+            for scan_type in scan_types:
+                torch.manual_seed(0)
+                result = run(variant, scan_type, patch_size, args.batch_size, device, args.n_iter)
+                result['device'] = device.type
+                output['results'] = [r for r in output['results'] if
+                                     [r[k] for k in ('variant', 'scan_type', 'patch_size', 'batch_size', 'device')] !=
+                                     [result[k] for k in ('variant', 'scan_type', 'patch_size', 'batch_size',
+                                                          'device')]] + [result]
+                name = f'{variant} {scan_type or "default scan"} {result["patch_size"]}'
+                if 'error' in result:
+                    print(f'{name}: {result["error"]}')
+                else:
+                    print(f'{name}: forward {result["forward_ms"]:.0f} ms, '
+                          f'forward + backward {result["forward_backward_ms"]:.0f} ms, '
+                          f'{result["tokens_per_s"]:.0f} tokens/s' +
+                          (f', scan overhead {100 * result["scan_overhead_fraction"]:.0f} %'
+                           if 'scan_overhead_fraction' in result else ''))
+                # save after every run, long sweeps may be interrupted
+                save_json(output, args.o, sort_keys=False)
@@ -0,0 +1,88 @@
+import argparse
+from time import perf_counter
+
+import torch
+
+from nnunetv2.nets.mamba_backends import Mamba, available_mamba_backends, resolve_mamba_backend
+
+
+def measure_forward_backward(layer, x: torch.Tensor, device: torch.device):
+    """
+    One forward + backward pass of layer. Returns (time in s, bytes of the tensors autograd kept for backward,
+    peak allocated bytes (cuda only, else None)).
+    """
+    saved = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        saved[(storage.data_ptr(), t.device)] = storage.nbytes()
+        return t
+
+    x = x.detach().requires_grad_(True)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+    start = perf_counter()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = layer(x)
+    out.float().square().mean().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    t = perf_counter() - start
+    # the input is not an activation of the stem
+    saved.pop((x.untyped_storage().data_ptr(), x.device), None)
+    peak = torch.cuda.max_memory_allocated(device) - baseline if device.type == 'cuda' else None
+    return t, sum(saved.values()), peak
+
+
+if __name__ == '__main__':
+    """
+    Memory of the PSU-Mamba stem MambaLayer during training (forward + backward) per scan type: bytes of the tensors
+    autograd keeps for backward (any device) and the peak allocated memory (cuda). The x scan is a plain reshape, the
+    PCA scans should not need noticeably more than it. With --no_mamba the Mamba block is replaced by an identity so
+    that only flatten / norm / unpermute are measured.
+
+    Example: python -m nnunetv2.batch_running.benchmarking.benchmark_stem_memory -patch_size 128 128 128 -batch_size 2
+    -scan_types x global_pca local_pca multi_pca
+    """
+    from nnunetv2.nets.UMambaFirst_PCA import MambaLayer
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-patch_size', type=int, nargs=3, default=(128, 128, 128))
+    parser.add_argument('-channels', type=int, default=32)
+    parser.add_argument('-batch_size', type=int, default=2)
+    parser.add_argument('-backend', type=str, default='auto', help=f'any of {available_mamba_backends()} or auto')
+    parser.add_argument('-scan_types', type=str, nargs='+', default=('x', 'global_pca', 'local_pca'))
+    parser.add_argument('-pca_patch_size', type=int, nargs=3, default=(16, 16, 16))
+    parser.add_argument('--no_mamba', action='store_true')
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    x = torch.randn((args.batch_size, args.channels, *args.patch_size), device=device)
+    # local PCA vectors on the patch grid of a reference volume that is the input itself
+    coords = torch.stack(torch.meshgrid(*[torch.arange(0, s - p + 1, p) for s, p in
+                                          zip(args.patch_size, args.pca_patch_size)], indexing='ij'),
+                         dim=-1).reshape(-1, 3)
+    vectors = torch.nn.functional.normalize(torch.randn(coords.shape[0], 3), dim=1)
+
+    print(f'patch size {args.patch_size}, {args.channels} channels, batch size {args.batch_size}, '
+          f'backend {"none" if args.no_mamba else resolve_mamba_backend(args.backend)}, device {device}')
+    for scan_type in args.scan_types:
+        layer = MambaLayer(dim=args.channels, scan_type=scan_type)
+        layer.mamba = torch.nn.Identity() if args.no_mamba else \
+            Mamba(d_model=args.channels, d_state=16, d_conv=4, expand=2, backend=args.backend)
+        layer = layer.to(device).train()
+        layer.set_global_pca_vectors(torch.nn.functional.normalize(torch.randn(2, 3), dim=1).to(device))
+        layer.set_local_pca_vectors(vectors.to(device), coords.to(device))
+        layer.set_pca_patch_size(args.pca_patch_size)
+        layer.set_pca_reference_shape(args.patch_size)
+        # warmup builds the cached scan orders
+        measure_forward_backward(layer, x, device)
+        t, saved, peak = measure_forward_backward(layer, x, device)
+        msg = f'{scan_type}: {t:.2f} s, saved for backward {saved / 2 ** 20:.0f} MB'
+        if peak is not None:
+            msg += f', peak allocated {peak / 2 ** 20:.0f} MB'
+        print(msg)
@@ -0,0 +1,61 @@
+import argparse
+from time import perf_counter
+
+import torch
+
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+
+
+def time_sliding_window(predictor: nnUNetPredictor, data: torch.Tensor, n_iter: int) -> float:
+    """
+    Average time of predict_sliding_window_return_logits in seconds (one warmup run).
+    """
+    predictor.predict_sliding_window_return_logits(data)
+    if predictor.device.type == 'cuda':
+        torch.cuda.synchronize(predictor.device)
+    start = perf_counter()
+    for _ in range(n_iter):
+        predictor.predict_sliding_window_return_logits(data)
+    if predictor.device.type == 'cuda':
+        torch.cuda.synchronize(predictor.device)
+    return (perf_counter() - start) / n_iter
+
+
+if __name__ == '__main__':
+    """
+    Sliding window inference time of a trained model on a random image for different tile batch sizes (number of tiles
+    that, together with their mirrored variants, go through the network in one forward pass). 1 is the old behavior.
+    The logits of all batch sizes are compared against batch size 1.
+
+    Example: python -m nnunetv2.batch_running.benchmarking.benchmark_tile_batch -m MODEL_FOLDER -f 0 -shape 160 160 160
+    -tile_batch_sizes 1 2 4 auto -device cpu
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', type=str, required=True, help='trained model folder')
+    parser.add_argument('-f', nargs='+', type=str, default=(0,))
+    parser.add_argument('-chk', type=str, default='checkpoint_final.pth')
+    parser.add_argument('-shape', type=int, nargs='+', required=True, help='spatial shape of the random image')
+    parser.add_argument('-tile_batch_sizes', type=str, nargs='+', default=('1', '2', '4', 'auto'))
+    parser.add_argument('--disable_tta', action='store_true')
+    parser.add_argument('-n_iter', type=int, default=3)
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    predictor = nnUNetPredictor(use_mirroring=not args.disable_tta, device=device, allow_tqdm=False)
+    predictor.initialize_from_trained_model_folder(args.m, [i if i == 'all' else int(i) for i in args.f], args.chk)
+    num_input_channels = determine_num_input_channels(predictor.plans_manager, predictor.configuration_manager,
+                                                      predictor.dataset_json)
+    data = torch.randn((num_input_channels, *args.shape))
+
+    reference, reference_time = None, None
+    for tile_batch_size in args.tile_batch_sizes:
+        predictor.tile_batch_size = tile_batch_size if tile_batch_size == 'auto' else int(tile_batch_size)
+        t = time_sliding_window(predictor, data, args.n_iter)
+        logits = predictor.predict_sliding_window_return_logits(data).float().cpu()
+        if reference is None:
+            reference, reference_time = logits, t
+        used = predictor._auto_tile_batch_size if tile_batch_size == 'auto' else tile_batch_size
+        print(f'tile batch size {tile_batch_size} ({used}): {t:.2f} s/case ({reference_time / t:.2f}x), '
+              f'max abs diff to first: {(logits - reference).abs().max().item():.2e}')
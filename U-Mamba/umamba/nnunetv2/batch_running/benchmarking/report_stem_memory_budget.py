@@ -0,0 +1,91 @@
+import argparse
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import load_json
+
+import nnunetv2.nets.mamba_backends as mamba_backends
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+# ExperimentPlanner: 560M feature map elements correspond to batch size 2 on 8 GB (3d)
+REFERENCE_VAL_3D = 560000000
+REFERENCE_GB = 8
+REFERENCE_BATCH_SIZE = 2
+
+
+def max_patch_size(network, patch_size, divisor, reference, max_scale: float = 4):
+    """
+    Largest patch size (multiple of divisor per axis) whose feature map estimate fits reference, found like the
+    planner does it: shrink the axis that is largest relative to patch_size, or grow the one that is smallest, in steps
+    of divisor. Growing stops at max_scale times the voxels of patch_size. Returns None if nothing fits.
+    """
+    patch_size = np.array(patch_size)
+    current = patch_size.copy()
+    if network.compute_conv_feature_map_size(tuple(current)) > reference:
+        while network.compute_conv_feature_map_size(tuple(current)) > reference:
+            axis = np.argsort(current / patch_size)[-1]
+            current[axis] -= divisor[axis]
+            if current[axis] < divisor[axis]:
+                return None
+        return tuple(int(i) for i in current)
+    while True:
+        candidate = current.copy()
+        axis = np.argsort(candidate / patch_size)[0]
+        candidate[axis] += divisor[axis]
+        if np.prod(candidate) > max_scale * np.prod(patch_size) or \
+                network.compute_conv_feature_map_size(tuple(candidate)) > reference:
+            return tuple(int(i) for i in current)
+        current = candidate
+
+
+if __name__ == '__main__':
+    """
+    Batch size (at the configured patch size) and largest patch size (at batch size 2) per GPU memory budget for the
+    PSU-Mamba network of a plans file, with and without the stem memory options (UMambaEnc.set_stem_memory_options).
+    Uses the compute_conv_feature_map_size accounting and the reference values of the experiment planner.
+
+    Example: python -m nnunetv2.batch_running.benchmarking.report_stem_memory_budget -plans
+    nnUNet_preprocessed/Dataset001/nnUNetPlans.json -dataset_json nnUNet_preprocessed/Dataset001/dataset.json
+    -budgets 8 11 24 -chunk_size 4096 -backend mamba_ssm
+    """
+    from nnunetv2.nets.UMambaFirst_PCA import get_umamba_first_3d_from_plans
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-plans', type=str, required=True)
+    parser.add_argument('-dataset_json', type=str, required=True)
+    parser.add_argument('-c', type=str, default='3d_fullres')
+    parser.add_argument('-budgets', type=float, nargs='+', default=(8, 11, 24, 40), help='GPU memory in GB')
+    parser.add_argument('-chunk_size', type=int, default=4096, help='stem sequence chunk size in tokens')
+    parser.add_argument('-scan_type', type=str, default='global_pca')
+    parser.add_argument('-num_input_channels', type=int, default=1)
+    parser.add_argument('-backend', type=str, default=None,
+                        help=f'mamba backend whose memory is accounted, any of '
+                             f'{mamba_backends.available_mamba_backends()} or auto (default: nnUNet_mamba_backend)')
+    args = parser.parse_args()
+
+    if args.backend is not None:
+        mamba_backends.default_mamba_backend = args.backend
+    plans_manager = PlansManager(load_json(args.plans))
+    configuration_manager = plans_manager.get_configuration(args.c)
+    network = get_umamba_first_3d_from_plans(plans_manager, load_json(args.dataset_json), configuration_manager,
+                                             args.num_input_channels, deep_supervision=True, scan_type=args.scan_type)
+    patch_size = tuple(configuration_manager.patch_size)
+    divisor = np.prod(np.array(configuration_manager.pool_op_kernel_sizes), axis=0)
+
+    print(f'configuration {args.c}, patch size {patch_size}, scan type {args.scan_type}, '
+          f'mamba backend {mamba_backends.resolve_mamba_backend()}')
+    options = {
+        'default': (False, None),
+        'checkpoint_stem': (True, None),
+        f'stem_chunk_size={args.chunk_size}': (False, args.chunk_size),
+        f'checkpoint_stem + stem_chunk_size={args.chunk_size}': (True, args.chunk_size),
+    }
+    for name, (checkpoint_stem, chunk_size) in options.items():
+        network.set_stem_memory_options(checkpoint_stem, chunk_size)
+        estimate = network.compute_conv_feature_map_size(patch_size)
+        print(f'\n{name}: {estimate / 1e6:.0f}M feature map elements per sample at {patch_size}')
+        for budget in args.budgets:
+            reference = REFERENCE_VAL_3D * budget / REFERENCE_GB
+            batch_size = int(round(reference / estimate * REFERENCE_BATCH_SIZE))
+            largest = max_patch_size(network, patch_size, divisor, reference)
+            print(f'  {budget:g} GB: batch size {batch_size} at {patch_size}, largest patch size at batch size '
+                  f'{REFERENCE_BATCH_SIZE}: {largest}')
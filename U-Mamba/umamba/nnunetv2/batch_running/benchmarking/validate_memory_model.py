@@ -0,0 +1,141 @@
+import argparse
+
+import numpy as np
+import torch
+
+import nnunetv2.nets.mamba_backends as mamba_backends
+from nnunetv2.experiment_planning.experiment_planners.memory_model import get_memory_model, fit_memory_model
+from nnunetv2.experiment_planning.experiment_planners.network_topology import get_pool_and_conv_props
+
+
+def measure_training_step(network, patch_size, batch_size: int, num_labels: int, device: torch.device):
+    """
+    Memory of one training iteration (forward, deep supervision loss, backward, optimizer step) like nnUNetTrainer
+    runs it. On cuda this is the peak allocated memory (everything: parameters, gradients, optimizer state,
+    activations; autocast), elsewhere the bytes of the non-parameter tensors autograd keeps for backward (fp32).
+    """
+    optimizer = torch.optim.SGD(network.parameters(), 1e-3, momentum=0.99, nesterov=True)
+    parameters = set(p.untyped_storage().data_ptr() for p in network.parameters())
+    x = torch.randn((batch_size, network.encoder.stem[0].conv1.in_channels, *patch_size), device=device)
+    target = torch.randint(0, num_labels, (batch_size, 1, *patch_size), device=device).float()
+    saved = {}
+
+    def pack(t):
+        ptr = t.untyped_storage().data_ptr()
+        if ptr not in parameters:
+            saved[ptr] = t.untyped_storage().nbytes()
+        return t
+
+    def step():
+        optimizer.zero_grad(set_to_none=True)
+        with torch.autocast(device.type, enabled=device.type == 'cuda'), \
+                torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            outputs = network(x)
+            outputs = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+            loss = 0
+            for o in outputs:
+                t = torch.nn.functional.interpolate(target, o.shape[2:], mode='nearest')[:, 0].long()
+                loss = loss + torch.nn.functional.cross_entropy(o.float(), t)
+        loss.backward()
+        optimizer.step()
+
+    # the first step allocates gradients and momentum buffers and builds the cached scan orders
+    step()
+    saved.clear()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    return sum(saved.values())
+
+
+if __name__ == '__main__':
+    """
+    Validates the memory model of the PSU-Mamba network (memory_model.MambaMemoryModel, as used by
+    UMambaFirstPCAPlanner) against measured training memory on reference shapes and batch sizes, and optionally fits
+    its coefficients (-fit). The fitted json is used by the planner if nnUNet_memory_model_calibration points to it.
+
+    Only measurements on cuda calibrate the planner. On cpu the autograd saved-for-backward bytes (fp32, no
+    parameters / optimizer state) are measured instead, which checks that the model is linear in the accounted
+    feature map sizes.
+
+    Example: python -m nnunetv2.batch_running.benchmarking.validate_memory_model -shapes 64x64x64 96x96x96 128x128x128
+    160x128x112 -batch_sizes 1 2 -fit memory_model_calibration.json
+    """
+    from nnunetv2.experiment_planning.experiment_planners.umamba_first_pca_planner import \
+        build_umamba_first_pca_for_estimate
+    from nnunetv2.nets.UMambaFirst_PCA import UMambaEnc
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-shapes', type=str, nargs='+', default=('64x64x64', '96x96x96', '128x128x128'),
+                        help='reference patch sizes, DxHxW. They are adapted to the network topology like the '
+                             'planner does it')
+    parser.add_argument('-batch_sizes', type=int, nargs='+', default=(1, 2))
+    parser.add_argument('-features', type=int, nargs='+', default=(32, 64, 128, 256, 320, 320),
+                        help='features per stage, the last value is repeated for deeper networks')
+    parser.add_argument('-num_input_channels', type=int, default=1)
+    parser.add_argument('-num_labels', type=int, default=3)
+    parser.add_argument('-scan_type', type=str, default='global_pca')
+    parser.add_argument('-backend', type=str, default='auto', help=f'any of '
+                                                                   f'{mamba_backends.available_mamba_backends()} or '
+                                                                   f'auto')
+    parser.add_argument('-calibration', type=str, default=None, help='memory model json to validate (default: '
+                                                                     'nnUNet_memory_model_calibration or the '
+                                                                     'default coefficients)')
+    parser.add_argument('-fit', type=str, default=None, help='fit the coefficients and save them to this json')
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    mamba_backends.default_mamba_backend = args.backend
+    model = get_memory_model(UMambaEnc, args.calibration)
+    model.mamba_backend = mamba_backends.resolve_mamba_backend(args.backend)
+    torch.manual_seed(0)
+
+    print(f'device {device}, mamba backend {model.mamba_backend}, scan type {args.scan_type}, coefficients '
+          f'{model.coefficients()}')
+    rows = []
+    for shape in args.shapes:
+        shape = [int(i) for i in shape.split('x')]
+        _, pool_op_kernel_sizes, _, patch_size, _ = get_pool_and_conv_props([1.] * len(shape), shape, 4, 999999)
+        patch_size = tuple(int(i) for i in patch_size)
+        n_stages = len(pool_op_kernel_sizes)
+        features = tuple(args.features[min(i, len(args.features) - 1)] for i in range(n_stages))
+        # a fresh network per shape, the estimate builder is cached
+        build_umamba_first_pca_for_estimate.cache_clear()
+        network = build_umamba_first_pca_for_estimate(len(patch_size), n_stages,
+                                                      tuple(tuple(i) for i in pool_op_kernel_sizes),
+                                                      args.num_input_channels, features,
+                                                      (2,) * n_stages, (2,) * (n_stages - 1), args.num_labels,
+                                                      args.scan_type)
+        network.set_global_pca_vectors(torch.nn.functional.normalize(torch.randn(1, 3), dim=1))
+        network = network.to(device).train()
+        for batch_size in args.batch_sizes:
+            measured = measure_training_step(network, patch_size, batch_size, args.num_labels, device)
+            rows.append((patch_size, batch_size, model.feature_map_sizes(network, patch_size),
+                         model.fixed_sizes(network, patch_size) if device.type == 'cuda' else {}, measured,
+                         model.estimate(network, patch_size, batch_size)))
+        del network
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def report(estimates):
+        errors = []
+        for (patch_size, batch_size, _, _, measured, _), estimate in zip(rows, estimates):
+            errors.append((estimate - measured) / measured)
+            print(f'  {patch_size} batch size {batch_size}: measured {measured / 2 ** 30:.3f} GB, estimated '
+                  f'{estimate / 2 ** 30:.3f} GB ({100 * errors[-1]:+.1f} %)')
+        print(f'  max abs error {100 * np.max(np.abs(errors)):.1f} %')
+
+    print('\nmemory model' + ('' if device.type == 'cuda' else ' (cuda coefficients, not comparable on cpu)'))
+    report([r[5] for r in rows])
+    if args.fit is not None:
+        fit_memory_model(model, [r[2] for r in rows], [r[3] for r in rows], [r[1] for r in rows],
+                         [r[4] for r in rows])
+        print(f'\nfitted {model.coefficients()}')
+        report([sum(getattr(model, k) * v for k, v in r[2].items()) * r[1] +
+                sum(getattr(model, k) * v for k, v in r[3].items()) + model.fixed_bytes for r in rows])
+        model.save(args.fit)
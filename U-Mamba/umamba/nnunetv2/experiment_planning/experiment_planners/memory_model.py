@@ -0,0 +1,175 @@
+import os
+from typing import Callable, Dict, Tuple, Type
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import load_json, save_json
+from scipy.optimize import nnls
+from torch import nn
+
+# ExperimentPlanner: 560M conv feature map elements (per sample) correspond to batch size 2 on 8 GB (3d)
+DEFAULT_BYTES_PER_CONV_ELEMENT = 8 * 2 ** 30 / (2 * 560000000)
+
+
+class ConvMemoryModel(object):
+    """
+    Training peak GPU memory in bytes of a network at a given patch size and batch size:
+
+        fixed_bytes + bytes_per_parameter * parameters + batch_size * bytes_per_conv_element * conv elements
+
+    where conv elements is the compute_conv_feature_map_size of the network. With the default coefficients this is
+    the reference of ExperimentPlanner expressed in bytes, so planning with it gives the default nnU-Net
+    configurations. Calibrated coefficients can be fitted with
+    nnunetv2.batch_running.benchmarking.validate_memory_model.
+    """
+    def __init__(self, bytes_per_conv_element: float = DEFAULT_BYTES_PER_CONV_ELEMENT,
+                 bytes_per_parameter: float = 0, fixed_bytes: float = 0):
+        self.bytes_per_conv_element = float(bytes_per_conv_element)
+        self.bytes_per_parameter = float(bytes_per_parameter)
+        self.fixed_bytes = float(fixed_bytes)
+
+    def feature_map_sizes(self, network: nn.Module, patch_size: Tuple[int, ...]) -> Dict[str, int]:
+        """
+        Per sample element counts the model needs, keyed by the name of the coefficient they are multiplied with.
+        """
+        return {'bytes_per_conv_element': int(network.compute_conv_feature_map_size(patch_size))}
+
+    def fixed_sizes(self, network: nn.Module, patch_size: Tuple[int, ...]) -> Dict[str, int]:
+        """
+        Batch size independent counts, keyed like feature_map_sizes. fixed_bytes is always added on top.
+        """
+        return {'bytes_per_parameter': sum(p.numel() for p in network.parameters())}
+
+    def estimate(self, network: nn.Module, patch_size: Tuple[int, ...], batch_size: int) -> float:
+        patch_size = tuple(int(i) for i in patch_size)
+        per_sample = sum(getattr(self, k) * v for k, v in self.feature_map_sizes(network, patch_size).items())
+        fixed = sum(getattr(self, k) * v for k, v in self.fixed_sizes(network, patch_size).items())
+        return self.fixed_bytes + fixed + batch_size * per_sample
+
+    def coefficients(self) -> Dict[str, float]:
+        return {'bytes_per_conv_element': self.bytes_per_conv_element,
+                'bytes_per_parameter': self.bytes_per_parameter,
+                'fixed_bytes': self.fixed_bytes}
+
+    def save(self, filename: str):
+        save_json({'class': self.__class__.__name__, **self.coefficients()}, filename, sort_keys=False)
+
+
+class MambaMemoryModel(ConvMemoryModel):
+    """
+    ConvMemoryModel for networks with Mamba layers (UMambaEnc of UMambaFirst_PCA). The full resolution stem MambaLayer
+    does not behave like a conv: per token it keeps several times its expanded inner dimension for backward (plus the
+    scan states with the torch backend), and its scan orders are cached long index tensors. These are accounted
+    separately:
+
+        ... + batch_size * bytes_per_mamba_element * mamba elements + bytes_per_scan_buffer_byte * scan buffer bytes
+
+    mamba elements come from network.compute_mamba_feature_map_size for mamba_backend (the planning machine may not
+    have the backend training runs with), conv elements are the rest of compute_conv_feature_map_size.
+    """
+    def __init__(self, bytes_per_conv_element: float = DEFAULT_BYTES_PER_CONV_ELEMENT,
+                 bytes_per_parameter: float = 0, fixed_bytes: float = 0, bytes_per_mamba_element: float = 4,
+                 bytes_per_scan_buffer_byte: float = 1, mamba_backend: str = 'mamba_ssm'):
+        super().__init__(bytes_per_conv_element, bytes_per_parameter, fixed_bytes)
+        self.bytes_per_mamba_element = float(bytes_per_mamba_element)
+        self.bytes_per_scan_buffer_byte = float(bytes_per_scan_buffer_byte)
+        self.mamba_backend = mamba_backend
+
+    def feature_map_sizes(self, network: nn.Module, patch_size: Tuple[int, ...]) -> Dict[str, int]:
+        total = int(network.compute_conv_feature_map_size(patch_size))
+        mamba_as_built = int(network.compute_mamba_feature_map_size(patch_size))
+        # only the torch backend materializes the scan states
+        mamba = int(network.compute_mamba_feature_map_size(patch_size, scan_states=self.mamba_backend == 'torch'))
+        return {'bytes_per_conv_element': total - mamba_as_built, 'bytes_per_mamba_element': mamba}
+
+    def fixed_sizes(self, network: nn.Module, patch_size: Tuple[int, ...]) -> Dict[str, int]:
+        sizes = super().fixed_sizes(network, patch_size)
+        sizes['bytes_per_scan_buffer_byte'] = int(network.scan_buffer_bytes(patch_size))
+        return sizes
+
+    def coefficients(self) -> Dict[str, float]:
+        coefficients = super().coefficients()
+        coefficients.update({'bytes_per_mamba_element': self.bytes_per_mamba_element,
+                             'bytes_per_scan_buffer_byte': self.bytes_per_scan_buffer_byte,
+                             'mamba_backend': self.mamba_backend})
+        return coefficients
+
+
+_memory_models: Dict[type, Callable[[], ConvMemoryModel]] = {}
+
+
+def register_memory_model(network_class: Type[nn.Module], factory: Callable[[], ConvMemoryModel]):
+    """
+    Use factory() as the memory model of network_class and its subclasses.
+    """
+    _memory_models[network_class] = factory
+
+
+def get_memory_model(network_class: Type[nn.Module], calibration_file: str = None) -> ConvMemoryModel:
+    """
+    Memory model registered for network_class (or the closest base class), ConvMemoryModel if there is none.
+
+    calibration_file: json written by ConvMemoryModel.save (for example by validate_memory_model -fit) whose
+    coefficients replace the defaults. Defaults to the nnUNet_memory_model_calibration environment variable. The
+    file must have been fitted for the same kind of model
+    """
+    _register_default_memory_models()
+    model = ConvMemoryModel()
+    for cls in network_class.__mro__:
+        if cls in _memory_models:
+            model = _memory_models[cls]()
+            break
+    if calibration_file is None:
+        calibration_file = os.environ.get('nnUNet_memory_model_calibration')
+    if calibration_file is not None:
+        calibration = load_json(calibration_file)
+        model_class = calibration.pop('class', model.__class__.__name__)
+        if model_class != model.__class__.__name__:
+            raise RuntimeError(f'{calibration_file} calibrates a {model_class}, but {network_class.__name__} uses a '
+                               f'{model.__class__.__name__}')
+        for k, v in calibration.items():
+            if k not in model.coefficients():
+                raise RuntimeError(f'unknown coefficient {k} in {calibration_file}')
+            setattr(model, k, v if isinstance(v, str) else float(v))
+    return model
+
+
+def fit_memory_model(model: ConvMemoryModel, per_sample_sizes, fixed_sizes, batch_sizes, measured_bytes,
+                     fit_fixed_bytes: bool = True) -> ConvMemoryModel:
+    """
+    Non-negative least squares fit of the coefficients of model to measurements. per_sample_sizes / fixed_sizes are
+    lists (one entry per measurement) of the dicts of feature_map_sizes / fixed_sizes. Coefficients whose counts are
+    zero in all measurements keep their value.
+    """
+    names = sorted(set(k for s in per_sample_sizes for k in s) | set(k for s in fixed_sizes for k in s))
+    columns = [np.array([s.get(k, 0) * b for s, b in zip(per_sample_sizes, batch_sizes)], dtype=np.float64) +
+               np.array([s.get(k, 0) for s in fixed_sizes], dtype=np.float64) for k in names]
+    keep = [i for i, c in enumerate(columns) if np.any(c != 0)]
+    names = [names[i] for i in keep]
+    columns = [columns[i] for i in keep]
+    if fit_fixed_bytes:
+        names.append('fixed_bytes')
+        columns.append(np.ones(len(measured_bytes)))
+    a = np.stack(columns, axis=1)
+    # scale the columns, the counts span many orders of magnitude
+    scale = np.abs(a).max(axis=0)
+    solution = nnls(a / scale, np.asarray(measured_bytes, dtype=np.float64))[0] / scale
+    for k, v in zip(names, solution):
+        setattr(model, k, float(v))
+    return model
+
+
+def _umamba_first_pca_memory_model():
+    return MambaMemoryModel()
+
+
+_default_memory_models_registered = False
+
+
+def _register_default_memory_models():
+    # on first use instead of at import time: the network modules (and mamba) are only needed for an estimate
+    global _default_memory_models_registered
+    if _default_memory_models_registered:
+        return
+    _default_memory_models_registered = True
+    from nnunetv2.nets.UMambaFirst_PCA import UMambaEnc as UMambaFirstPCA
+    register_memory_model(UMambaFirstPCA, _umamba_first_pca_memory_model)
@@ -0,0 +1,77 @@
+from functools import lru_cache
+from typing import Union, List, Tuple
+
+import numpy as np
+from torch import nn
+from dynamic_network_architectures.building_blocks.helper import convert_dim_to_conv_op, get_matching_instancenorm
+
+from nnunetv2.experiment_planning.experiment_planners.default_experiment_planner import ExperimentPlanner
+from nnunetv2.experiment_planning.experiment_planners.memory_model import get_memory_model
+from nnunetv2.nets.UMambaFirst_PCA import UMambaEnc
+
+
+@lru_cache(maxsize=None)
+def build_umamba_first_pca_for_estimate(dim: int, n_stages: int, strides: Tuple[Tuple[int, ...]],
+                                        num_input_channels: int, features_per_stage: Tuple[int, ...],
+                                        blocks_per_stage_encoder: Tuple[int, ...],
+                                        blocks_per_stage_decoder: Tuple[int, ...], num_labels: int,
+                                        scan_type: str = 'global_pca'):
+    """
+    The PSU-Mamba network as get_umamba_first_3d_from_plans builds it for a candidate topology. Only used for memory
+    accounting (which takes the patch size as argument), so no weight init and no scan vectors.
+    """
+    conv_op = convert_dim_to_conv_op(dim)
+    # the architecture does not depend on input_size
+    input_size = [int(i) for i in np.prod(np.array(strides), axis=0)]
+    return UMambaEnc(input_size, num_input_channels, n_stages, list(features_per_stage), conv_op,
+                     [[3] * dim] * n_stages, [list(i) for i in strides], list(blocks_per_stage_encoder), num_labels,
+                     list(blocks_per_stage_decoder), conv_bias=True, norm_op=get_matching_instancenorm(conv_op),
+                     norm_op_kwargs={'eps': 1e-5, 'affine': True}, nonlin=nn.LeakyReLU,
+                     nonlin_kwargs={'inplace': True}, deep_supervision=True, scan_type=scan_type)
+
+class UMambaFirstPCAPlanner(ExperimentPlanner):
+    """
+    Plans 3d configurations for the PSU-Mamba network (UMambaEnc of UMambaFirst_PCA) with the memory model of that
+    network (memory_model.MambaMemoryModel) instead of the conv feature map count of PlainConvUNet. The full
+    resolution stem Mamba layer needs considerably more memory per voxel than a conv layer, so the default plans
+    overestimate the batch size / patch size the network fits.
+
+    The 3d reference values are in bytes: the estimate is the modelled training peak at the reference batch size and
+    the reference is the GPU memory target. 2d configurations are planned like ExperimentPlanner does (the network is
+    3d only). UNet_class_name stays PlainConvUNet, the PSU-Mamba trainers build their network themselves.
+
+    Set nnUNet_memory_model_calibration to a json fitted with validate_memory_model -fit to use calibrated
+    coefficients. The default Mamba coefficients (bytes_per_mamba_element, bytes_per_scan_buffer_byte) are not
+    calibrated on a GPU: the model has only been validated against CPU measurements so far, so without a calibration
+    file the 3d plans may not match the real GPU memory use.
+    """
+    def __init__(self, dataset_name_or_id: Union[str, int],
+                 gpu_memory_target_in_gb: float = 8,
+                 preprocessor_name: str = 'DefaultPreprocessor', plans_name: str = 'nnUNetMambaPlans',
+                 overwrite_target_spacing: Union[List[float], Tuple[float, ...]] = None,
+                 suppress_transpose: bool = False):
+        super().__init__(dataset_name_or_id, gpu_memory_target_in_gb, preprocessor_name, plans_name,
+                         overwrite_target_spacing, suppress_transpose)
+        self.memory_model = get_memory_model(UMambaEnc)
+        self.scan_type = 'global_pca'
+        self.UNet_reference_val_3d = self.UNet_reference_val_corresp_GB * 2 ** 30
+
+    def static_estimate_VRAM_usage(self, patch_size: Tuple[int],
+                                   n_stages: int,
+                                   strides: Union[int, List[int], Tuple[int, ...]],
+                                   UNet_class,
+                                   num_input_channels: int,
+                                   features_per_stage: Tuple[int],
+                                   blocks_per_stage_encoder: Union[int, Tuple[int]],
+                                   blocks_per_stage_decoder: Union[int, Tuple[int]],
+                                   num_labels: int):
+        if len(patch_size) != 3:
+            return ExperimentPlanner.static_estimate_VRAM_usage(patch_size, n_stages, strides, UNet_class,
+                                                                num_input_channels, features_per_stage,
+                                                                blocks_per_stage_encoder, blocks_per_stage_decoder,
+                                                                num_labels)
+        net = build_umamba_first_pca_for_estimate(len(patch_size), n_stages, tuple(tuple(i) for i in strides),
+                                                  num_input_channels, tuple(features_per_stage),
+                                                  tuple(blocks_per_stage_encoder), tuple(blocks_per_stage_decoder),
+                                                  num_labels, self.scan_type)
+        return self.memory_model.estimate(net, patch_size, self.UNet_reference_val_corresp_bs_3d)
@@ -1,13 +1,15 @@
 import os
 from copy import deepcopy
-from typing import Union, List
+from typing import Union, List, Tuple
 
 import numpy as np
 import torch
 from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
 from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle
 
-from nnunetv2.configuration import default_num_processes
+from nnunetv2.configuration import default_num_processes, ANISO_THRESHOLD
+from nnunetv2.preprocessing.resampling.default_resampling import get_do_separate_z, get_lowres_axis
+from nnunetv2.utilities.helpers import softmax_helper_dim0
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 
@@ -106,6 +108,175 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
                  properties_dict)
 
 
+def _separate_z_axis(current_spacing, new_spacing, force_separate_z: Union[bool, None] = False,
+                      separate_z_anisotropy_threshold: float = ANISO_THRESHOLD) -> Union[int, None]:
+    """
+    axis that resample_data_or_seg_to_shape resamples separately (with order_z), None if it resamples all axes at once
+    """
+    if force_separate_z is not None:
+        axis = get_lowres_axis(current_spacing) if force_separate_z else None
+    elif get_do_separate_z(current_spacing, separate_z_anisotropy_threshold):
+        axis = get_lowres_axis(current_spacing)
+    elif get_do_separate_z(new_spacing, separate_z_anisotropy_threshold):
+        axis = get_lowres_axis(new_spacing)
+    else:
+        axis = None
+    # several axes with the largest spacing: resampled together, like resample_data_or_seg_to_shape does
+    return int(axis[0]) if axis is not None and len(axis) == 1 else None
+
+
+def _interpolate_on_device(channel: torch.Tensor, new_shape: List[int], order: int) -> torch.Tensor:
+    x = channel[None, None].float()
+    if order == 0:
+        return torch.nn.functional.interpolate(x, new_shape, mode='nearest-exact')[0, 0]
+    mode = 'trilinear' if len(new_shape) == 3 else 'bilinear'
+    return torch.nn.functional.interpolate(x, new_shape, mode=mode, align_corners=False)[0, 0]
+
+
+def resample_channel_on_device(channel: torch.Tensor, new_shape: Union[Tuple[int, ...], List[int]],
+                               separate_z_axis: Union[int, None] = None, order: int = 3, order_z: int = 0) \
+        -> torch.Tensor:
+    """
+    float32 channel (x, y(, z)) resampled to new_shape with torch interpolation on the device channel is on. torch has
+    no spline interpolation, every order > 0 is linear. With separate_z_axis the other axes are resampled first and
+    separate_z_axis afterwards with order_z (keeping an axis at its size is the identity for align_corners=False)
+    """
+    new_shape = [int(i) for i in new_shape]
+    if list(channel.shape) == new_shape:
+        return channel.float()
+    if separate_z_axis is None:
+        return _interpolate_on_device(channel, new_shape, order)
+    in_plane = list(new_shape)
+    in_plane[separate_z_axis] = channel.shape[separate_z_axis]
+    channel = _interpolate_on_device(channel, in_plane, order) if in_plane != list(channel.shape) else channel.float()
+    return _interpolate_on_device(channel, new_shape, order_z) if in_plane != new_shape else channel
+
+
+def convert_predicted_logits_to_segmentation_on_device(predicted_logits: torch.Tensor,
+                                                       plans_manager: PlansManager,
+                                                       configuration_manager: ConfigurationManager,
+                                                       label_manager: LabelManager,
+                                                       properties_dict: dict,
+                                                       return_probabilities: bool = False):
+    """
+    Same as convert_predicted_logits_to_segmentation_with_correct_shape, but resampling, nonlinearity, argmax and
+    reverting cropping and transpose all happen on the device of predicted_logits (keep them on the GPU!). Only the
+    segmentation (and the probabilities if return_probabilities) is copied to the host, so logits never have to be
+    sent to the export workers.
+
+    Resampling uses torch interpolation (linear instead of the spline order of the plans, see
+    resample_channel_on_device), results can differ from the CPU export in a few boundary voxels.
+    With the default nonlinearities (softmax / sigmoid) and without return_probabilities the logits are resampled one
+    channel at a time and reduced into a running argmax (sigmoid regions: logit > 0), so next to the logits only two
+    volumes of the original size are allocated on the device
+    """
+    if not isinstance(predicted_logits, torch.Tensor):
+        predicted_logits = torch.from_numpy(predicted_logits)
+    device = predicted_logits.device
+    new_shape = [int(i) for i in properties_dict['shape_after_cropping_and_before_resampling']]
+    shape_before_cropping = [int(i) for i in properties_dict['shape_before_cropping']]
+    current_spacing = configuration_manager.spacing if \
+        len(configuration_manager.spacing) == len(new_shape) else \
+        [properties_dict['spacing'][0], *configuration_manager.spacing]
+    kwargs = configuration_manager.configuration.get('resampling_fn_probabilities_kwargs', {})
+    resampling_kwargs = {
+        'separate_z_axis': _separate_z_axis(current_spacing, properties_dict['spacing'],
+                                            kwargs.get('force_separate_z', False),
+                                            kwargs.get('separate_z_anisotropy_threshold', ANISO_THRESHOLD)),
+        'order': kwargs.get('order', 3),
+        'order_z': kwargs.get('order_z', 0)
+    }
+    # uint16 does not exist in torch, int16 covers all label values nnU-Net can export anyway
+    seg_dtype = torch.uint8 if len(label_manager.foreground_labels) < 255 else torch.int16
+
+    with torch.no_grad():
+        predicted_probabilities = None
+        if return_probabilities or label_manager.inference_nonlin not in (torch.sigmoid, softmax_helper_dim0):
+            predicted_probabilities = label_manager.apply_inference_nonlin(torch.stack(
+                [resample_channel_on_device(c, new_shape, **resampling_kwargs) for c in predicted_logits]))
+            segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities).to(seg_dtype)
+        elif label_manager.has_regions:
+            # sigmoid(x) > 0.5 <=> x > 0
+            segmentation = torch.zeros(new_shape, dtype=seg_dtype, device=device)
+            for i, c in enumerate(label_manager.regions_class_order):
+                segmentation[resample_channel_on_device(predicted_logits[i], new_shape, **resampling_kwargs) > 0] = c
+        else:
+            # argmax of softmax is argmax of the logits. Strictly greater keeps the first maximum, like argmax
+            best = resample_channel_on_device(predicted_logits[0], new_shape, **resampling_kwargs)
+            segmentation = torch.zeros(new_shape, dtype=seg_dtype, device=device)
+            for i in range(1, predicted_logits.shape[0]):
+                channel = resample_channel_on_device(predicted_logits[i], new_shape, **resampling_kwargs)
+                better = channel > best
+                segmentation[better] = i
+                best = torch.maximum(best, channel, out=best)
+                del channel, better
+            del best
+
+        # put segmentation in bbox (revert cropping) and revert transpose, still on the device
+        segmentation_reverted_cropping = torch.zeros(shape_before_cropping, dtype=seg_dtype, device=device)
+        slicer = bounding_box_to_slice(properties_dict['bbox_used_for_cropping'])
+        segmentation_reverted_cropping[slicer] = segmentation
+        del segmentation
+        segmentation_reverted_cropping = segmentation_reverted_cropping.permute(
+            *plans_manager.transpose_backward).contiguous().cpu().numpy()
+        if seg_dtype != torch.uint8:
+            segmentation_reverted_cropping = segmentation_reverted_cropping.astype(np.uint16)
+
+        if return_probabilities:
+            # revert cropping
+            probabilities_reverted_cropping = torch.zeros((predicted_probabilities.shape[0],
+                                                           *shape_before_cropping),
+                                                          dtype=predicted_probabilities.dtype, device=device)
+            if not label_manager.has_regions:
+                probabilities_reverted_cropping[0] = 1
+            probabilities_reverted_cropping[tuple([slice(None)] + list(slicer))] = predicted_probabilities
+            del predicted_probabilities
+            # revert transpose
+            probabilities_reverted_cropping = probabilities_reverted_cropping.permute(
+                0, *[i + 1 for i in plans_manager.transpose_backward]).contiguous().cpu().numpy()
+            return segmentation_reverted_cropping, probabilities_reverted_cropping
+    return segmentation_reverted_cropping
+
+
+def export_segmentation(segmentation_final: np.ndarray, properties_dict: dict, plans_manager: PlansManager,
+                        dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
+                        probabilities_final: np.ndarray = None):
+    """
+    writes a segmentation that already has the original shape (and optionally its probabilities), for example the
+    output of convert_predicted_logits_to_segmentation_on_device. Cheap enough for the export workers: only the
+    segmentation has to be sent to them
+    """
+    if isinstance(dataset_json_dict_or_file, str):
+        dataset_json_dict_or_file = load_json(dataset_json_dict_or_file)
+    if probabilities_final is not None:
+        np.savez_compressed(output_file_truncated + '.npz', probabilities=probabilities_final)
+        save_pickle(properties_dict, output_file_truncated + '.pkl')
+    rw = plans_manager.image_reader_writer_class()
+    rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
+                 properties_dict)
+
+
+def export_prediction_from_logits_on_device(predicted_logits: torch.Tensor, properties_dict: dict,
+                                            configuration_manager: ConfigurationManager,
+                                            plans_manager: PlansManager,
+                                            dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
+                                            save_probabilities: bool = False):
+    """
+    export_prediction_from_logits with the conversion done by convert_predicted_logits_to_segmentation_on_device
+    """
+    if isinstance(dataset_json_dict_or_file, str):
+        dataset_json_dict_or_file = load_json(dataset_json_dict_or_file)
+    label_manager = plans_manager.get_label_manager(dataset_json_dict_or_file)
+    ret = convert_predicted_logits_to_segmentation_on_device(predicted_logits, plans_manager, configuration_manager,
+                                                             label_manager, properties_dict,
+                                                             return_probabilities=save_probabilities)
+    if save_probabilities:
+        export_segmentation(ret[0], properties_dict, plans_manager, dataset_json_dict_or_file, output_file_truncated,
+                            ret[1])
+    else:
+        export_segmentation(ret, properties_dict, plans_manager, dataset_json_dict_or_file, output_file_truncated)
+
+
 def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape: List[int], output_file: str,
                       plans_manager: PlansManager, configuration_manager: ConfigurationManager, properties_dict: dict,
                       dataset_json_dict_or_file: Union[dict, str], num_threads_torch: int = default_num_processes) \
@@ -0,0 +1,172 @@
+import os
+import threading
+from multiprocessing.pool import Pool, AsyncResult
+from typing import Callable, List, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+
+def default_shared_memory_limit(fraction: float = 0.5) -> Union[int, None]:
+    """
+    fraction of the size of /dev/shm (where torch puts shared tensors), None if there is no /dev/shm. Containers often
+    have a small one (docker: 64 MB)
+    """
+    if not os.path.isdir('/dev/shm'):
+        return None
+    stat = os.statvfs('/dev/shm')
+    return int(stat.f_blocks * stat.f_frsize * fraction)
+
+
+class ExportQueue(object):
+    """
+    Bounded handoff of predictions to a (spawn) export pool.
+
+    Logits are copied into a small ring of shared memory buffers (torch shared tensors, allocated on first use, grown
+    when a case does not fit and recycled across cases) and only a handle to them is pickled to the worker, instead of
+    the whole array. A buffer is reference counted by the jobs reading it (export, next stage resampling, ...) and
+    returns to the ring when the last of them is done. The parent must not write to a shared tensor after submitting
+    it.
+
+    wait_for_capacity blocks (without polling) until fewer than max_pending jobs are queued or running, so the GPU
+    cannot run away from the export (backpressure). Use it before predicting the next case.
+
+    The buffers hold up to num_buffers (default max_pending, workers + 2) of the largest predictions seen, e.g. 6 x
+    3 x 512 x 512 x 300 float32 logits are 5.7 GB, and stay allocated until close (use try/finally). Their total is
+    capped at max_shared_bytes (default: half of /dev/shm, see default_shared_memory_limit): idle buffers are freed and
+    share waits for busy ones to be released until the new one fits. Predictions larger than the cap are not shared
+    but pickled to the worker through the pool's pipe, as a numpy array.
+    """
+    def __init__(self, export_pool: Pool, max_pending: int = None, num_buffers: int = None,
+                 worker_check_interval: float = 1., max_shared_bytes: int = None):
+        self.export_pool = export_pool
+        self.worker_list = [i for i in export_pool._pool]
+        # same throttling as check_workers_alive_and_busy(..., allowed_num_queued=2)
+        self.max_pending = max_pending if max_pending is not None else len(self.worker_list) + 2
+        # every pending job holds at most one buffer
+        self.num_buffers = num_buffers if num_buffers is not None else self.max_pending
+        self.worker_check_interval = worker_check_interval
+        # None if there is no /dev/shm to size the default from: no cap
+        self.max_shared_bytes = max_shared_bytes if max_shared_bytes is not None else default_shared_memory_limit()
+
+        self._buffers: List[Union[torch.Tensor, None]] = [None] * self.num_buffers
+        self._buffer_refs = [0] * self.num_buffers
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._results: List[Union[AsyncResult, object]] = []
+
+    def _check_workers_alive(self):
+        if not all(i.is_alive() for i in self.worker_list):
+            raise RuntimeError('Some background workers are no longer alive')
+
+    def _wait(self, predicate: Callable[[], bool]):
+        # called with self._condition acquired. The timeout is only there to notice dead workers
+        while not predicate():
+            self._check_workers_alive()
+            self._condition.wait(self.worker_check_interval)
+
+    def wait_for_capacity(self):
+        with self._condition:
+            self._wait(lambda: self._pending < self.max_pending)
+
+    def _shared_bytes(self) -> int:
+        return sum(b.numel() for b in self._buffers if b is not None)
+
+    def _make_room(self, nbytes: int):
+        # called with self._condition acquired. Frees idle buffers (and waits for busy ones to become idle) until
+        # nbytes more fit under max_shared_bytes
+        while self._shared_bytes() + nbytes > self.max_shared_bytes:
+            for i in range(self.num_buffers):
+                if self._buffer_refs[i] == 0:
+                    self._buffers[i] = None
+            if self._shared_bytes() + nbytes > self.max_shared_bytes:
+                self._check_workers_alive()
+                self._condition.wait(self.worker_check_interval)
+
+    def share(self, array: Union[torch.Tensor, np.ndarray]) -> Union[torch.Tensor, np.ndarray]:
+        """
+        copy of array in a free shared buffer of the ring (waits for one to be released if they are all in use). Pass
+        the returned tensor to submit. Arrays larger than max_shared_bytes are returned as numpy array instead (pickled
+        by submit)
+        """
+        if isinstance(array, np.ndarray):
+            array = torch.from_numpy(array)
+        nbytes = array.numel() * array.element_size()
+        if self.max_shared_bytes is not None and nbytes > self.max_shared_bytes:
+            return array.cpu().numpy()
+        with self._condition:
+            self._wait(lambda: 0 in self._buffer_refs)
+            idx = self._buffer_refs.index(0)
+            # claimed until submit takes it over, so that a second share cannot pick the same buffer
+            self._buffer_refs[idx] = 1
+            if self._buffers[idx] is None or self._buffers[idx].numel() < nbytes:
+                # drop the old buffer first so that its memory can be released before the new one is allocated
+                self._buffers[idx] = None
+                if self.max_shared_bytes is not None:
+                    self._make_room(nbytes)
+                self._buffers[idx] = torch.empty(nbytes, dtype=torch.uint8).share_memory_()
+        shared = self._buffers[idx][:nbytes].view(array.dtype).view(array.shape)
+        shared.copy_(array)
+        shared._export_queue_buffer = idx
+        return shared
+
+    def _buffers_of(self, args: Sequence) -> List[int]:
+        return [a._export_queue_buffer for a in args if isinstance(a, torch.Tensor) and
+                hasattr(a, '_export_queue_buffer')]
+
+    def submit(self, fn: Callable, args: Tuple, collect_result: bool = True) -> AsyncResult:
+        """
+        fn(*args) in the export pool. Tensors returned by share are passed by handle and their buffer stays claimed
+        until the job is done. Does not block, call wait_for_capacity before producing the next prediction.
+        collect_result: add the job to the results returned by get_results
+        """
+        buffers = self._buffers_of(args)
+        with self._condition:
+            self._pending += 1
+            for b in buffers:
+                self._buffer_refs[b] += 1
+
+        def _release(_):
+            with self._condition:
+                self._pending -= 1
+                for b in buffers:
+                    self._buffer_refs[b] -= 1
+                self._condition.notify_all()
+
+        result = self.export_pool.apply_async(fn, args, callback=_release, error_callback=_release)
+        if collect_result:
+            self._results.append(result)
+        return result
+
+    def release(self, shared: Union[torch.Tensor, np.ndarray]):
+        """
+        gives up the claim share put on the buffer of shared. Jobs submitted with it keep it until they are done
+        """
+        if not hasattr(shared, '_export_queue_buffer'):
+            # too large to be shared, see share
+            return
+        with self._condition:
+            self._buffer_refs[shared._export_queue_buffer] -= 1
+            self._condition.notify_all()
+
+    def add_result(self, result):
+        """
+        result that is already there (e.g. converted on the GPU), returned by get_results in submission order
+        """
+        self._results.append(result)
+
+    def get_results(self) -> list:
+        """
+        waits for all jobs and returns their results (and the ones from add_result) in submission order. Raises the
+        exception of a failed job
+        """
+        with self._condition:
+            self._wait(lambda: self._pending == 0)
+        return [i.get() if isinstance(i, AsyncResult) else i for i in self._results]
+
+    def close(self):
+        """
+        frees the shared buffers. Call it in a finally block, the buffers stay in /dev/shm as long as the queue is
+        referenced (e.g. by the traceback of an exception)
+        """
+        self._buffers = [None] * self.num_buffers
@@ -4,7 +4,6 @@ import multiprocessing
 import os
 import traceback
 from copy import deepcopy
-from time import sleep
 from typing import Tuple, Union, List, Optional
 
 import numpy as np
@@ -23,27 +22,24 @@ from nnunetv2.configuration import default_num_processes
 from nnunetv2.inference.data_iterators import PreprocessAdapterFromNpy, preprocessing_iterator_fromfiles, \
     preprocessing_iterator_fromnpy
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
-    convert_predicted_logits_to_segmentation_with_correct_shape
+    convert_predicted_logits_to_segmentation_with_correct_shape, convert_predicted_logits_to_segmentation_on_device, \
+    export_segmentation
+from nnunetv2.inference.export_queue import ExportQueue
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian, \
-    compute_steps_for_sliding_window
+    compute_steps_for_sliding_window, bounding_box, fit_box_to_tiles
 #from nnunetv2.inference.predict_from_raw_data_pca import PCAAwarePredictor
-from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
+from nnunetv2.utilities.file_path_utilities import get_output_folder
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
-from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from nnunetv2.utilities.helpers import empty_cache, dummy_context, get_available_memory
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+from nnunetv2.utilities.pca_utils import pad_centered
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.scan_plan import ScanPlan
 from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
 
-# Import your MambaLayer
-from nnunetv2.nets.UMambaFirst import MambaLayer
-from nnunetv2.nets.UMambaFirst_3d import MambaLayer as MambaLayer3d
-from nnunetv2.nets.UMambaFirst_32 import MambaLayer as MambaLayer32
-from nnunetv2.nets.UMambaFirst_patch16 import MambaLayer as MambaLayer_patch16
-#from nnunetv2.nets.UMambaFirst_global32 import MambaLayer as MambaLayer_global32 #! add reassemble patches to utils 
-from nnunetv2.nets.UMambaFirst_z_3d import MambaLayer as MambaLayer_z
-from nnunetv2.nets.UMambaFirst_global import MambaLayer as MambaLayer_global
-from nnunetv2.nets.UMambaFirst_PCA import MambaLayer as MambaLayer_PCA
+# base class of the Mamba layers of all UMambaFirst networks
+from nnunetv2.nets.mamba_layer import MambaLayer
 
 class nnUNetPredictor(object):
     def __init__(self,
@@ -54,7 +50,14 @@ class nnUNetPredictor(object):
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 fuse_folds: bool = True,
+                 tile_batch_size: Union[int, str] = 'auto',
+                 roi_mode: str = None,
+                 roi_margin: int = 16,
+                 adaptive_tta: bool = False,
+                 tta_confidence: float = 0.99,
+                 export_on_device: bool = False):
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -72,8 +75,53 @@ class nnUNetPredictor(object):
         if device.type != 'cuda':
             print(f'perform_everything_on_device=True is only supported for cuda devices! Setting this to False')
             perform_everything_on_device = False
+            export_on_device = False
         self.device = device
         self.perform_everything_on_device = perform_everything_on_device
+        # (padding lower bounds, unpadded shape) of each image currently predicted with the sliding window. Used to
+        # tell position dependent scan strategies (local PCA Mamba) where each tile is located
+        self._sliding_window_geometry = None
+        # scan plan of each entry in list_of_parameters (PCA Mamba trainers store it in the checkpoint), None otherwise
+        self.list_of_scan_plans = None
+        self._applied_scan_plan_hash = None
+        # scan type the network was built with, used by folds without a scan plan
+        self._default_scan_type = None
+        # fused multi-fold inference: keep one network per fold on the device and run every tile through all of them
+        # (one sliding window pass instead of one per fold). Only used if the copies fit, see _get_fold_networks
+        self.fuse_folds = fuse_folds
+        self._fold_networks = None
+        self._fold_fusion_possible = None
+        self._active_fold_networks = None
+        # number of sliding window tiles (each with all its mirrored variants) per forward pass. 'auto' picks it from
+        # the available memory, see _get_tile_batch_size
+        self.tile_batch_size = tile_batch_size
+        # activations of one tile (estimated once per network), the auto tile batch size of the last pass
+        self._tile_forward_bytes = None
+        self._auto_tile_batch_size = None
+        # region of interest inference: only the tiles covering the (roi_margin voxels dilated) bounding box of the
+        # foreground are predicted, everything else is background. 'prior': foreground of the training prior
+        # (roi_prior, the binary mean mask the PSU-Mamba trainer saves), 'localize': foreground of a cheap first pass
+        # (no tile overlap, no mirroring). None predicts all tiles
+        assert roi_mode in (None, 'prior', 'localize'), f'roi_mode must be None, prior or localize, got {roi_mode}'
+        self.roi_mode = roi_mode
+        self.roi_margin = roi_margin
+        self.roi_prior = None
+        # tiles predicted / skipped by the roi mode so far (all cases and folds)
+        self.roi_tiles_predicted = 0
+        self.roi_tiles_skipped = 0
+        # adaptive mirroring: tiles are predicted unmirrored first, the mirrored variants only run for tiles with a
+        # voxel whose predicted class has a probability below tta_confidence (near a decision boundary)
+        self.adaptive_tta = adaptive_tta
+        self.tta_confidence = tta_confidence
+        # tile forward passes (per tile, mirrored variant and fold) run / saved by adaptive mirroring so far. Only
+        # sliding window passes that succeeded are counted, not the ones retried after running out of memory
+        self.tta_forwards_run = 0
+        self.tta_forwards_saved = 0
+        # (run, saved) of the last tile batch, collected by _internal_predict_sliding_window_return_logits
+        self._tta_batch_forwards = None
+        # resample, argmax and revert cropping on the GPU (convert_predicted_logits_to_segmentation_on_device) so that
+        # only the segmentation is sent to the export workers instead of the full logits. cuda only
+        self.export_on_device = export_on_device
 
     def initialize_from_trained_model_folder(self, model_training_output_dir: str,
                                              use_folds: Union[Tuple[Union[int, str]], None],
@@ -92,6 +140,7 @@ class nnUNetPredictor(object):
             use_folds = [use_folds]
 
         parameters = []
+        scan_plans = []
         for i, f in enumerate(use_folds):
             f = int(f) if f != 'all' else f
             #checkpoint = torch.load(join(model_training_output_dir, f'fold_{f}', checkpoint_name),
@@ -105,6 +154,8 @@ class nnUNetPredictor(object):
                     'inference_allowed_mirroring_axes' in checkpoint.keys() else None
 
             parameters.append(checkpoint['network_weights'])
+            scan_plans.append(ScanPlan.from_state_dict(checkpoint['scan_plan'])
+                              if checkpoint.get('scan_plan') is not None else None)
 
         configuration_manager = plans_manager.get_configuration(configuration_name)
         # restore network
@@ -121,6 +172,14 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self.list_of_scan_plans = scan_plans if any(i is not None for i in scan_plans) else None
+        self._applied_scan_plan_hash = None
+        self._default_scan_type = getattr(network, 'scan_type', None)
+        self._fold_networks, self._fold_fusion_possible = None, None
+        self._tile_forward_bytes, self._auto_tile_batch_size = None, None
+        self.roi_prior = self._load_roi_prior(model_training_output_dir, use_folds)
+        if self.list_of_scan_plans is not None:
+            self._maybe_apply_scan_plan(self.list_of_scan_plans[0])
         if ('nnUNet_compile' in os.environ.keys()) and (os.environ['nnUNet_compile'].lower() in ('true', '1', 't')) \
                 and not isinstance(self.network, OptimizedModule):
             print('Using torch.compile')
@@ -141,6 +200,10 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        # the trainer's network is already set up with its scan plan
+        self.list_of_scan_plans = None
+        self._fold_networks, self._fold_fusion_possible = None, None
+        self._tile_forward_bytes, self._auto_tile_batch_size = None, None
         allow_compile = True
         allow_compile = allow_compile and ('nnUNet_compile' in os.environ.keys()) and (os.environ['nnUNet_compile'].lower() in ('true', '1', 't'))
         allow_compile = allow_compile and not isinstance(self.network, OptimizedModule)
@@ -390,67 +453,76 @@ class nnUNetPredictor(object):
             - Clears the LRU cache and device cache after predictions.
         """
         with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
-            worker_list = [i for i in export_pool._pool]
-            r = []
-            for preprocessed in data_iterator:
-                data = preprocessed['data']
-                if isinstance(data, str):
-                    delfile = data
-                    data = torch.from_numpy(np.load(data))
-                    os.remove(delfile)
-
-                ofile = preprocessed['ofile']
-                if ofile is not None:
-                    print(f'\nPredicting {os.path.basename(ofile)}:')
-                else:
-                    print(f'\nPredicting image of shape {data.shape}:')
-
-                print(f'perform_everything_on_device: {self.perform_everything_on_device}')
-
-                properties = preprocessed['data_properties']
-
-                # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
-                # npy files
-                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                while not proceed:
-                    # print('sleeping')
-                    sleep(0.1)
-                    proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-
-                prediction = self.predict_logits_from_preprocessed_data(data).cpu()
-
-                if ofile is not None:
-                    # this needs to go into background processes
-                    # export_prediction_from_logits(prediction, properties, configuration_manager, plans_manager,
-                    #                               dataset_json, ofile, save_probabilities)
-                    print('sending off prediction to background worker for resampling and export')
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits,
-                            ((prediction, properties, self.configuration_manager, self.plans_manager,
-                              self.dataset_json, ofile, save_probabilities),)
-                        )
-                    )
-                else:
-                    # convert_predicted_logits_to_segmentation_with_correct_shape(prediction, plans_manager,
-                    #                                                             configuration_manager, label_manager,
-                    #                                                             properties,
-                    #                                                             save_probabilities)
-                    print('sending off prediction to background worker for resampling')
-                    r.append(
-                        export_pool.starmap_async(
-                            convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                (prediction, self.plans_manager,
-                                 self.configuration_manager, self.label_manager,
-                                 properties,
-                                 save_probabilities),)
-                        )
-                    )
-                if ofile is not None:
-                    print(f'done with {os.path.basename(ofile)}')
-                else:
-                    print(f'\nDone with image of shape {data.shape}:')
-            ret = [i.get()[0] for i in r]
+            # logits go to the workers through a ring of shared memory buffers, see ExportQueue
+            export_queue = ExportQueue(export_pool)
+            try:
+                for preprocessed in data_iterator:
+                    data = preprocessed['data']
+                    if isinstance(data, str):
+                        delfile = data
+                        data = torch.from_numpy(np.load(data))
+                        os.remove(delfile)
+
+                    ofile = preprocessed['ofile']
+                    if ofile is not None:
+                        print(f'\nPredicting {os.path.basename(ofile)}:')
+                    else:
+                        print(f'\nPredicting image of shape {data.shape}:')
+
+                    print(f'perform_everything_on_device: {self.perform_everything_on_device}')
+
+                    properties = preprocessed['data_properties']
+
+                    # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
+                    # npy files
+                    export_queue.wait_for_capacity()
+
+                    converted = None
+                    if self.export_on_device:
+                        prediction = self.predict_logits_from_preprocessed_data(data, return_on_device=True)
+                        converted = self._maybe_convert_logits_on_device(prediction, properties, save_probabilities)
+                        prediction = prediction.cpu() if converted is None else None
+                    else:
+                        prediction = self.predict_logits_from_preprocessed_data(data).cpu()
+
+                    if converted is not None:
+                        if ofile is not None:
+                            print('sending off segmentation to background worker for export')
+                            segmentation, probabilities = converted if save_probabilities else (converted, None)
+                            export_queue.submit(export_segmentation,
+                                                (segmentation, properties, self.plans_manager, self.dataset_json, ofile,
+                                                 probabilities))
+                        else:
+                            export_queue.add_result(converted)
+                    else:
+                        prediction = export_queue.share(prediction)
+                        if ofile is not None:
+                            # this needs to go into background processes
+                            # export_prediction_from_logits(prediction, properties, configuration_manager, plans_manager,
+                            #                               dataset_json, ofile, save_probabilities)
+                            print('sending off prediction to background worker for resampling and export')
+                            export_queue.submit(export_prediction_from_logits,
+                                                (prediction, properties, self.configuration_manager, self.plans_manager,
+                                                 self.dataset_json, ofile, save_probabilities))
+                        else:
+                            # convert_predicted_logits_to_segmentation_with_correct_shape(prediction, plans_manager,
+                            #                                                             configuration_manager, label_manager,
+                            #                                                             properties,
+                            #                                                             save_probabilities)
+                            print('sending off prediction to background worker for resampling')
+                            export_queue.submit(convert_predicted_logits_to_segmentation_with_correct_shape,
+                                                (prediction, self.plans_manager, self.configuration_manager,
+                                                 self.label_manager, properties, save_probabilities))
+                        export_queue.release(prediction)
+                        del prediction
+                    if ofile is not None:
+                        print(f'done with {os.path.basename(ofile)}')
+                    else:
+                        print(f'\nDone with image of shape {data.shape}:')
+                ret = export_queue.get_results()
+            finally:
+                # also on errors, the buffers live in /dev/shm
+                export_queue.close()
 
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
@@ -478,7 +550,20 @@ class nnUNetPredictor(object):
 
         if self.verbose:
             print('predicting')
-        predicted_logits = self.predict_logits_from_preprocessed_data(dct['data']).cpu()
+        if self.export_on_device:
+            predicted_logits = self.predict_logits_from_preprocessed_data(dct['data'], return_on_device=True)
+            ret = self._maybe_convert_logits_on_device(predicted_logits, dct['data_properties'],
+                                                       save_or_return_probabilities)
+            if ret is not None:
+                if output_file_truncated is None:
+                    return ret
+                segmentation, probabilities = ret if save_or_return_probabilities else (ret, None)
+                export_segmentation(segmentation, dct['data_properties'], self.plans_manager, self.dataset_json,
+                                    output_file_truncated, probabilities)
+                return
+            predicted_logits = predicted_logits.cpu()
+        else:
+            predicted_logits = self.predict_logits_from_preprocessed_data(dct['data']).cpu()
 
         if self.verbose:
             print('resampling to original shape')
@@ -498,45 +583,99 @@ class nnUNetPredictor(object):
             else:
                 return ret
 
-    def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
+    def _maybe_convert_logits_on_device(self, predicted_logits: torch.Tensor, properties: dict,
+                                        return_probabilities: bool = False):
+        """
+        convert_predicted_logits_to_segmentation_on_device, None if that fails (most likely out of memory, the caller
+        then exports the logits on the CPU as usual)
+        """
+        try:
+            return convert_predicted_logits_to_segmentation_on_device(predicted_logits, self.plans_manager,
+                                                                      self.configuration_manager, self.label_manager,
+                                                                      properties, return_probabilities)
+        except RuntimeError:
+            print('Export on device was unsuccessful, probably due to a lack of memory. Exporting on the CPU')
+            empty_cache(self.device)
+            return None
+
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor, return_on_device: bool = False) -> torch.Tensor:
         """
         IMPORTANT! IF YOU ARE RUNNING THE CASCADE, THE SEGMENTATION FROM THE PREVIOUS STAGE MUST ALREADY BE STACKED ON
         TOP OF THE IMAGE AS ONE-HOT REPRESENTATION! SEE PreprocessAdapter ON HOW THIS SHOULD BE DONE!
 
         RETURNED LOGITS HAVE THE SHAPE OF THE INPUT. THEY MUST BE CONVERTED BACK TO THE ORIGINAL IMAGE SIZE.
         SEE convert_predicted_logits_to_segmentation_with_correct_shape
+
+        return_on_device: return the logits on self.device instead of the CPU (for
+        convert_predicted_logits_to_segmentation_on_device). Folds predicted one after another are still summed up on
+        the CPU
+        """
+        return self.predict_logits_from_list_of_preprocessed_data([data], return_on_device)[0]
+
+    def predict_logits_from_list_of_preprocessed_data(self, list_of_data: List[torch.Tensor],
+                                                      return_on_device: bool = False) -> List[torch.Tensor]:
+        """
+        predict_logits_from_preprocessed_data for several cases at once: the sliding window tiles of all cases share
+        the forward passes (see predict_sliding_window_return_logits_of_cases). Returns the logits of each case
         """
+        output_device = self.device if return_on_device else torch.device('cpu')
         n_threads = torch.get_num_threads()
         torch.set_num_threads(default_num_processes if default_num_processes < n_threads else n_threads)
         with torch.no_grad():
-            prediction = None
-
-            for params in self.list_of_parameters:
+            predictions = None
+
+            fold_networks = self._get_fold_networks()
+            if fold_networks is not None:
+                self._active_fold_networks = fold_networks
+                try:
+                    predictions = [i.to(output_device) for i in
+                                   self.predict_sliding_window_return_logits_of_cases(list_of_data)]
+                except RuntimeError:
+                    print('Fused multi-fold prediction was unsuccessful, probably due to a lack of memory. Predicting '
+                          'folds one after another')
+                    self._release_fold_networks()
+                finally:
+                    self._active_fold_networks = None
+            fused = predictions is not None
+
+            for i, params in enumerate(self.list_of_parameters if not fused else []):
 
                 # messing with state dict names...
                 if not isinstance(self.network, OptimizedModule):
                     self.network.load_state_dict(params)
                 else:
                     self.network._orig_mod.load_state_dict(params)
+                if self.list_of_scan_plans is not None:
+                    self._maybe_apply_scan_plan(self.list_of_scan_plans[i])
 
                 # why not leave prediction on device if perform_everything_on_device? Because this may cause the
                 # second iteration to crash due to OOM. Grabbing tha twith try except cause way more bloated code than
                 # this actually saves computation time
-                if prediction is None:
-                    prediction = self.predict_sliding_window_return_logits(data).to('cpu')
+                if predictions is None:
+                    predictions = [i.to(output_device if len(self.list_of_parameters) == 1 else 'cpu') for i in
+                                   self.predict_sliding_window_return_logits_of_cases(list_of_data)]
                 else:
-                    prediction += self.predict_sliding_window_return_logits(data).to('cpu')
+                    for prediction, i in zip(predictions,
+                                             self.predict_sliding_window_return_logits_of_cases(list_of_data)):
+                        prediction += i.to('cpu')
 
-            if len(self.list_of_parameters) > 1:
-                prediction /= len(self.list_of_parameters)
+            if len(self.list_of_parameters) > 1 and not fused:
+                for prediction in predictions:
+                    prediction /= len(self.list_of_parameters)
 
             if self.verbose: print('Prediction done')
-            prediction = prediction.to('cpu')
+            predictions = [i.to(output_device) for i in predictions]
         torch.set_num_threads(n_threads)
-        return prediction
+        return predictions
 
-    def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...]):
+    def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...],
+                                             roi: Tuple[List[int], List[int]] = None):
+        """
+        roi: (lower, upper) bounds of the region to tile, None for the whole image. It is grown to the tile size where
+        needed, see fit_box_to_tiles
+        """
         slicers = []
+        lower, upper = roi if roi is not None else ([0] * len(image_size), list(image_size))
         if len(self.configuration_manager.patch_size) < len(image_size):
             assert len(self.configuration_manager.patch_size) == len(
                 image_size) - 1, 'if tile_size has less entries than image_size, ' \
@@ -544,20 +683,25 @@ class nnUNetPredictor(object):
                                  'must be one shorter than len(image_size) ' \
                                  '(only dimension ' \
                                  'discrepancy of 1 allowed).'
-            steps = compute_steps_for_sliding_window(image_size[1:], self.configuration_manager.patch_size,
-                                                     self.tile_step_size)
-            if self.verbose: print(f'n_steps {image_size[0] * len(steps[0]) * len(steps[1])}, image size is'
+            box_lower, box_upper = fit_box_to_tiles(lower[1:], upper[1:], image_size[1:],
+                                                    self.configuration_manager.patch_size)
+            steps = compute_steps_for_sliding_window([u - l for l, u in zip(box_lower, box_upper)],
+                                                     self.configuration_manager.patch_size, self.tile_step_size)
+            steps = [[i + l for i in s] for s, l in zip(steps, box_lower)]
+            if self.verbose: print(f'n_steps {(upper[0] - lower[0]) * len(steps[0]) * len(steps[1])}, image size is'
                                    f' {image_size}, tile_size {self.configuration_manager.patch_size}, '
                                    f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
-            for d in range(image_size[0]):
+            for d in range(lower[0], upper[0]):
                 for sx in steps[0]:
                     for sy in steps[1]:
                         slicers.append(
                             tuple([slice(None), d, *[slice(si, si + ti) for si, ti in
                                                      zip((sx, sy), self.configuration_manager.patch_size)]]))
         else:
-            steps = compute_steps_for_sliding_window(image_size, self.configuration_manager.patch_size,
-                                                     self.tile_step_size)
+            box_lower, box_upper = fit_box_to_tiles(lower, upper, image_size, self.configuration_manager.patch_size)
+            steps = compute_steps_for_sliding_window([u - l for l, u in zip(box_lower, box_upper)],
+                                                     self.configuration_manager.patch_size, self.tile_step_size)
+            steps = [[i + l for i in s] for s, l in zip(steps, box_lower)]
             if self.verbose: print(
                 f'n_steps {np.prod([len(i) for i in steps])}, image size is {image_size}, tile_size {self.configuration_manager.patch_size}, '
                 f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
@@ -569,70 +713,451 @@ class nnUNetPredictor(object):
                                                   zip((sx, sy, sz), self.configuration_manager.patch_size)]]))
         return slicers
 
-    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor) -> torch.Tensor:
+    def _internal_get_mirror_axes_combinations(self, ndim: int) -> List[Tuple[int, ...]]:
+        """
+        Flip axes of all test time augmentation variants of a (b, c, x, y(, z)) tensor, starting with () (no flip)
+        """
         mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
-        prediction = self.network(x)
-
-        if mirror_axes is not None:
-            # check for invalid numbers in mirror_axes
-            # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
-            assert max(mirror_axes) <= x.ndim - 3, 'mirror_axes does not match the dimension of the input!'
-
-            axes_combinations = [
-                c for i in range(len(mirror_axes)) for c in itertools.combinations([m + 2 for m in mirror_axes], i + 1)
-            ]
-            for axes in axes_combinations:
-                prediction += torch.flip(self.network(torch.flip(x, (*axes,))), (*axes,))
-            prediction /= (len(axes_combinations) + 1)
+        if mirror_axes is None:
+            return [()]
+        # check for invalid numbers in mirror_axes
+        # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
+        assert max(mirror_axes) <= ndim - 3, 'mirror_axes does not match the dimension of the input!'
+        return [()] + [
+            c for i in range(len(mirror_axes)) for c in itertools.combinations([m + 2 for m in mirror_axes], i + 1)
+        ]
+
+    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor, tiles=None) -> torch.Tensor:
+        """
+        tiles: (case index, slicer) of each tile of x, for position dependent scans (see _maybe_set_scan_origins)
+        """
+        axes_combinations = self._internal_get_mirror_axes_combinations(x.ndim)
+        # fused multi-fold inference: the tiles go through all folds back to back, their average is returned
+        networks = self._active_fold_networks if self._active_fold_networks is not None else [self.network]
+        if self.adaptive_tta and len(axes_combinations) > 1:
+            return self._internal_adaptive_mirror_and_predict(x, tiles, axes_combinations, networks)
+        if tiles is not None:
+            self._maybe_set_scan_origins(tiles, len(axes_combinations))
+
+        # all mirrored variants go through the network as one batch: (tiles of variant 0, tiles of variant 1, ...)
+        b = x.shape[0]
+        if len(axes_combinations) > 1:
+            x = torch.cat([torch.flip(x, axes) if len(axes) > 0 else x for axes in axes_combinations])
+
+        prediction = None
+        for network in networks:
+            output = network(x)
+            for i, axes in enumerate(axes_combinations):
+                o = output[i * b:(i + 1) * b]
+                if len(axes) > 0:
+                    o = torch.flip(o, axes)
+                if prediction is None:
+                    prediction = o.clone()
+                else:
+                    prediction += o
+        prediction /= (len(axes_combinations) * len(networks))
         return prediction
 
+    def _internal_get_uncertain_tiles(self, logits: torch.Tensor) -> torch.Tensor:
+        """
+        (b,) bool, whether a tile of logits (b, c, x, y(, z)) has a voxel whose predicted class (each region for
+        region based models) has a probability below tta_confidence
+        """
+        logits = logits.float()
+        if self.label_manager.has_regions:
+            p = torch.sigmoid(logits)
+            confidence = torch.maximum(p, 1 - p).amin(1)
+        else:
+            confidence = torch.softmax(logits, 1).amax(1)
+        return confidence.flatten(1).amin(1) < self.tta_confidence
+
+    def _internal_adaptive_mirror_and_predict(self, x: torch.Tensor, tiles, axes_combinations, networks) \
+            -> torch.Tensor:
+        """
+        _internal_maybe_mirror_and_predict with adaptive mirroring: the unmirrored variant of all tiles first, then the
+        mirrored variants of the uncertain tiles only (see _internal_get_uncertain_tiles). Certain tiles get the
+        average of the unmirrored predictions of all folds.
+        """
+        b = x.shape[0]
+        if tiles is not None:
+            self._maybe_set_scan_origins(tiles, 1)
+        prediction = None
+        for network in networks:
+            o = network(x)
+            prediction = o.clone() if prediction is None else prediction + o
+        uncertain = self._internal_get_uncertain_tiles(prediction / len(networks))
+        n_uncertain = int(uncertain.sum())
+        n_mirrored = len(axes_combinations) - 1
+        forwards = ((b + n_uncertain * n_mirrored) * len(networks), (b - n_uncertain) * n_mirrored * len(networks))
+        if n_uncertain == 0:
+            self._tta_batch_forwards = forwards
+            return prediction / len(networks)
+
+        xu = x[uncertain]
+        if tiles is not None:
+            self._maybe_set_scan_origins([t for t, u in zip(tiles, uncertain.tolist()) if u], n_mirrored)
+        xu = torch.cat([torch.flip(xu, axes) for axes in axes_combinations[1:]])
+        mirrored = prediction[uncertain]
+        for network in networks:
+            output = network(xu)
+            for i, axes in enumerate(axes_combinations[1:]):
+                mirrored += torch.flip(output[i * n_uncertain:(i + 1) * n_uncertain], axes)
+        prediction /= len(networks)
+        prediction[uncertain] = mirrored / (len(axes_combinations) * len(networks))
+        # only now, a batch that runs out of memory is retried and must not be counted twice
+        self._tta_batch_forwards = forwards
+        return prediction
+
+    def _estimate_forward_bytes(self, x: torch.Tensor) -> int:
+        """
+        Sum of the sizes of all module outputs of one forward pass of x. Over-estimates the peak memory of an
+        inference forward pass (intermediates are freed early in no_grad mode), which is fine for sizing batches.
+        """
+        total = [0]
+
+        def hook(module, inputs, output):
+            for o in (output if isinstance(output, (list, tuple)) else [output]):
+                if isinstance(o, torch.Tensor):
+                    total[0] += o.numel() * o.element_size()
+
+        network = self._get_unwrapped_network()
+        handles = [m.register_forward_hook(hook) for m in network.modules() if len(list(m.children())) == 0]
+        try:
+            network(x)
+        finally:
+            for h in handles:
+                h.remove()
+        return total[0]
+
+    def _get_tile_batch_size(self, tile: torch.Tensor, n_tiles: int, n_variants: int, max_batch_size: int = 16) -> int:
+        """
+        Number of tiles per forward pass. Each tile is run together with its n_variants - 1 mirrored variants. In
+        'auto' mode this is determined for every pass such that the estimated activations of a batch take at most
+        half of the memory that is available once the logits buffers of the case are allocated (must be called after
+        allocating them). tile: one of the n_tiles tiles (c, x, y(, z)) of the pass
+        """
+        if self.tile_batch_size != 'auto':
+            return max(1, min(int(self.tile_batch_size), n_tiles))
+        if self._tile_forward_bytes is None:
+            self._tile_forward_bytes = self._estimate_forward_bytes(tile[None].to(self.device))
+        per_tile = self._tile_forward_bytes * n_variants
+        available = get_available_memory(self.device)
+        batch_size = 1 if available is None else int(available // 2 // max(per_tile, 1))
+        self._auto_tile_batch_size = max(1, min(batch_size, max_batch_size))
+        if self.verbose:
+            print(f'tile batch size {self._auto_tile_batch_size} ({n_variants} mirrored variants per tile, '
+                  f'~{per_tile / 1024 ** 2:.0f} MB per tile)')
+        return min(self._auto_tile_batch_size, n_tiles)
+
     def _internal_predict_sliding_window_return_logits(self,
                                                        data: torch.Tensor,
                                                        slicers,
                                                        do_on_device: bool = True,
+                                                       background_outside: bool = False
                                                        ):
+        """
+        background_outside: the slicers do not cover the whole image (roi mode), voxels no tile covers get background
+        logits
+        """
+        return self._internal_predict_sliding_window_return_logits_of_cases([data], [slicers], do_on_device,
+                                                                            [background_outside])[0]
+
+    def _internal_predict_sliding_window_return_logits_of_cases(self,
+                                                                list_of_data: List[torch.Tensor],
+                                                                list_of_slicers,
+                                                                do_on_device: bool = True,
+                                                                background_outside: List[bool] = None
+                                                                ) -> List[torch.Tensor]:
+        """
+        _internal_predict_sliding_window_return_logits for several images at once. All tiles have the patch size, so
+        the tiles of all images go through the same forward passes, each prediction is added to the logits of its
+        image. self._sliding_window_geometry must hold the geometry of each image (for _maybe_set_scan_origins)
+        """
+        if background_outside is None:
+            background_outside = [False] * len(list_of_data)
         results_device = self.device if do_on_device else torch.device('cpu')
         empty_cache(self.device)
 
         # move data to device
         if self.verbose:
             print(f'move image to device {results_device}')
-        data = data.to(results_device)
+        list_of_data = [data.to(results_device) for data in list_of_data]
 
         # preallocate arrays
         if self.verbose:
             print(f'preallocating results arrays on device {results_device}')
-        predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
-                                       dtype=torch.half,
-                                       device=results_device)
-        n_predictions = torch.zeros(data.shape[1:], dtype=torch.half, device=results_device)
+        predicted_logits = [torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
+                                        dtype=torch.half,
+                                        device=results_device) for data in list_of_data]
+        n_predictions = [torch.zeros(data.shape[1:], dtype=torch.half, device=results_device) for data in list_of_data]
         if self.use_gaussian:
             gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
                                         value_scaling_factor=10,
                                         device=results_device)
 
-        if self.verbose: print('running prediction')
-        if not self.allow_tqdm and self.verbose: print(f'{len(slicers)} steps')
-        for sl in tqdm(slicers, disable=not self.allow_tqdm):
-            workon = data[sl][None]
-            workon = workon.to(self.device, non_blocking=False)
+        # (case index, slicer), the tiles of one case after the other
+        tiles = [(c, sl) for c, slicers in enumerate(list_of_slicers) for sl in slicers]
+        n_variants = len(self._internal_get_mirror_axes_combinations(list_of_data[0].ndim + 1))
+        tile_batch_size = self._get_tile_batch_size(list_of_data[0][list_of_slicers[0][0]], len(tiles), n_variants)
+
+        if self.verbose: print(f'running prediction, {tile_batch_size} tiles per forward pass')
+        if not self.allow_tqdm and self.verbose: print(f'{len(tiles)} steps')
+        # adaptive TTA forward passes of this pass, counted once it is done (it is rerun if it runs out of memory)
+        tta_forwards_run, tta_forwards_saved = 0, 0
+        with tqdm(total=len(tiles), disable=not self.allow_tqdm) as pbar:
+            i = 0
+            while i < len(tiles):
+                batch_tiles = tiles[i:i + tile_batch_size]
+                workon = torch.stack([list_of_data[c][sl] for c, sl in batch_tiles])
+                workon = workon.to(self.device, non_blocking=False)
+
+                self._tta_batch_forwards = None
+                try:
+                    prediction = self._internal_maybe_mirror_and_predict(workon, batch_tiles).to(results_device)
+                except RuntimeError:
+                    # the auto tuned tile batch size was too optimistic: halve it and retry this batch. Later passes
+                    # assume twice the activations per tile
+                    if self.tile_batch_size != 'auto' or tile_batch_size == 1:
+                        raise
+                    del workon
+                    empty_cache(self.device)
+                    tile_batch_size = self._auto_tile_batch_size = max(1, tile_batch_size // 2)
+                    self._tile_forward_bytes *= 2
+                    if self.verbose: print(f'out of memory, reducing tile batch size to {tile_batch_size}')
+                    continue
+
+                for (c, sl), p in zip(batch_tiles, prediction):
+                    predicted_logits[c][sl] += (p * gaussian if self.use_gaussian else p)
+                    n_predictions[c][sl[1:]] += (gaussian if self.use_gaussian else 1)
+                if self._tta_batch_forwards is not None:
+                    tta_forwards_run += self._tta_batch_forwards[0]
+                    tta_forwards_saved += self._tta_batch_forwards[1]
+                i += len(batch_tiles)
+                pbar.update(len(batch_tiles))
+        self.tta_forwards_run += tta_forwards_run
+        self.tta_forwards_saved += tta_forwards_saved
+
+        for logits, n, outside_roi in zip(predicted_logits, n_predictions, background_outside):
+            if outside_roi:
+                outside = n == 0
+                logits[:, outside] = self._get_background_logits(logits.dtype, results_device)[:, None]
+                n[outside] = 1
+            logits /= n
+            # check for infs
+            if torch.any(torch.isinf(logits)):
+                raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
+                                   'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
+                                   'predicted_logits to fp32')
+        return predicted_logits
 
-            prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
+    def _get_background_logits(self, dtype, device) -> torch.Tensor:
+        # confident background: sigmoid(-10) for all regions, or a softmax of ~1 on the background class
+        logits = torch.full((self.label_manager.num_segmentation_heads,), -10, dtype=dtype, device=device)
+        if not self.label_manager.has_regions:
+            logits[0] = 10
+        return logits
 
-            predicted_logits[sl] += (prediction * gaussian if self.use_gaussian else prediction)
-            n_predictions[sl[1:]] += (gaussian if self.use_gaussian else 1)
+    @staticmethod
+    def _load_roi_prior(model_training_output_dir: str, use_folds) -> Optional[np.ndarray]:
+        """
+        Union of the binary mean masks (global_pca_binary_mask.nii.gz) the PSU-Mamba trainer saved in the fold folders,
+        None if there are none. The masks of the folds are centered in the largest shape of any of them (the shape of a
+        mean mask is the largest training case of its fold), like the cases are in the mean masks.
+        """
+        masks = []
+        for f in use_folds:
+            filename = join(model_training_output_dir, f'fold_{f}', 'global_pca_binary_mask.nii.gz')
+            if not isfile(filename):
+                continue
+            import nibabel as nib
+            masks.append(np.asanyarray(nib.load(filename).dataobj) > 0)
+        if len(masks) == 0:
+            return None
+        shape = tuple(int(i) for i in np.max([m.shape for m in masks], axis=0))
+        prior = np.zeros(shape, dtype=bool)
+        for mask in masks:
+            prior |= pad_centered(mask, shape)
+        return prior
 
-        predicted_logits /= n_predictions
-        # check for infs
-        if torch.any(torch.isinf(predicted_logits)):
-            raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
-                               'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
-                               'predicted_logits to fp32')
-        return predicted_logits
+    def set_roi_prior(self, prior: Optional[np.ndarray]):
+        """
+        Foreground prior for roi_mode 'prior': (x, y, z) binary mask in the space of the preprocessed training cases,
+        which are centered in it (like the mean mask of pca_utils.compute_mean_mask).
+        """
+        self.roi_prior = None if prior is None else np.asarray(prior) > 0
+
+    def _internal_get_prior_roi(self, pad_lbs: List[int], image_shape: Tuple[int, ...]) \
+            -> Optional[Tuple[List[int], List[int]]]:
+        """
+        Bounding box (padded image coordinates) of the prior foreground, aligned to the image like the cases were when
+        the prior was computed: centered. None if the prior has no foreground inside the image.
+        """
+        box = bounding_box(self.roi_prior) if self.roi_prior is not None else None
+        if box is None:
+            return None
+        offsets = [(r - s) // 2 for r, s in zip(self.roi_prior.shape, image_shape)]
+        lower = [max(lb - o - self.roi_margin, 0) for lb, o in zip(box[0], offsets)]
+        upper = [min(ub - o + self.roi_margin, s) for ub, o, s in zip(box[1], offsets, image_shape)]
+        if any(u <= l for l, u in zip(lower, upper)):
+            return None
+        return [int(l + p) for l, p in zip(lower, pad_lbs)], [int(u + p) for u, p in zip(upper, pad_lbs)]
+
+    def _internal_localize_roi(self, data: torch.Tensor) -> Optional[Tuple[List[int], List[int]]]:
+        """
+        Bounding box (padded image coordinates, dilated by roi_margin) of the foreground found by a cheap pass over the
+        whole image: adjacent tiles without overlap, no mirroring. None if it found no foreground.
+        """
+        settings = self.tile_step_size, self.use_mirroring
+        self.tile_step_size, self.use_mirroring = 1, False
+        try:
+            slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+            # the logits only serve to find the box, they do not need to be on the device
+            logits = self._internal_predict_sliding_window_return_logits(data, slicers, False)
+        finally:
+            self.tile_step_size, self.use_mirroring = settings
+        if self.verbose: print(f'localization pass: {len(slicers)} tiles')
+        box = bounding_box(self.label_manager.convert_logits_to_segmentation(logits.float()) > 0)
+        if box is None:
+            return None
+        return [max(lb - self.roi_margin, 0) for lb in box[0]], \
+            [min(ub + self.roi_margin, s) for ub, s in zip(box[1], data.shape[1:])]
+
+    def _get_unwrapped_network(self):
+        network = self.network.module if isinstance(self.network, DistributedDataParallel) else self.network
+        return network._orig_mod if isinstance(network, OptimizedModule) else network
+
+    def _get_fold_networks(self) -> Optional[List[nn.Module]]:
+        """
+        One network per fold, all resident on self.device: self.network holds the first fold, the others are copies.
+        None if there is only one fold, fusion is disabled or the copies would take more than a quarter of the
+        available memory (the rest is needed for activations and the logits buffers).
+        """
+        if not self.fuse_folds or self.list_of_parameters is None or len(self.list_of_parameters) < 2 or \
+                self._fold_fusion_possible is False:
+            return None
+        if self._fold_networks is not None:
+            return self._fold_networks
+
+        network = self._get_unwrapped_network()
+        network_bytes = sum(t.numel() * t.element_size() for t in itertools.chain(network.parameters(),
+                                                                                   network.buffers()))
+        required = network_bytes * (len(self.list_of_parameters) - 1)
+        available = get_available_memory(self.device)
+        if available is None or required > available / 4:
+            print(f'Not enough memory to keep all {len(self.list_of_parameters)} folds on {self.device} '
+                  f'(need {required / 1024 ** 2:.0f} MB), predicting folds one after another')
+            self._fold_fusion_possible = False
+            return None
+
+        self.network = self.network.to(self.device)
+        fold_networks = []
+        for i, params in enumerate(self.list_of_parameters):
+            if i == 0:
+                fold_network = self.network
+                network.load_state_dict(params)
+                if self.list_of_scan_plans is not None:
+                    self._maybe_apply_scan_plan(self.list_of_scan_plans[0])
+            else:
+                fold_network = deepcopy(network)
+                fold_network.load_state_dict(params)
+                if self.list_of_scan_plans is not None and self.list_of_scan_plans[i] is not None:
+                    self.list_of_scan_plans[i].apply(fold_network)
+                elif self.list_of_scan_plans is not None:
+                    # the copy has the scan plan of the first fold
+                    self._reset_scan_plan(fold_network)
+                if isinstance(self.network, OptimizedModule):
+                    fold_network = torch.compile(fold_network)
+            fold_networks.append(fold_network.eval())
+        if self.verbose:
+            print(f'Fused inference of {len(fold_networks)} folds ({required / 1024 ** 2:.0f} MB for the copies)')
+        self._fold_networks = fold_networks
+        return fold_networks
+
+    def _release_fold_networks(self):
+        self._fold_networks = None
+        self._fold_fusion_possible = False
+        empty_cache(self.device)
+
+    def _maybe_apply_scan_plan(self, scan_plan: Optional[ScanPlan]):
+        # folds have their own scan plan (PCA vectors + precomputed scan orders). Only re-apply when it changes, this
+        # resets the scan order caches of the network. Folds without one scan like the network was built
+        if scan_plan is None:
+            if self._applied_scan_plan_hash is not None:
+                self._reset_scan_plan(self._get_unwrapped_network())
+                self._applied_scan_plan_hash = None
+            return
+        if scan_plan.source_hash == self._applied_scan_plan_hash:
+            return
+        scan_plan.apply(self._get_unwrapped_network())
+        self._applied_scan_plan_hash = scan_plan.source_hash
+
+    def _reset_scan_plan(self, network: nn.Module):
+        """
+        Undo ScanPlan.apply: back to the scan type network was built with, no token pruning. The vectors of the plan
+        stay set but are not used by that scan type (the global scan vector comes with the fold's weights)
+        """
+        if self._default_scan_type is not None and hasattr(network, 'set_scan_type'):
+            network.set_scan_type(self._default_scan_type)
+        if hasattr(network, 'set_token_mask'):
+            network.set_token_mask(None)
+
+    def _maybe_set_scan_origins(self, tiles, n_repeats: int = 1):
+        """
+        Networks whose scan depends on the position in the volume (local PCA Mamba) get the position of each tile
+        (case index, slicer) of the batch in its unpadded image. The batch holds the tiles n_repeats times (mirrored
+        variants).
+        """
+        network = self._get_unwrapped_network()
+        if self._sliding_window_geometry is None or not hasattr(network, 'set_scan_origins'):
+            return
+        origins, image_shapes = [], []
+        for c, sl in tiles:
+            pad_lbs, image_shape = self._sliding_window_geometry[c]
+            origins.append([s.start - p for s, p in zip(sl[1:], pad_lbs)])
+            image_shapes.append(image_shape)
+        for network in self._get_unwrapped_prediction_networks():
+            network.set_scan_origins(origins * n_repeats, image_shapes * n_repeats)
+
+    def _get_unwrapped_prediction_networks(self) -> List[nn.Module]:
+        if self._active_fold_networks is None:
+            return [self._get_unwrapped_network()]
+        return [i._orig_mod if isinstance(i, OptimizedModule) else i for i in self._active_fold_networks]
+
+    def _maybe_restrict_slicers_to_roi(self, data: torch.Tensor, slicers):
+        """
+        In roi mode: the slicers tiling only the region of interest of the (padded) image and the region, otherwise
+        (or if no region was found) all slicers and None. Reports the number of skipped tiles.
+        """
+        if self.roi_mode is None:
+            return slicers, None
+        if self.roi_mode == 'prior':
+            roi = self._internal_get_prior_roi(*self._sliding_window_geometry[0])
+        else:
+            roi = self._internal_localize_roi(data)
+        if roi is None:
+            print(f'ROI ({self.roi_mode}): no foreground found, predicting all {len(slicers)} tiles')
+            self.roi_tiles_predicted += len(slicers)
+            return slicers, None
+        roi_slicers = self._internal_get_sliding_window_slicers(data.shape[1:], roi)
+        self.roi_tiles_predicted += len(roi_slicers)
+        self.roi_tiles_skipped += len(slicers) - len(roi_slicers)
+        print(f'ROI ({self.roi_mode}): predicting {len(roi_slicers)} of {len(slicers)} tiles, skipped '
+              f'{len(slicers) - len(roi_slicers)} (region {roi[0]} - {roi[1]} of {list(data.shape[1:])})')
+        return roi_slicers, roi
 
     def predict_sliding_window_return_logits(self, input_image: torch.Tensor) \
             -> Union[np.ndarray, torch.Tensor]:
         assert isinstance(input_image, torch.Tensor)
+        return self.predict_sliding_window_return_logits_of_cases([input_image])[0]
+
+    def predict_sliding_window_return_logits_of_cases(self, list_of_images: List[torch.Tensor]) \
+            -> List[torch.Tensor]:
+        """
+        predict_sliding_window_return_logits for several images (of any shapes) in one sliding window pass: their tiles
+        are stacked into the same forward passes, which keeps the device busy with the small cases that arrive one at
+        a time (see predict_server). Returns the logits of each image
+        """
+        assert all(isinstance(i, torch.Tensor) for i in list_of_images)
         self.network = self.network.to(self.device)
         self.network.eval()
 
@@ -646,48 +1171,66 @@ class nnUNetPredictor(object):
         # So autocast will only be active if we have a cuda device.
         with torch.no_grad():
             with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
-                assert input_image.ndim == 4, 'input_image must be a 4D np.ndarray or torch.Tensor (c, x, y, z)'
-
-                if self.verbose: print(f'Input shape: {input_image.shape}')
                 if self.verbose: print("step_size:", self.tile_step_size)
                 if self.verbose: print("mirror_axes:", self.allowed_mirroring_axes if self.use_mirroring else None)
 
-                # if input_image is smaller than tile_size we need to pad it to tile_size.
-                data, slicer_revert_padding = pad_nd_image(input_image, self.configuration_manager.patch_size,
-                                                           'constant', {'value': 0}, True,
-                                                           None)
-
-                slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+                list_of_data, list_of_slicers, reverts, geometries, outside = [], [], [], [], []
+                for input_image in list_of_images:
+                    assert input_image.ndim == 4, 'input_image must be a 4D np.ndarray or torch.Tensor (c, x, y, z)'
+                    if self.verbose: print(f'Input shape: {input_image.shape}')
+
+                    # if input_image is smaller than tile_size we need to pad it to tile_size.
+                    data, slicer_revert_padding = pad_nd_image(input_image, self.configuration_manager.patch_size,
+                                                               'constant', {'value': 0}, True,
+                                                               None)
+
+                    slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+                    geometries.append(([i.start for i in slicer_revert_padding[1:]], input_image.shape[1:]))
+                    # the roi of each image is found on its own (localization pass)
+                    self._sliding_window_geometry = geometries[-1:]
+                    slicers, roi = self._maybe_restrict_slicers_to_roi(data, slicers)
+                    list_of_data.append(data)
+                    list_of_slicers.append(slicers)
+                    reverts.append(slicer_revert_padding)
+                    outside.append(roi is not None)
+                self._sliding_window_geometry = geometries
+                tta_counters = self.tta_forwards_run, self.tta_forwards_saved
 
                 if self.perform_everything_on_device and self.device != 'cpu':
                     # we need to try except here because we can run OOM in which case we need to fall back to CPU as a results device
                     try:
-                        predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, self.perform_everything_on_device)
+                        predicted_logits = self._internal_predict_sliding_window_return_logits_of_cases(list_of_data, list_of_slicers, self.perform_everything_on_device, outside)
                     except RuntimeError:
                         print('Prediction on device was unsuccessful, probably due to a lack of memory. Moving results arrays to CPU')
                         empty_cache(self.device)
-                        predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False)
+                        predicted_logits = self._internal_predict_sliding_window_return_logits_of_cases(list_of_data, list_of_slicers, False, outside)
                 else:
-                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, self.perform_everything_on_device)
+                    predicted_logits = self._internal_predict_sliding_window_return_logits_of_cases(list_of_data, list_of_slicers, self.perform_everything_on_device, outside)
 
                 empty_cache(self.device)
+                if self.adaptive_tta and self.tta_forwards_run > tta_counters[0]:
+                    run, saved = self.tta_forwards_run - tta_counters[0], self.tta_forwards_saved - tta_counters[1]
+                    print(f'adaptive TTA: {run} tile forward passes, {saved} saved ({100 * saved / (run + saved):.0f} %)')
+                self._sliding_window_geometry = None
+                for network in self._get_unwrapped_prediction_networks():
+                    if hasattr(network, 'clear_scan_origins'):
+                        network.clear_scan_origins()
                 # revert padding
-                predicted_logits = predicted_logits[tuple([slice(None), *slicer_revert_padding[1:]])]
+                predicted_logits = [logits[tuple([slice(None), *slicer_revert_padding[1:]])]
+                                    for logits, slicer_revert_padding in zip(predicted_logits, reverts)]
         return predicted_logits
 
 
 class PCAAwarePredictor(nnUNetPredictor):
     def initialize_from_trained_model_folder(self, model_training_output_dir: str, use_folds: tuple, checkpoint_name: str = 'checkpoint_final.pth'):
         super().initialize_from_trained_model_folder(model_training_output_dir, use_folds, checkpoint_name)
+        if self.list_of_scan_plans is not None:
+            print("[PCA] Using the scan plan stored in the checkpoint.")
+            return
 
         def find_mamba_layer(module):
             for child in module.children():
-                if isinstance(child, MambaLayer) or isinstance(
-                    child, MambaLayer3d) or isinstance(
-                        child, MambaLayer32) or isinstance(
-                            child, MambaLayer_patch16) or isinstance(
-                                child, MambaLayer_PCA) or isinstance(
-                                    child, MambaLayer_z) or isinstance(child, MambaLayer_global):
+                if isinstance(child, MambaLayer):
                     return child
                 result = find_mamba_layer(child)
                 if result is not None:
@@ -784,6 +1327,21 @@ def predict_entry_point_modelfolder():
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
     parser.add_argument('--use_pca', action='store_true', help='Inject PCA vectors into Mamba layers if found')
+    parser.add_argument('-roi_mode', type=str, required=False, default=None, choices=('prior', 'localize'),
+                        help='Only predict the tiles around the foreground, everything else is background. prior: '
+                             'the training prior of PSU-Mamba models (global_pca_binary_mask.nii.gz), localize: a '
+                             'cheap first pass without tile overlap and mirroring. Reports the skipped tiles')
+    parser.add_argument('-roi_margin', type=int, required=False, default=16,
+                        help='Voxels the bounding box of the roi is dilated by. Default: 16')
+    parser.add_argument('--adaptive_tta', action='store_true', required=False, default=False,
+                        help='Only run the mirrored variants of tiles that have a voxel whose predicted class is '
+                             'uncertain (probability below -tta_confidence). Reports the forward passes saved')
+    parser.add_argument('-tta_confidence', type=float, required=False, default=0.99,
+                        help='Probability below which a voxel counts as uncertain for --adaptive_tta. Default: 0.99')
+    parser.add_argument('--export_on_device', action='store_true', required=False, default=False,
+                        help='Resample, argmax and revert cropping on the GPU so that only the segmentation is sent to '
+                             'the export workers (instead of the full logits). Resampling is linear, results can '
+                             'differ from the default export in a few boundary voxels. cuda only')
 
 
     print(
@@ -816,12 +1374,17 @@ def predict_entry_point_modelfolder():
 
     if args.use_pca:
         predictor = PCAAwarePredictor(tile_step_size=args.step_size,
-                                    use_gaussian=True,
-                                    use_mirroring=not args.disable_tta,
-                                    perform_everything_on_device=True,
-                                    device=device,
-                                    verbose=args.verbose,
-                                    allow_tqdm=not args.disable_progress_bar)
+                                      use_gaussian=True,
+                                      use_mirroring=not args.disable_tta,
+                                      perform_everything_on_device=True,
+                                      device=device,
+                                      verbose=args.verbose,
+                                      allow_tqdm=not args.disable_progress_bar,
+                                      roi_mode=args.roi_mode,
+                                      roi_margin=args.roi_margin,
+                                      adaptive_tta=args.adaptive_tta,
+                                      tta_confidence=args.tta_confidence,
+                                      export_on_device=args.export_on_device)
     else:
         predictor = nnUNetPredictor(tile_step_size=args.step_size,
                                     use_gaussian=True,
@@ -829,7 +1392,12 @@ def predict_entry_point_modelfolder():
                                     perform_everything_on_device=True,
                                     device=device,
                                     verbose=args.verbose,
-                                    allow_tqdm=not args.disable_progress_bar)
+                                    allow_tqdm=not args.disable_progress_bar,
+                                    roi_mode=args.roi_mode,
+                                    roi_margin=args.roi_margin,
+                                    adaptive_tta=args.adaptive_tta,
+                                    tta_confidence=args.tta_confidence,
+                                    export_on_device=args.export_on_device)
     predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
@@ -903,6 +1471,21 @@ def predict_entry_point():
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
     parser.add_argument('--use_pca', action='store_true', help='Inject PCA vectors into Mamba layers if found')
+    parser.add_argument('-roi_mode', type=str, required=False, default=None, choices=('prior', 'localize'),
+                        help='Only predict the tiles around the foreground, everything else is background. prior: '
+                             'the training prior of PSU-Mamba models (global_pca_binary_mask.nii.gz), localize: a '
+                             'cheap first pass without tile overlap and mirroring. Reports the skipped tiles')
+    parser.add_argument('-roi_margin', type=int, required=False, default=16,
+                        help='Voxels the bounding box of the roi is dilated by. Default: 16')
+    parser.add_argument('--adaptive_tta', action='store_true', required=False, default=False,
+                        help='Only run the mirrored variants of tiles that have a voxel whose predicted class is '
+                             'uncertain (probability below -tta_confidence). Reports the forward passes saved')
+    parser.add_argument('-tta_confidence', type=float, required=False, default=0.99,
+                        help='Probability below which a voxel counts as uncertain for --adaptive_tta. Default: 0.99')
+    parser.add_argument('--export_on_device', action='store_true', required=False, default=False,
+                        help='Resample, argmax and revert cropping on the GPU so that only the segmentation is sent to '
+                             'the export workers (instead of the full logits). Resampling is linear, results can '
+                             'differ from the default export in a few boundary voxels. cuda only')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -944,7 +1527,12 @@ def predict_entry_point():
                                       perform_everything_on_device=True,
                                       device=device,
                                       verbose=args.verbose,
-                                      allow_tqdm=not args.disable_progress_bar)
+                                      allow_tqdm=not args.disable_progress_bar,
+                                      roi_mode=args.roi_mode,
+                                      roi_margin=args.roi_margin,
+                                      adaptive_tta=args.adaptive_tta,
+                                      tta_confidence=args.tta_confidence,
+                                      export_on_device=args.export_on_device)
     else:
         predictor = nnUNetPredictor(tile_step_size=args.step_size,
                                     use_gaussian=True,
@@ -953,7 +1541,12 @@ def predict_entry_point():
                                     device=device,
                                     verbose=args.verbose,
                                     verbose_preprocessing=False,
-                                    allow_tqdm=not args.disable_progress_bar)
+                                    allow_tqdm=not args.disable_progress_bar,
+                                    roi_mode=args.roi_mode,
+                                    roi_margin=args.roi_margin,
+                                    adaptive_tta=args.adaptive_tta,
+                                    tta_confidence=args.tta_confidence,
+                                    export_on_device=args.export_on_device)
     predictor.initialize_from_trained_model_folder(
         model_folder,
         args.f,
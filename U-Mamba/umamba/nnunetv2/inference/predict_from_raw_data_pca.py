@@ -4,12 +4,8 @@ import torch
 import os
 import numpy as np
 
-# Import your MambaLayer
-from nnunetv2.nets.UMambaFirst import MambaLayer
-from nnunetv2.nets.UMambaFirst_3d import MambaLayer as MambaLayer3d
-from nnunetv2.nets.UMambaFirst_32 import MambaLayer as MambaLayer32
-from nnunetv2.nets.UMambaFirst_patch16 import MambaLayer as MambaLayer_patch16
-from nnunetv2.nets.UMambaFirst_PCA import MambaLayer as MambaLayer_PCA
+# base class of the Mamba layers of all UMambaFirst networks
+from nnunetv2.nets.mamba_layer import MambaLayer
 
 from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
@@ -31,7 +27,7 @@ class PCAAwarePredictor(nnUNetPredictor):
 
         def find_mamba_layer(module):
             for child in module.children():
-                if isinstance(child, MambaLayer) or isinstance(child, MambaLayer3d) or isinstance(child, MambaLayer32) or isinstance(child, MambaLayer_patch16) or isinstance(child, MambaLayer_PCA):
+                if isinstance(child, MambaLayer):
                     return child
                 result = find_mamba_layer(child)
                 if result is not None:
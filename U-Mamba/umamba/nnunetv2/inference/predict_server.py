@@ -0,0 +1,423 @@
+import http.client
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+from typing import List, Tuple, Union
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape, \
+    export_segmentation
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+
+
+class ServerBusyError(RuntimeError):
+    pass
+
+
+class nnUNetPredictionServer(object):
+    """
+    Keeps one initialized nnUNetPredictor (network, fold weights, scan plans, Gaussian importance map, fused fold
+    networks, compiled network) resident and predicts cases as they arrive, see serve_forever for the HTTP / unix
+    socket interface. predict can also be called directly from other threads of the same process.
+
+    Every request is preprocessed and exported (resampling, argmax, writing) in the thread that made it, so these
+    overlap between requests. Only the device work is serialized: one device thread collects the requests waiting
+    for the device into batches of up to max_batch_size (waiting at most batch_timeout seconds for a batch to fill
+    up) and predicts each batch in one sliding window pass. All sliding window tiles have the patch size, so the
+    tiles of the cases of a batch are stacked into the same forward passes and scattered back into the logits of
+    their case (see nnUNetPredictor.predict_logits_from_list_of_preprocessed_data). Small cases that would each
+    leave most of a forward pass empty fill it up together.
+
+    max_concurrent_requests: requests in flight (preprocessing, waiting, predicting or exporting). More are rejected
+    with ServerBusyError (HTTP 503), they are not queued up without bound.
+
+    Cascaded models (segmentation of a previous stage as input) are not supported.
+    """
+    def __init__(self, predictor: nnUNetPredictor, max_batch_size: int = 4, batch_timeout: float = 0.05,
+                 max_concurrent_requests: int = 4, verbose: bool = False):
+        assert predictor.network is not None, 'predictor must be initialized (initialize_from_trained_model_folder)'
+        if predictor.configuration_manager.previous_stage_name is not None:
+            raise NotImplementedError('the prediction server does not support cascaded models')
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.max_concurrent_requests = max_concurrent_requests
+        self.verbose = verbose
+
+        self.preprocessor = predictor.configuration_manager.preprocessor_class(verbose=False)
+        self._request_slots = threading.BoundedSemaphore(max_concurrent_requests)
+        self._device_queue = queue.Queue()
+        self._device_thread = None
+        self._stop_event = threading.Event()
+        # statistics, see status
+        self._lock = threading.Lock()
+        self.requests_served = 0
+        self.requests_rejected = 0
+        self.requests_failed = 0
+        self.batches_predicted = 0
+        self.start_time = None
+
+    def start(self, warmup: bool = True):
+        """
+        starts the device thread. warmup: predict an empty patch first so that lazy initialization (torch.compile,
+        cudnn autotuning, fused fold networks, tile batch size, Gaussian) does not slow down the first request
+        """
+        if warmup:
+            self.warmup()
+        self._stop_event.clear()
+        self._device_thread = threading.Thread(target=self._device_loop, name='nnUNetPredictionServer-device',
+                                               daemon=True)
+        self._device_thread.start()
+        self.start_time = time()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._device_thread is not None:
+            self._device_thread.join()
+            self._device_thread = None
+
+    def warmup(self):
+        patch_size = self.predictor.configuration_manager.patch_size
+        num_input_channels = determine_num_input_channels(self.predictor.plans_manager,
+                                                          self.predictor.configuration_manager,
+                                                          self.predictor.dataset_json)
+        shape = (num_input_channels, *([1] if len(patch_size) == 2 else []), *patch_size)
+        start = time()
+        self.predictor.predict_logits_from_preprocessed_data(torch.zeros(shape))
+        print(f'prediction server warmup done ({time() - start:.1f} s)')
+
+    def _device_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                batch = [self._device_queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            deadline = time() + self.batch_timeout
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._device_queue.get(timeout=max(0., deadline - time())))
+                except queue.Empty:
+                    break
+            batch = [(data, future) for data, future in batch if future.set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            if self.verbose:
+                print(f'predicting a batch of {len(batch)} case(s) of shapes {[tuple(i[0].shape) for i in batch]}, '
+                      f'{self._device_queue.qsize()} waiting')
+            try:
+                predictions = self.predictor.predict_logits_from_list_of_preprocessed_data([i[0] for i in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # find the case that failed, the others still get their prediction
+                print(f'prediction of a batch of {len(batch)} cases failed ({e!r}), predicting them one by one')
+                predictions = []
+                for data, future in batch:
+                    try:
+                        predictions.append(self.predictor.predict_logits_from_preprocessed_data(data))
+                    except Exception as e:
+                        predictions.append(e)
+            for (_, future), prediction in zip(batch, predictions):
+                if isinstance(prediction, Exception):
+                    future.set_exception(prediction)
+                else:
+                    future.set_result(prediction)
+            with self._lock:
+                self.batches_predicted += 1
+
+    def predict(self, files_or_image: Union[List[str], np.ndarray], properties: dict = None,
+                output_file_truncated: str = None, save_probabilities: bool = False) \
+            -> Union[None, np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        """
+        files_or_image: list of the image files of one case (one per channel, like nnUNetv2_predict) or an image as
+        array (c, x, y(, z)) with properties {'spacing': ...} (like predict_single_npy_array).
+        Returns the segmentation in the original image geometry (and the probabilities if save_probabilities) or
+        writes them to output_file_truncated (only for files, arrays have no geometry to write them with) and returns
+        None. Blocks until done, raises ServerBusyError if max_concurrent_requests requests are already in flight
+        """
+        if self._device_thread is None:
+            raise RuntimeError('the server is not running, call start first')
+        if not self._request_slots.acquire(blocking=False):
+            with self._lock:
+                self.requests_rejected += 1
+            raise ServerBusyError(f'{self.max_concurrent_requests} requests are already being processed')
+        try:
+            if isinstance(files_or_image, np.ndarray):
+                assert output_file_truncated is None, 'predictions of arrays can only be returned, not written'
+                assert properties is not None and 'spacing' in properties, 'arrays need properties with a spacing'
+                properties = dict(properties)
+                data, _ = self.preprocessor.run_case_npy(files_or_image, None, properties,
+                                                         self.predictor.plans_manager,
+                                                         self.predictor.configuration_manager,
+                                                         self.predictor.dataset_json)
+            else:
+                data, _, properties = self.preprocessor.run_case(files_or_image, None, self.predictor.plans_manager,
+                                                                 self.predictor.configuration_manager,
+                                                                 self.predictor.dataset_json)
+            future = Future()
+            self._device_queue.put((torch.from_numpy(data).contiguous().float(), future))
+            del data
+            ret = convert_predicted_logits_to_segmentation_with_correct_shape(
+                future.result(), self.predictor.plans_manager, self.predictor.configuration_manager,
+                self.predictor.label_manager, properties, return_probabilities=save_probabilities)
+            if output_file_truncated is not None:
+                segmentation, probabilities = ret if save_probabilities else (ret, None)
+                export_segmentation(segmentation, properties, self.predictor.plans_manager,
+                                    self.predictor.dataset_json, output_file_truncated, probabilities)
+                ret = None
+            with self._lock:
+                self.requests_served += 1
+            return ret
+        except Exception:
+            with self._lock:
+                self.requests_failed += 1
+            raise
+        finally:
+            self._request_slots.release()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'trainer': self.predictor.trainer_name,
+                'num_folds': len(self.predictor.list_of_parameters),
+                'device': str(self.predictor.device),
+                'uptime': time() - self.start_time if self.start_time is not None else 0,
+                'requests_served': self.requests_served,
+                'requests_rejected': self.requests_rejected,
+                'requests_failed': self.requests_failed,
+                'requests_waiting_for_device': self._device_queue.qsize(),
+                'batches_predicted': self.batches_predicted,
+                'max_batch_size': self.max_batch_size,
+                'max_concurrent_requests': self.max_concurrent_requests,
+            }
+
+    def serve_forever(self, host: str = '127.0.0.1', port: int = 8765, socket_path: str = None):
+        """
+        HTTP interface, on host:port or (if socket_path is given) on a unix socket:
+        GET /status: json with the statistics of status
+        POST /predict: json {"files": [...], "output_file": optional, "save_probabilities": optional}. Returns json
+            {"output_file": ...} if output_file is given (the segmentation is written to output_file + file ending,
+            the probabilities to output_file + .npz if save_probabilities), otherwise the segmentation as .npy file
+            (np.load(io.BytesIO(response))). save_probabilities needs output_file
+        POST /predict_array: .npz file (np.savez) with 'image' (c, x, y(, z)) and 'spacing'. Returns the segmentation
+            as .npy file
+        Errors are answered with a json {"error": ...}, status 503 if the server is busy. See request_prediction for
+        a client
+        """
+        handler = _make_request_handler(self)
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            httpd = _ThreadingUnixHTTPServer(socket_path, handler)
+            print(f'nnU-Net prediction server listening on unix socket {socket_path}')
+        else:
+            httpd = ThreadingHTTPServer((host, port), handler)
+            print(f'nnU-Net prediction server listening on http://{host}:{port}')
+        if self._device_thread is None:
+            self.start()
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            self.stop()
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+            compute_gaussian.cache_clear()
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# segmentations are sent back in pieces of this size
+_STREAM_CHUNK_SIZE = 1 << 20
+
+
+def _make_request_handler(server: nnUNetPredictionServer):
+    class _RequestHandler(BaseHTTPRequestHandler):
+        def address_string(self):
+            # unix sockets have no client address
+            return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+        def log_message(self, format, *args):
+            if server.verbose:
+                super().log_message(format, *args)
+
+        def _send_json(self, obj: dict, status: int = 200):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_array(self, array: np.ndarray, seconds: float):
+            buffer = io.BytesIO()
+            np.save(buffer, array)
+            body = buffer.getbuffer()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Prediction-Seconds', f'{seconds:.3f}')
+            self.end_headers()
+            for i in range(0, len(body), _STREAM_CHUNK_SIZE):
+                self.wfile.write(body[i:i + _STREAM_CHUNK_SIZE])
+
+        def _read_body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def do_GET(self):
+            if self.path == '/status':
+                self._send_json(server.status())
+            else:
+                self._send_json({'error': f'unknown path {self.path}'}, 404)
+
+        def do_POST(self):
+            start = time()
+            try:
+                if self.path == '/predict':
+                    request = json.loads(self._read_body())
+                    output_file = request.get('output_file')
+                    save_probabilities = request.get('save_probabilities', False)
+                    if save_probabilities and output_file is None:
+                        raise ValueError('save_probabilities needs output_file, probabilities are only written')
+                    ret = server.predict(request['files'], None, output_file, save_probabilities)
+                    if output_file is not None:
+                        self._send_json({'output_file': output_file + server.predictor.dataset_json['file_ending'],
+                                         'seconds': time() - start})
+                    else:
+                        self._send_array(ret, time() - start)
+                elif self.path == '/predict_array':
+                    request = np.load(io.BytesIO(self._read_body()))
+                    segmentation = server.predict(request['image'], {'spacing': request['spacing'].tolist()})
+                    self._send_array(segmentation, time() - start)
+                else:
+                    self._send_json({'error': f'unknown path {self.path}'}, 404)
+            except ServerBusyError as e:
+                self._send_json({'error': str(e)}, 503)
+            except (KeyError, ValueError, AssertionError) as e:
+                self._send_json({'error': f'bad request: {e!r}'}, 400)
+            except Exception as e:
+                self._send_json({'error': repr(e)}, 500)
+
+    return _RequestHandler
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request_prediction(files_or_image: Union[List[str], np.ndarray], spacing=None, output_file_truncated: str = None,
+                       host: str = '127.0.0.1', port: int = 8765, socket_path: str = None,
+                       timeout: float = None) -> Union[np.ndarray, str]:
+    """
+    client for nnUNetPredictionServer.serve_forever. Returns the segmentation, or the name of the written file if
+    output_file_truncated is given. Raises RuntimeError with the error message of the server
+    """
+    connection = _UnixHTTPConnection(socket_path, timeout) if socket_path is not None else \
+        http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        if isinstance(files_or_image, np.ndarray):
+            buffer = io.BytesIO()
+            np.savez(buffer, image=files_or_image, spacing=np.asarray(spacing, dtype=np.float64))
+            connection.request('POST', '/predict_array', buffer.getvalue(),
+                               {'Content-Type': 'application/octet-stream'})
+        else:
+            connection.request('POST', '/predict', json.dumps({'files': list(files_or_image),
+                                                               'output_file': output_file_truncated}),
+                               {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError(f'prediction server answered {response.status}: {json.loads(body)["error"]}')
+        if response.getheader('Content-Type') == 'application/json':
+            return json.loads(body)['output_file']
+        return np.load(io.BytesIO(body))
+    finally:
+        connection.close()
+
+
+def predict_server_entry_point():
+    import argparse
+    parser = argparse.ArgumentParser(description='Keeps a trained nnU-Net model loaded and predicts cases sent to it '
+                                                 'over HTTP on localhost (or a unix socket), see '
+                                                 'nnUNetPredictionServer.serve_forever for the requests. Use this '
+                                                 'when cases arrive one at a time')
+    parser.add_argument('-m', type=str, required=True,
+                        help='Folder in which the trained model is. Must have subfolders fold_X for the different '
+                             'folds you trained')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Specify the folds of the trained model that should be used for prediction. '
+                             'Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. Default: 0.5')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to disable test time data augmentation in the form of mirroring')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="'cuda', 'cpu' or 'mps'. Use CUDA_VISIBLE_DEVICES=X to select the GPU")
+    parser.add_argument('-roi_mode', type=str, required=False, default=None, choices=('prior', 'localize'),
+                        help='Only predict the tiles around the foreground, see nnUNetv2_predict')
+    parser.add_argument('--adaptive_tta', action='store_true', required=False, default=False,
+                        help='Only mirror uncertain tiles, see nnUNetv2_predict')
+    parser.add_argument('-host', type=str, required=False, default='127.0.0.1',
+                        help='Address to listen on. Default: 127.0.0.1 (only this machine)')
+    parser.add_argument('-port', type=int, required=False, default=8765, help='Default: 8765')
+    parser.add_argument('-socket', type=str, required=False, default=None,
+                        help='Listen on this unix socket instead of -host/-port')
+    parser.add_argument('-max_batch_size', type=int, required=False, default=4,
+                        help='Maximum number of queued cases predicted together, their tiles share the forward passes. '
+                             'Default: 4')
+    parser.add_argument('-batch_timeout', type=float, required=False, default=0.05,
+                        help='Seconds to wait for a batch to fill up. Default: 0.05')
+    parser.add_argument('-max_concurrent', type=int, required=False, default=4,
+                        help='Maximum number of requests in flight, more are answered with 503. Default: 4')
+    parser.add_argument('--no_warmup', action='store_true', required=False, default=False,
+                        help='Do not predict an empty patch on startup')
+    parser.add_argument('--verbose', action='store_true', help='Log every request and batch')
+    args = parser.parse_args()
+    args.f = [i if i == 'all' else int(i) for i in args.f]
+
+    assert args.device in ['cpu', 'cuda', 'mps'], f'-device must be either cpu, mps or cuda. Got: {args.device}.'
+    if args.device == 'cpu':
+        import multiprocessing
+        torch.set_num_threads(multiprocessing.cpu_count())
+        device = torch.device('cpu')
+    elif args.device == 'cuda':
+        # preprocessing and export run in the request threads, they need a few threads too
+        torch.set_num_threads(max(1, args.max_concurrent))
+        device = torch.device('cuda')
+    else:
+        device = torch.device('mps')
+
+    predictor = nnUNetPredictor(tile_step_size=args.step_size, use_gaussian=True, use_mirroring=not args.disable_tta,
+                                perform_everything_on_device=True, device=device, verbose=False, allow_tqdm=False,
+                                roi_mode=args.roi_mode, adaptive_tta=args.adaptive_tta)
+    predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
+    server = nnUNetPredictionServer(predictor, max_batch_size=args.max_batch_size, batch_timeout=args.batch_timeout,
+                                    max_concurrent_requests=args.max_concurrent, verbose=args.verbose)
+    server.start(warmup=not args.no_warmup)
+    server.serve_forever(args.host, args.port, args.socket)
@@ -56,6 +56,34 @@ def compute_steps_for_sliding_window(image_size: Tuple[int, ...], tile_size: Tup
     return steps
 
 
+def bounding_box(mask: Union[np.ndarray, torch.Tensor]) -> Union[Tuple[List[int], List[int]], None]:
+    """
+    (lower, upper) bounds of the nonzero voxels of mask, upper exclusive. None if there are none.
+    """
+    nonzero = torch.nonzero(torch.as_tensor(mask))
+    if len(nonzero) == 0:
+        return None
+    return nonzero.min(0)[0].tolist(), (nonzero.max(0)[0] + 1).tolist()
+
+
+def fit_box_to_tiles(lower: List[int], upper: List[int], image_size: Tuple[int, ...], tile_size: Tuple[int, ...]) \
+        -> Tuple[List[int], List[int]]:
+    """
+    Box clipped to the image and grown (around its center) to at least tile_size along every axis, shifted to lie
+    inside the image so that it can be tiled by the sliding window. The image must be at least as large as tile_size.
+    """
+    new_lower, new_upper = [], []
+    for lb, ub, s, t in zip(lower, upper, image_size, tile_size):
+        lb, ub = max(int(lb), 0), min(int(ub), s)
+        if ub - lb < t:
+            lb = (lb + ub - t) // 2
+            ub = lb + t
+        shift = max(0, -lb) - max(0, ub - s)
+        new_lower.append(lb + shift)
+        new_upper.append(ub + shift)
+    return new_lower, new_upper
+
+
 if __name__ == '__main__':
     a = torch.rand((4, 2, 32, 23))
     a_npy = a.numpy()
@@ -12,7 +12,7 @@ from dynamic_network_architectures.building_blocks.helper import convert_conv_op
 from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager, PlansManager
 from dynamic_network_architectures.building_blocks.helper import get_matching_instancenorm, convert_dim_to_conv_op
 from nnunetv2.utilities.network_initialization import InitWeights_He
-from mamba_ssm import Mamba
+from nnunetv2.nets.mamba_backends import Mamba
 from dynamic_network_architectures.building_blocks.helper import maybe_convert_scalar_to_list, get_matching_pool_op
 from torch.cuda.amp import autocast
 from dynamic_network_architectures.building_blocks.residual import BasicBlockD
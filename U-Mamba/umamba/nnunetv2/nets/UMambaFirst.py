@@ -15,93 +15,14 @@ from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager
 from dynamic_network_architectures.building_blocks.helper import get_matching_instancenorm, convert_dim_to_conv_op
 from dynamic_network_architectures.initialization.weight_init import init_last_bn_before_add_to_0
 from nnunetv2.utilities.network_initialization import InitWeights_He
-from mamba_ssm import Mamba
+from nnunetv2.nets import mamba_layer
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
 from dynamic_network_architectures.building_blocks.helper import maybe_convert_scalar_to_list, get_matching_pool_op
 from torch.cuda.amp import autocast
 from dynamic_network_architectures.building_blocks.residual import BasicBlockD
 
-def flatten_for_scan(x, scan_type='yz-diag'):
-    B, C, D, H, W = x.shape
-    if scan_type == 'x':
-        print("Flattening for x scan")
-        x_perm = x.permute(0, 1, 4, 3, 2)
-        flatten = x_perm.reshape(B, C, -1).transpose(-1, -2)
-        unpermute = lambda t: t.reshape(B, C, W, H, D).permute(0, 1, 4, 3, 2)
-        return flatten, unpermute
-    
-    elif scan_type == 'y':
-        print("Flattening for y scan")
-        x_perm = x.permute(0, 1, 3, 4, 2)
-        flatten = x_perm.reshape(B, C, -1).transpose(-1, -2)
-        unpermute = lambda t: t.reshape(B, C, H, W, D).permute(0, 1, 4, 2, 3)
-        return flatten, unpermute
-    
-    elif scan_type == 'z':
-        #print("Flattening for z scan")
-        flatten = x.reshape(B, C, -1).transpose(-1, -2)
-        unpermute = lambda t: t.transpose(-1, -2).reshape(B, C, D, H, W)
-        return flatten, unpermute
-    
-    elif scan_type == 'yz-diag':
-        #print("Flattening for yz-diag scan")
-        x_perm = x.permute(0, 1, 4, 3, 2)
-        X, Y, Z = x_perm.shape[2:]
-        z_coords, y_coords = torch.meshgrid(
-            torch.arange(Z, device=x.device),
-            torch.arange(Y, device=x.device),
-            indexing='ij'
-        )
-        diag_order = torch.argsort((z_coords + y_coords).flatten())
-        x_flat = x_perm.reshape(B, C, X, Y * Z)[:, :, :, diag_order]
-        flatten = x_flat.reshape(B, C, -1).transpose(-1, -2)
-        unpermute = lambda t: t.reshape(B, C, X, Y, Z).permute(0, 1, 4, 3, 2)
-        return flatten, unpermute
-    
-    elif scan_type == 'xy-diag':
-        x_perm = x.permute(0, 1, 2, 4, 3)
-        D, X, Y = x_perm.shape[2:]
-        x_coords, y_coords = torch.meshgrid(
-            torch.arange(X, device=x.device),
-            torch.arange(Y, device=x.device),
-            indexing='ij'
-        )
-        diag_order = torch.argsort((x_coords + y_coords).flatten())
-        x_flat = x_perm.reshape(B, C, D, X * Y)[:, :, :, diag_order]
-        flatten = x_flat.reshape(B, C, -1).transpose(-1, -2)
-        unpermute = lambda t: t.reshape(B, C, D, X, Y).permute(0, 1, 2, 4, 3)
-        return flatten, unpermute
-    else:
-        raise ValueError(f"Unsupported scan type: {scan_type}")
-
-def flatten_pca_scan(x, principal_vector):
-    print("Flattening for PCA scan")
-    B, C, D, H, W = x.shape
-    device = x.device
-    zz, yy, xx = torch.meshgrid(
-        torch.arange(D, device=device),
-        torch.arange(H, device=device),
-        torch.arange(W, device=device),
-        indexing='ij'
-    )
-    coords = torch.stack([zz, yy, xx], dim=-1).reshape(-1, 3).float()
-    if isinstance(principal_vector, np.ndarray):
-        principal_vector = torch.from_numpy(principal_vector).to(device, dtype=torch.float32)
-    else:
-        principal_vector = principal_vector.to(device, dtype=torch.float32)
-    projections = torch.matmul(coords, principal_vector)
-    sorted_indices = torch.argsort(projections)
-    x_flat_list = []
-    for b in range(B):
-        x_b = x[b].reshape(C, -1)[:, sorted_indices].T
-        x_flat_list.append(x_b)
-    x_flat = torch.stack(x_flat_list, dim=0)
-    def unpermute(t):
-        out = torch.zeros((B, D * H * W, C), device=t.device, dtype=t.dtype)
-        for b in range(B):
-            out[b, sorted_indices] = t[b]
-        return out.permute(0, 2, 1).reshape(B, C, D, H, W)
-    return x_flat, unpermute
-
+# per-step messages are DEBUG, see nnunetv2/utilities/mamba_logging.py
+logger = get_mamba_logger('UMambaFirst', interval=10)
 
 class UpsampleLayer(nn.Module):
     def __init__(
@@ -122,56 +43,13 @@ class UpsampleLayer(nn.Module):
         x = self.conv(x)
         return x
 
-class MambaLayer(nn.Module):
-    def __init__(self, dim, d_state=16, d_conv=4, expand=2, scan_type='yz-diag'): #
-        super().__init__()
-        self.dim = dim
-        self.norm = nn.LayerNorm(dim)
-        self.mamba = Mamba(
-            d_model=dim,
-            d_state=d_state,
-            d_conv=d_conv,
-            expand=expand,
-        )
-        self.scan_type = scan_type
-        self.register_buffer('principal_vector', torch.zeros(3), persistent=True)
-    
-    def set_scan_vector(self, vector):
-        print("Setting principal_vector to:", vector)
-        if isinstance(vector, np.ndarray):
-            vector = torch.from_numpy(vector)
-        self.principal_vector.copy_(vector.to(self.principal_vector.device, dtype=self.principal_vector.dtype))
-        print("[DEBUG] Set principal_vector to:", self.principal_vector)
-        
-        
+class MambaLayer(mamba_layer.MambaLayer):
+    def __init__(self, dim, d_state=16, d_conv=4, expand=2, scan_type='yz-diag'):
+        super().__init__(dim, d_state, d_conv, expand, scan_type)
+
     @autocast(enabled=False)
     def forward(self, x):
-        if x.dtype == torch.float16 or x.dtype == torch.bfloat16:
-            x = x.type(torch.float32)
-        B, C = x.shape[:2]
-        img_dims = x.shape[2:]
-        
-        if self.scan_type == 'pca':
-            print("[MambaLayer] Using PCA scan type.")
-            if not torch.any(self.principal_vector):
-                print("[MambaLayer] PCA vector not set. Falling back to 'x' scan.")
-                x_flat, unpermute = flatten_for_scan(x, 'x')
-                x_norm = self.norm(x_flat)
-                x_mamba = self.mamba(x_norm)
-                out = x_mamba.transpose(-1, -2).reshape(B, C, *img_dims)
-                return unpermute(out)
-            print("right before flatten_pca_scan")
-
-            x_flat, unpermute = flatten_pca_scan(x, self.principal_vector)
-            x_norm = self.norm(x_flat)
-            x_mamba = self.mamba(x_norm)
-            return unpermute(x_mamba)
-        else:
-            x_flat, unpermute = flatten_for_scan(x, self.scan_type)
-            x_norm = self.norm(x_flat)
-            x_mamba = self.mamba(x_norm)
-            out = x_mamba.transpose(-1, -2).reshape(B, C, *img_dims)
-            return unpermute(out)
+        return super().forward(x)
 
 class BasicResBlock(nn.Module):
     def __init__(
@@ -256,19 +134,19 @@ class ResidualMambaEncoder(nn.Module):
         feature_map_sizes = []
         #feature_map_size = input_size[::-1] # ! CHANGE 
         feature_map_size = input_size 
-        print("feature_map_size Input size", feature_map_size)
+        logger.debug("feature_map_size Input size", feature_map_size)
         
         for s in range(n_stages):
             feature_map_sizes.append([i // j for i, j in zip(feature_map_size, strides[s])])
             feature_map_size = feature_map_sizes[-1]
             if np.prod(feature_map_size) <= features_per_stage[s]:
                 do_channel_token[s] = True
-        print("do_channel_token", do_channel_token)
-        print("feature_map_sizeS size", feature_map_sizes)
+        logger.debug("do_channel_token", do_channel_token)
+        logger.debug("feature_map_sizeS size", feature_map_sizes)
         
 
-        print(f"feature_map_sizes: {feature_map_sizes}")
-        print(f"do_channel_token: {do_channel_token}")
+        logger.debug("feature_map_sizes:", feature_map_sizes)
+        logger.debug("do_channel_token:", do_channel_token)
         
         self.mamba_scan_type = mamba_scan_type
         self.conv_pad_sizes = []
@@ -376,7 +254,7 @@ class ResidualMambaEncoder(nn.Module):
             return ret[-1]
 
     def compute_conv_feature_map_size(self, input_size):
-        print("Input size encoder initial", input_size)
+        logger.debug("Input size encoder initial", input_size)
         if self.stem is not None:
             output = self.stem.compute_conv_feature_map_size(input_size)
         else:
@@ -386,7 +264,7 @@ class ResidualMambaEncoder(nn.Module):
             
             output += self.stages[s].compute_conv_feature_map_size(input_size)
             input_size = [i // j for i, j in zip(input_size, self.strides[s])]
-            print("Input size encoder", input_size)
+            logger.debug("Input size encoder", input_size)
 
         return output
 
@@ -414,7 +292,7 @@ class UNetResDecoder(nn.Module):
 
         seg_layers = []
         for s in range(1, n_stages_encoder):
-            print("encoder.output_channels[-s]", encoder.output_channels[-s])
+            logger.debug("encoder.output_channels[-s]", encoder.output_channels[-s])
             input_features_below = encoder.output_channels[-s]
             input_features_skip = encoder.output_channels[-(s + 1)]
             stride_for_upsampling = encoder.strides[-s]
@@ -15,12 +15,16 @@ from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager
 from dynamic_network_architectures.building_blocks.helper import get_matching_instancenorm, convert_dim_to_conv_op
 from dynamic_network_architectures.initialization.weight_init import init_last_bn_before_add_to_0
 from nnunetv2.utilities.network_initialization import InitWeights_He
-from mamba_ssm import Mamba
+from nnunetv2.nets.mamba_layer import MambaLayer
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
 from dynamic_network_architectures.building_blocks.helper import maybe_convert_scalar_to_list, get_matching_pool_op
 from torch.cuda.amp import autocast
 from dynamic_network_architectures.building_blocks.residual import BasicBlockD
 from nnunetv2.utilities.pca_utils import extract_patches_and_origins, reassemble_patches
 
+# per-step messages are DEBUG, see nnunetv2/utilities/mamba_logging.py
+logger = get_mamba_logger('UMambaFirst_32', interval=10)
+
 
 
 class UpsampleLayer(nn.Module):
@@ -42,139 +46,6 @@ class UpsampleLayer(nn.Module):
         x = self.conv(x)
         return x
 
-class MambaLayer(nn.Module):
-    def __init__(self, dim, d_state=16, d_conv=4, expand=2, scan_type='x'):
-        super().__init__()
-        self.dim = dim
-        self.norm = nn.LayerNorm(dim)
-        self.mamba = Mamba(
-            d_model=dim,
-            d_state=d_state, 
-            d_conv=d_conv, 
-            expand=expand)
-        self.local_pca_vectors = None
-        self.local_pca_coords = None
-        self.scan_type = scan_type
-        self.register_buffer('principal_vector', torch.zeros(3), persistent=True)
-
-    def set_local_pca_vectors(self, vectors, coords):
-        print("[MambaLayer] Setting local PCA vectors and coordinates.")
-        self.local_pca_vectors = vectors
-        self.local_pca_coords = coords
-        print(f"[MambaLayer] Loaded {len(vectors)} local PCA vectors.")
-
-    def get_patch_index(self, patch_origin):
-        # find the index of a specific patch within collection of patch coordinates
-        print("Patch origin:", patch_origin)
-        #print("Local PCA coordinates:", self.local_pca_coords)
-        
-        arr = np.array(patch_origin)
-        # compare to the rows
-        if self.local_pca_coords is None:
-            print("[MambaLayer] No local PCA coordinates set Should run normal path flattening . Returning None.")
-            return None
-        matches = np.all(self.local_pca_coords == arr, axis=0) # !  check this 
-        idx = np.where(matches)[0] # get idxs of the rows that match
-        return idx[0] if len(idx) > 0 else None # if no match, return None
-
-    def get_local_pca_vector(self, patch_origin):
-        idx = self.get_patch_index(patch_origin)
-        print("Index of patch origin:", idx)
-        if idx is not None:
-            return self.local_pca_vectors[idx]
-        else:
-            return self.principal_vector
-
-    def set_scan_vector(self, vector):
-        if isinstance(vector, np.ndarray):
-            vector = torch.from_numpy(vector) if isinstance(vector, np.ndarray) else vector
-        self.principal_vector.copy_(vector.to(self.principal_vector.device, dtype=self.principal_vector.dtype))
-
-    def flatten_for_scan(self, x, scan_type='x', patch_origin=None):
-        B, C, D, H, W = x.shape
-        if scan_type == 'pca':
-            print("[MambaLayer] Using PCA scan type.")
-            print("TRYING TO GET LOCAL PCA, failing afterwards ")
-            vector = self.get_local_pca_vector(patch_origin) if patch_origin else self.principal_vector
-            print("made it")
-            return self.flatten_pca_scan(x, vector)
-
-        permute, unpermute = {
-            'x':  ((0, 1, 4, 3, 2), lambda t: t.reshape(B, C, W, H, D).permute(0, 1, 4, 3, 2)),
-            'y':  ((0, 1, 3, 4, 2), lambda t: t.reshape(B, C, H, W, D).permute(0, 1, 4, 2, 3)),
-            'z':  (None, lambda t: t.transpose(-1, -2).reshape(B, C, D, H, W)),
-        }[scan_type]
-        
-        x_perm = x.permute(*permute) if permute else x
-        x_flat = x_perm.reshape(B, C, -1).transpose(-1, -2)
-        return x_flat, unpermute
-
-    def flatten_pca_scan(self, x, principal_vector):
-        # ! : INCLUDE LOGIC HERE TO FALL BACK TO x!! 
-        """
-        Flattens the input tensor x using the given principal_vector.
-        Input:
-            x: (B, C, D, H, W) tensor
-            principal_vector: (3,) numpy or torch array (should be unit vector)
-        Output:
-            x_flat: (B, N, C) tensor, where N = D*H*W
-            indices: list of sorted indices for each batch
-        """
-        if principal_vector is None:
-            print("[MambaLayer] Principal vector is None. Skipping PCA flatten.")
-            return None, None
-        
-        B, C, D, H, W = x.shape
-        device = x.device
-        zz, yy, xx = torch.meshgrid(
-            torch.arange(D, device=device),
-            torch.arange(H, device=device),
-            torch.arange(W, device=device),
-            indexing='ij'
-        )
-        coords = torch.stack([zz, yy, xx], dim=-1).reshape(-1, 3).float()
-        # Project coordinates onto principal vector
-        if isinstance(principal_vector, np.ndarray):
-            principal_vector = torch.from_numpy(principal_vector).to(device, dtype=torch.float32)
-        else: 
-            principal_vector = principal_vector.to(device, dtype=torch.float32)
-        # : Forse qua niente matmul, ma dot product??? Gets messed up here? 
-        projections = torch.matmul(coords, principal_vector)
-        sorted_idx = torch.argsort(projections)
-
-        x_flat_list = [x[b].reshape(C, -1)[:, sorted_idx].T for b in range(B)]
-        x_flat = torch.stack(x_flat_list)
-
-        def unpermute(t):
-            out = torch.zeros((B, D*H*W, C), device=t.device,  dtype=t.dtype)
-            for b in range(B):
-                out[b, sorted_idx] = t[b]
-            return out.permute(0, 2, 1).reshape(B, C, D, H, W)
-
-        return x_flat, unpermute
-
-    def forward(self, x):
-        if x.dtype in [torch.float16, torch.bfloat16]:
-            x = x.float()
-        B, C = x.shape[:2]
-        assert C == self.dim
-        
-        if self.scan_type == 'pca':
-            if not torch.any(self.principal_vector):
-                print("[MambaLayer] No principal vector. Falling back to 'x'.")
-                x_flat, unpermute = self.flatten_for_scan(x, 'x')
-                print("x_flat shape:", x_flat.shape)
-                
-            else:
-                x_flat, unpermute = self.flatten_pca_scan(x, self.principal_vector)
-        else:
-            x_flat, unpermute = self.flatten_for_scan(x, self.scan_type)
-
-        x_norm = self.norm(x_flat)
-        x_mamba = self.mamba(x_norm)
-        out = x_mamba.transpose(-1, -2).reshape(B, C, *x.shape[2:])
-        return unpermute(out)
-
 class BasicResBlock(nn.Module):
     def __init__(
             self,
@@ -258,19 +129,19 @@ class ResidualMambaEncoder(nn.Module):
         feature_map_sizes = []
         #feature_map_size = input_size[::-1] # ! CHANGE 
         feature_map_size = input_size 
-        print("feature_map_size Input size", feature_map_size)
+        logger.debug("feature_map_size Input size", feature_map_size)
         
         for s in range(n_stages):
             feature_map_sizes.append([i // j for i, j in zip(feature_map_size, strides[s])])
             feature_map_size = feature_map_sizes[-1]
             if np.prod(feature_map_size) <= features_per_stage[s]:
                 do_channel_token[s] = True
-        print("do_channel_token", do_channel_token)
-        print("feature_map_sizeS size", feature_map_sizes)
+        logger.debug("do_channel_token", do_channel_token)
+        logger.debug("feature_map_sizeS size", feature_map_sizes)
         
 
-        print(f"feature_map_sizes: {feature_map_sizes}")
-        print(f"do_channel_token: {do_channel_token}")
+        logger.debug("feature_map_sizes:", feature_map_sizes)
+        logger.debug("do_channel_token:", do_channel_token)
         
         self.mamba_scan_type = mamba_scan_type
         self.conv_pad_sizes = []
@@ -378,13 +249,13 @@ class ResidualMambaEncoder(nn.Module):
             mamba_outputs = []
 
             for patch, origin in zip(patches, coords):
-                print("Origin of patch:", origin)
+                logger.debug("Origin of patch:", origin)
                 principal_vector = mamba.get_local_pca_vector(origin)
                 #! : here incorporate that output can be none and directly go to scan x. 
                 x_flat, unpermute = mamba.flatten_pca_scan(patch, principal_vector)
                 
                 if x_flat is None:
-                    print("[ResidualMambaEncoder] Falling back to 'x' scan path.")
+                    logger.debug("[ResidualMambaEncoder] Falling back to 'x' scan path.")
                     x_flat, unpermute = mamba.flatten_for_scan(patch, scan_type='x')
                 x_norm = mamba.norm(x_flat)
                 x_mamba = mamba.mamba(x_norm)
@@ -405,7 +276,7 @@ class ResidualMambaEncoder(nn.Module):
 
 
     def compute_conv_feature_map_size(self, input_size):
-        print("Input size encoder initial", input_size)
+        logger.debug("Input size encoder initial", input_size)
         if self.stem is not None:
             output = self.stem.compute_conv_feature_map_size(input_size)
         else:
@@ -443,7 +314,7 @@ class UNetResDecoder(nn.Module):
 
         seg_layers = []
         for s in range(1, n_stages_encoder):
-            print("encoder.output_channels[-s]", encoder.output_channels[-s])
+            logger.debug("encoder.output_channels[-s]", encoder.output_channels[-s])
             input_features_below = encoder.output_channels[-s]
             input_features_skip = encoder.output_channels[-(s + 1)]
             stride_for_upsampling = encoder.strides[-s]
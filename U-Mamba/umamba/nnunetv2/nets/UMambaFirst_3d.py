@@ -15,7 +15,8 @@ from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager
 from dynamic_network_architectures.building_blocks.helper import get_matching_instancenorm, convert_dim_to_conv_op
 from dynamic_network_architectures.initialization.weight_init import init_last_bn_before_add_to_0
 from nnunetv2.utilities.network_initialization import InitWeights_He
-from mamba_ssm import Mamba
+from nnunetv2.nets import mamba_layer
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
 from dynamic_network_architectures.building_blocks.helper import maybe_convert_scalar_to_list, get_matching_pool_op
 from torch.cuda.amp import autocast
 from dynamic_network_architectures.building_blocks.residual import BasicBlockD
@@ -23,7 +24,6 @@ import logging
 
 import torch.nn as nn
 from torch.cuda.amp import autocast
-from mamba_ssm.modules.mamba_simple import Mamba
 
 from sklearn.decomposition import PCA
 
@@ -34,122 +34,8 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-def flatten_for_scan(x, scan_type='x'):
-    """
-    Input: x: (B, C, D, H, W) tensor
-    Output: Flattened tensor and unpermute function
-    scan_type: 'x', 'y', 'z', 'yz-diag', 'xy-diag'
-    - 'x': Flatten along the x-axis
-    - 'y': Flatten along the y-axis
-    - 'z': Flatten along the z-axis
-    - 'yz-diag': Flatten along the diagonal of the yz-plane
-    - 'xy-diag': Flatten along the diagonal of the xy-plane
-    """
-    B, C, D, H, W = x.shape
-
-    if scan_type == 'x':
-        print("Using x-scan")
-        x_perm = x.permute(0, 1, 4, 3, 2)  # (B, C, X, Y, Z)
-        flatten = x_perm.reshape(B, C, -1).transpose(-1, -2)
-        unpermute = lambda t: t.reshape(B, C, W, H, D).permute(0, 1, 4, 3, 2)
-        return flatten, unpermute
-
-    elif scan_type == 'y':
-        print("Using y-scan")
-        x_perm = x.permute(0, 1, 3, 4, 2)  # (B, C, Y, X, Z)
-        flatten = x_perm.reshape(B, C, -1).transpose(-1, -2)
-        unpermute = lambda t: t.reshape(B, C, H, W, D).permute(0, 1, 4, 2, 3)
-        return flatten, unpermute
-
-    elif scan_type == 'z':
-        #print("Using z-scan")
-        # No permutation
-        flatten = x.reshape(B, C, -1).transpose(-1, -2)
-        unpermute = lambda t: t.transpose(-1, -2).reshape(B, C, D, H, W)
-        return flatten, unpermute
-
-    elif scan_type == 'yz-diag':
-        print("Using yz-diag-scan")
-        x_perm = x.permute(0, 1, 4, 3, 2)  # (B, C, X, Y, Z)
-        X, Y, Z = x_perm.shape[2:]
-        z_coords, y_coords = torch.meshgrid(
-            torch.arange(Z, device=x.device),
-            torch.arange(Y, device=x.device),
-            indexing='ij'
-        )
-        
-        diag_order = torch.argsort((z_coords + y_coords).flatten()) #! changed
-        x_flat = x_perm.reshape(B, C, X, Y * Z)[:, :, :, diag_order]
-        flatten = x_flat.reshape(B, C, -1).transpose(-1, -2)
-        unpermute = lambda t: t.reshape(B, C, X, Y, Z).permute(0, 1, 4, 3, 2)
-        return flatten, unpermute
-
-    elif scan_type == 'xy-diag':
-        x_perm = x.permute(0, 1, 2, 4, 3)  # (B, C, Z, X, Y)
-        D, X, Y = x_perm.shape[2:]
-        x_coords, y_coords = torch.meshgrid(
-            torch.arange(X, device=x.device),
-            torch.arange(Y, device=x.device),
-            indexing='ij'
-        )
-        
-        diag_order = torch.argsort((x_coords + y_coords).flatten()) #! changed
-        x_flat = x_perm.reshape(B, C, D, X * Y)[:, :, :, diag_order]
-        flatten = x_flat.reshape(B, C, -1).transpose(-1, -2)
-        unpermute = lambda t: t.reshape(B, C, D, X, Y).permute(0, 1, 2, 4, 3)
-        return flatten, unpermute
-
-    else:
-        raise ValueError(f"Unsupported scan type: {scan_type}")
-
-    
-
-
-def flatten_pca_scan(x, principal_vector):
-    """
-    Flattens the input tensor x using the given principal_vector.
-    Input:
-        x: (B, C, D, H, W) tensor
-        principal_vector: (3,) numpy or torch array (should be unit vector)
-    Output:
-        x_flat: (B, N, C) tensor, where N = D*H*W
-        indices: list of sorted indices for each batch
-    """
-    B, C, D, H, W = x.shape
-    device = x.device
-    # Create a grid of coordinates (D, H, W, 3)
-    zz, yy, xx = torch.meshgrid(
-        torch.arange(D, device=device),
-        torch.arange(H, device=device),
-        torch.arange(W, device=device),
-        indexing='ij'
-    )
-    coords = torch.stack([zz, yy, xx], dim=-1).reshape(-1, 3).float()  # (N, 3)
-    # Project coordinates onto principal vector
-    if isinstance(principal_vector, np.ndarray):
-        principal_vector = torch.from_numpy(principal_vector).to(device, dtype=torch.float32)
-    else:
-        principal_vector = principal_vector.to(device, dtype=torch.float32)
-    projections = torch.matmul(coords, principal_vector)  # (N,)
-    sorted_indices = torch.argsort(projections)
-    # Flatten x and reorder according to sorted_indices
-    x_flat_list = []
-    index_list = []
-    for b in range(B):
-        x_b = x[b].reshape(C, -1)[:, sorted_indices].T  # (N, C)
-        x_flat_list.append(x_b)
-        index_list.append(sorted_indices)
-    x_flat = torch.stack(x_flat_list, dim=0)  # (B, N, C)
-    # unpermute function to restore original shape
-    def unpermute(t):
-        # t: (B, N, C)
-        out = torch.zeros((B, D * H * W, C), device=t.device, dtype=t.dtype)
-        for b in range(B):
-            out[b, sorted_indices] = t[b]
-        return out.permute(0, 2, 1).reshape(B, C, D, H, W)
-    return x_flat, unpermute
-
-
+# per-step messages are DEBUG, see nnunetv2/utilities/mamba_logging.py
+logger = get_mamba_logger('UMambaFirst_3d', interval=10)
 
 class UpsampleLayer(nn.Module):
     def __init__(
@@ -170,74 +56,13 @@ class UpsampleLayer(nn.Module):
         x = self.conv(x)
         return x
 
-class MambaLayer(nn.Module):
-    #  
-    # - check patch size to avoid segmenting ears
-    # - scan paths
-    # - put mamba also in encoding layers
-    def __init__(self, dim, d_state = 16, d_conv = 4, expand = 2, scan_type='z'): #  
-            
-        super().__init__()
-        self.dim = dim
-        self.norm = nn.LayerNorm(dim)
-        self.mamba = Mamba(
-                d_model=dim, # Model dimension d_model
-                d_state=d_state,  # SSM state expansion factor
-                d_conv=d_conv,    # Local convolution width
-                expand=expand,    # Block expansion factor
-        )
-        self.scan_type = scan_type # self.scan_type = 'x'  # 'x', 'y', 'z', 'xy-diag', 'yz-diag', 'xz-diag'
-        self.register_buffer('principal_vector', torch.zeros(3), persistent=True)
-
-        
-    ## NEW VERSION FROM HERE: 
-    
-    def set_scan_vector(self, vector):
-        # Accepts numpy or torch, moves to correct device and dtype
-        if isinstance(vector, np.ndarray):
-            vector = torch.from_numpy(vector)
-        self.principal_vector.copy_(vector.to(self.principal_vector.device, dtype=self.principal_vector.dtype))
+class MambaLayer(mamba_layer.MambaLayer):
+    def __init__(self, dim, d_state=16, d_conv=4, expand=2, scan_type='z'):
+        super().__init__(dim, d_state, d_conv, expand, scan_type)
 
     @autocast(enabled=False)
     def forward(self, x):
-        if x.dtype == torch.float16:
-            x = x.type(torch.float32)
-
-        B, C = x.shape[:2]
-        assert C == self.dim
-        n_tokens = x.shape[2:].numel() # total number of voxels in the 3D image (i.e., Z × Y × X)
-        img_dims = x.shape[2:]
-        
-
-        if self.scan_type == 'pca':
-            if not torch.any(self.principal_vector):
-            # Fallback to x-scan if PCA vector is not yet set
-                print("[MambaLayer] PCA vector not set. Falling back to 'x' scan.")
-                logging.info("[MambaLayer] PCA vector not set. Falling back to 'x' scan.")
-                x_flat, unpermute = flatten_for_scan(x, 'x')
-                x_norm = self.norm(x_flat)
-                x_mamba = self.mamba(x_norm)
-                out = x_mamba.transpose(-1, -2).reshape(B, C, *img_dims)
-                return unpermute(out)
-            #print("[MambaLayer] Using PCA scan with principal vector:", self.principal_vector)
-            x_flat, unpermute = flatten_pca_scan(x, self.principal_vector)
-            x_norm = self.norm(x_flat)
-            x_mamba = self.mamba(x_norm)
-
-            # x_mamba is (B, N, C), unpermute expects (B, N, C)
-            return unpermute(x_mamba)
-
-        else:
-            logging.info(f"[MambaLayer] Using scan type: {self.scan_type}")
-            x_flat, unpermute = flatten_for_scan(x, self.scan_type)
-            x_norm = self.norm(x_flat)
-            x_mamba = self.mamba(x_norm)
-            out = x_mamba.transpose(-1, -2).reshape(B, C, *img_dims)
-            return unpermute(out)
-
-    
-    ## NEW VERSION UNTIL # delete what comes after
-    
+        return super().forward(x)
 
 class BasicResBlock(nn.Module):
     def __init__(
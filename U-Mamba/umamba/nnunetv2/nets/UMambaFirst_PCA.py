@@ -2,6 +2,7 @@ import os
 import numpy as np
 import math
 import torch
+import torch.utils.checkpoint
 from torch import nn
 from torch.nn import functional as F
 from typing import Union, Type, List, Tuple
@@ -16,11 +17,22 @@ from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager
 from dynamic_network_architectures.building_blocks.helper import get_matching_instancenorm, convert_dim_to_conv_op
 from dynamic_network_architectures.initialization.weight_init import init_last_bn_before_add_to_0
 from nnunetv2.utilities.network_initialization import InitWeights_He
-from mamba_ssm import Mamba
+from nnunetv2.nets.mamba_backends import TorchMamba
 from dynamic_network_architectures.building_blocks.helper import maybe_convert_scalar_to_list, get_matching_pool_op
 from torch.cuda.amp import autocast
 from dynamic_network_architectures.building_blocks.residual import BasicBlockD
 from nnunetv2.utilities.pca_utils import extract_patches_and_origins, reassemble_patches
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
+from nnunetv2.utilities.scan_orders import local_pca_key_map, vector_key, crop_reference_volume, pruned_scan_order, \
+    gather_tokens
+from nnunetv2.nets import mamba_layer
+from nnunetv2.nets.mamba_layer import AxisScan, GlobalPCAScan, LocalPCAScan
+
+# shape of the volume the local PCA vectors live in, used if the trainer did not set one (legacy checkpoints)
+DEFAULT_PCA_REFERENCE_SHAPE = (240, 240, 180)
+
+# per-step messages are DEBUG, see nnunetv2/utilities/mamba_logging.py
+logger = get_mamba_logger('UMambaFirst_PCA', interval=10)
 
 
 
@@ -43,29 +55,36 @@ class UpsampleLayer(nn.Module):
         x = self.conv(x)
         return x
 
-class MambaLayer(nn.Module):
+class MambaLayer(mamba_layer.MambaLayer):
+    """
+    The stem Mamba layer of PSU-Mamba. On top of the scans of mamba_layer.MambaLayer: global_pca (along the scan
+    vector, which is stored as global_pca_vector), multi_pca, local_pca (see local_pca_key_map) and token pruning.
+    """
+    # 'z' scans the W axis before H, 'diag' is memory order
+    axis_scans = dict(mamba_layer.AXIS_SCANS, z=AxisScan((0, 2, 1)),
+                      diag=AxisScan((0, 1, 2), transposed_unscan=True))
+    scan_vector_name = 'global_pca_vector'
+
     def __init__(self, dim, d_state=16, d_conv=4, expand=2, scan_type='x'):
-        super().__init__()
-        self.dim = dim
-        self.norm = nn.LayerNorm(dim)
-        self.mamba = Mamba(
-            d_model=dim,
-            d_state=d_state, 
-            d_conv=d_conv, 
-            expand=expand)
-        self.local_pca_vectors = None
-        self.local_pca_coords = None
-        self.scan_type = scan_type
-        self.register_buffer('global_pca_vector', torch.zeros(3), persistent=True)
-        
-    def get_local_pca_vector(self, patch_origin):
-        idx = self.get_patch_index(patch_origin)
-        print("Index of patch origin:", idx)
-        if idx is not None:
-            return self.local_pca_vectors[idx]
-        else:
-            return self.global_pca_vector
-        
+        super().__init__(dim, d_state, d_conv, expand, scan_type)
+        # all global scan vectors (K, 3), global_pca_vector is the first one. Used by the multi_pca scan. Not part of
+        # the state dict (older checkpoints do not have it), it is restored from the scan plan
+        self.register_buffer('global_pca_vectors', torch.zeros(0, 3), persistent=False)
+        # scan permutations only depend on (shape, vector/tile origin, device), so they are built once and reused
+        # from self._scan_order_cache. It is bounded because local PCA adds one entry per tile origin
+        self._global_pca_keys = None
+        self._local_pca_key_map = None
+        # scan orders shipped with the checkpoint (see ScanPlan), used instead of building them
+        self._precomputed_global_orders = {}
+        self._precomputed_local_key_map = None
+        # local PCA scan: shape of the volume local_pca_coords refer to and the position of the current input in it
+        self.pca_reference_shape = None
+        self._scan_origins = None
+        self._scan_volume_shapes = None
+        # token pruning: (D, H, W) bool mask in reference volume space (dilated foreground prior). If set, PCA scans
+        # only visit the voxels inside it, see flatten_pruned_scan
+        self.register_buffer('token_mask', None, persistent=False)
+
     def set_local_pca_vectors(self, vectors, coords):
         """
         Sets local PCA vectors and their corresponding patch coordinates.
@@ -93,22 +112,9 @@ class MambaLayer(nn.Module):
 
         self.local_pca_vectors = vectors  # (N, k, C) where k = 1 or 2
         self.local_pca_coords = coords
+        self._invalidate_scan_orders()
 
 
-    def get_patch_index(self, patch_origin):
-        print("Patch origin:", patch_origin)
-        arr = torch.tensor(patch_origin, dtype=torch.long)
-        if self.local_pca_coords is None:
-            print("[MambaLayer] No local PCA coordinates set. Returning None.")
-            return None
-        # Ensure coords are also long/int
-        coords = self.local_pca_coords
-        if coords.dtype != torch.long:
-            coords = coords.long()
-        matches = torch.all(coords == arr, dim=1)
-        idx = torch.where(matches)[0]
-        return idx[0].item() if len(idx) > 0 else None
-
     def get_global_pca_vector(self):
         """
         Get the global PCA vector used in the Mamba layer.
@@ -143,13 +149,172 @@ class MambaLayer(nn.Module):
         vector = vector.to(self.global_pca_vector.device, dtype=self.global_pca_vector.dtype)
 
         if vector.ndim == 1 and vector.shape[0] == 3:
-            # Single vector
-            self.global_pca_vector.copy_(vector)
-        elif vector.ndim == 2 and vector.shape[1] == 3:
-            # Multiple vectors: use the first as representative (or update your logic to handle all)
-            self.global_pca_vector.copy_(vector[0])  # <- Replace this line if you want multi-vector support
-        else:
+            vector = vector[None]
+        elif vector.ndim != 2 or vector.shape[1] != 3:
             raise ValueError(f"Expected shape (3,) or (N, 3), got {tuple(vector.shape)}")
+        # global_pca scans along the first vector, multi_pca along all of them
+        self.global_pca_vector.copy_(vector[0])
+        self.global_pca_vectors = vector.clone()
+        self._invalidate_scan_orders()
+
+    def set_scan_vector(self, vector):
+        self.set_global_pca_vectors(vector)
+
+    def _invalidate_scan_orders(self, keep_precomputed: bool = False):
+        super()._invalidate_scan_orders(keep_precomputed)
+        self._global_pca_keys = None
+        self._local_pca_key_map = None
+        if not keep_precomputed:
+            self._precomputed_global_orders = {}
+            self._precomputed_local_key_map = None
+
+    def set_precomputed_scan_orders(self, global_vector_key=None, global_orders=None, local_key_map=None):
+        """
+        Use scan orders computed ahead of time (ScanPlan.precompute_scan_orders) instead of building them on the first
+        forward pass. Must be called after the vectors / patch size / reference shape were set, setting those discards
+        precomputed orders.
+
+        Args:
+            global_vector_key: vector_key of the global PCA vector the orders were computed for, or a list of keys (one
+            per global vector, multi_pca). Orders are only used while the layer's vector matches (loading another
+            fold's weights can change it)
+            global_orders: {spatial shape: (N,) scan permutation, or (K, N) for K vectors}
+            local_key_map: (D, H, W) key map of the reference volume, see local_pca_key_map
+        """
+        self._precomputed_global_orders = {}
+        if global_orders is not None:
+            keys = global_vector_key if isinstance(global_vector_key, list) else [global_vector_key]
+            for shape, perms in global_orders.items():
+                perms = torch.as_tensor(perms).long().reshape(len(keys), -1)
+                for key, perm in zip(keys, perms):
+                    self._precomputed_global_orders[(tuple(int(i) for i in shape), key)] = perm
+        self._precomputed_local_key_map = None if local_key_map is None else torch.as_tensor(local_key_map).int()
+        self._scan_order_cache.clear()
+        self._local_pca_key_map = None
+
+    def get_pca_scan(self, vector=None, key=None) -> GlobalPCAScan:
+        scan = super().get_pca_scan(vector) if key is None else GlobalPCAScan(vector, key)
+        scan.precomputed = self._precomputed_global_orders
+        return scan
+
+    def set_pca_reference_shape(self, shape):
+        """
+        Set the shape of the volume local_pca_coords refer to (the shape of the mean mask the vectors were computed on).
+        Cases are assumed to be centered in it.
+        """
+        self.pca_reference_shape = tuple(int(i) for i in shape)
+        self._invalidate_scan_orders()
+
+    def set_token_mask(self, mask):
+        """
+        Enable token pruning with mask ((D, H, W), reference volume space, see set_pca_reference_shape) or disable it
+        (None).
+        """
+        if mask is not None:
+            mask = torch.as_tensor(mask).bool()
+            if mask.ndim != 3:
+                raise ValueError(f"Expected a (D, H, W) token mask, got shape {tuple(mask.shape)}")
+            mask = mask.to(self.global_pca_vector.device)
+        self.token_mask = mask
+        self._invalidate_scan_orders(keep_precomputed=True)
+
+    def get_pca_reference_shape(self):
+        return self.pca_reference_shape if self.pca_reference_shape is not None else DEFAULT_PCA_REFERENCE_SHAPE
+
+    def set_scan_origins(self, origins, volume_shapes=None):
+        """
+        Tell the layer where the next input(s) are located so that the local PCA scan matches the anatomy.
+
+        Args:
+            origins: (B, 3) or (1, 3) position of the first voxel of each input in its case (e.g. from the bbox of the
+            data loader or the start of the sliding window slicer). Can be negative if the input was padded
+            volume_shapes: (B, 3) or (1, 3) shape of the cases. If given, origins are shifted into reference volume
+            space (cases are centered in the reference volume). If None, origins are taken to be in reference space
+        """
+        # kept as numpy so that forward does not need to sync with the device
+        self._scan_origins = np.asarray(origins, dtype=np.int64).reshape(-1, 3)
+        self._scan_volume_shapes = None if volume_shapes is None else \
+            np.asarray(volume_shapes, dtype=np.int64).reshape(-1, 3)
+
+    def clear_scan_origins(self):
+        # inputs are assumed to be center crops of the reference volume
+        self._scan_origins = None
+        self._scan_volume_shapes = None
+
+    def set_sequence_chunk_size(self, chunk_size):
+        """
+        Run the Mamba block over the (full resolution) sequence in chunks of chunk_size tokens that carry the scan state
+        and conv context over, each chunk under activation checkpointing (see TorchMamba.checkpoint_blocks). Only the
+        chunk boundaries are kept for backward. None restores the default. The mamba_ssm kernels cannot start from a
+        given scan state, with that backend the option is ignored (use stem checkpointing instead).
+        """
+        if not hasattr(self.mamba, 'checkpoint_blocks'):
+            if chunk_size is not None:
+                logger.warning(f"[MambaLayer] {type(self.mamba).__name__} cannot carry the scan state between chunks, "
+                               f"ignoring sequence chunk size {chunk_size}", interval=600)
+            return
+        self.mamba.block_size = chunk_size
+        self.mamba.checkpoint_blocks = chunk_size is not None
+
+    def compute_conv_feature_map_size(self, input_size, scan_states: bool = None):
+        """
+        Number of activation elements (per sample) this layer keeps for backward, in the units of the conv feature map
+        accounting of the planner. The Mamba block holds several times the expanded inner dimension per token
+        (and the scan states with the torch backend), unless it runs in checkpointed chunks.
+
+        scan_states: whether the Mamba implementation materializes the scan states (torch backend). Default: that of
+        the layer's Mamba block
+        """
+        mamba = self.mamba
+        n_tokens = np.prod(input_size, dtype=np.int64)
+        # multi_pca scans every input 2K times in one batch
+        n_seq = 2 * max(1, len(self.global_pca_vectors)) if self.scan_type == 'multi_pca' else 1
+        # flattened input, LayerNorm output and Mamba output of each sequence, unpermuted output
+        output = np.int64(3 * n_seq * self.dim + self.dim) * n_tokens
+        # in_proj (x and z), conv, activation, delta, scan output and gated output, x_proj
+        inner = 6 * mamba.d_inner + mamba.dt_rank + 2 * mamba.d_state
+        if scan_states is None:
+            scan_states = isinstance(mamba, TorchMamba)
+        if scan_states:
+            inner += mamba.d_state * mamba.d_inner
+        if getattr(mamba, 'checkpoint_blocks', False):
+            block_size = mamba.block_size if mamba.block_size is not None else \
+                max(mamba.chunk_size, 2 ** 21 // (mamba.d_inner * mamba.d_state))
+            n_blocks = -(-int(n_tokens) // block_size)
+            # scan state per chunk boundary + the recomputed intermediates of one chunk
+            output += np.int64(n_seq * n_blocks) * mamba.d_state * mamba.d_inner + \
+                np.int64(n_seq * min(block_size, int(n_tokens))) * inner
+        else:
+            output += np.int64(n_seq * inner) * n_tokens
+        return output
+
+    def scan_buffer_bytes(self, input_size):
+        """
+        Bytes of the cached scan order index tensors (long perm + inv per cached order) for inputs of this size. Local
+        PCA orders are cached per input position, up to the cache size, plus the key map of the reference volume.
+        """
+        n_tokens = int(np.prod(input_size, dtype=np.int64))
+        if self.scan_type in ('global_pca', 'learned'):
+            return 16 * n_tokens
+        if self.scan_type == 'multi_pca':
+            # the single vector orders and the stacked forward / reverse orders
+            return 16 * n_tokens * 3 * max(1, len(self.global_pca_vectors))
+        if self.scan_type == 'local_pca':
+            n_entries = self._scan_order_cache.max_entries or 1
+            return 16 * n_tokens * n_entries + 4 * int(np.prod(self.get_pca_reference_shape()))
+        return 0
+
+    def _get_reference_origins(self, batch_size, spatial_shape):
+        reference_shape = np.array(self.get_pca_reference_shape())
+        center = tuple(int(i) for i in (reference_shape - np.array(spatial_shape)) // 2)
+        if self._scan_origins is None or len(self._scan_origins) not in (1, batch_size):
+            return [center] * batch_size
+        origins = self._scan_origins
+        if self._scan_volume_shapes is not None:
+            origins = origins + (reference_shape - self._scan_volume_shapes) // 2
+        if len(origins) == 1:
+            origins = np.repeat(origins, batch_size, axis=0)
+        return [tuple(int(i) for i in o) for o in origins]
 
     def set_pca_patch_size(self, patch_size):
         """
@@ -165,6 +330,7 @@ class MambaLayer(nn.Module):
             self.pca_patch_size = (patch_size, patch_size, patch_size)
         else:
             raise ValueError(f"Expected patch_size to be a tuple or int, got {type(patch_size)}")
+        self._invalidate_scan_orders()
      
     def pad_to_fit(volume, patch_size):
         _, _, D, H, W = volume.shape
@@ -174,119 +340,52 @@ class MambaLayer(nn.Module):
         pad = (0, pad_W, 0, pad_H, 0, pad_D)  # last dimension first
         return F.pad(volume, pad), pad   
 
-    def flatten_for_scan(self, x, scan_type='x', patch_origin=None):
-        print(f"[MambaLayer] Flattening for scan type: {scan_type}, patch origin: {patch_origin}")
-        B, C, D, H, W = x.shape
+    def _build_multi_pca_scan_orders(self, spatial_shape, vectors, device):
+        # the single vector orders are shared with flatten_pca_scan (and can come from the scan plan)
+        perms, invs = [], []
+        for key, vector in zip(self._global_pca_keys, vectors):
+            perm, inv = self.get_pca_scan(vector, key).scan_order(spatial_shape, device, self._scan_order_cache)
+            perms += [perm, perm.flip(0)]
+            invs += [inv, perm.numel() - 1 - inv]
+        return torch.stack(perms), torch.stack(invs)
 
-        # can delete this later as now we handle 3 different functions
-        if scan_type in ['global_pca', 'local_pca', 'pca']:
-            print("WARNING: SHOULD NEVER ENTER HERE")
-            exit() #! delete this block, should never enter here in theory. 
-            vector = self.get_local_pca_vector(patch_origin) if patch_origin else self.global_pca_vector
-            return self.flatten_pca_scan(x, vector)
-
-        # original: (B, C, D, H, W) = (B, C, Z, Y, X) where X = D, Y = H, Z = W
-        permute, unpermute = {
-            'x':  ((0, 1, 4, 3, 2), lambda t: t.reshape(B, C, W, H, D).permute(0, 1, 4, 3, 2)), # x -> y -> z
-            'y':  ((0, 1, 3, 4, 2), lambda t: t.reshape(B, C, H, W, D).permute(0, 1, 4, 2, 3)), # y -> x -> z
-            #'z':  ((0, 1, 3, 4, 2), lambda t: t.permute(0, 1, 3, 4, 2).reshape(B, C, -1)),  # z fastest, then x, then y               # z -> y -> x
-            'z':  ((0, 1, 2, 4, 3), lambda t: t.reshape(B, C, D, W, H).permute(0, 1, 2, 4, 3)),  # z fastest, then x, then y
-            'diag': (None, lambda t: t.transpose(-1, -2).reshape(B, C, D, H, W)),  # fallback
-        }.get(scan_type, (None, lambda t: t.transpose(-1, -2).reshape(B, C, D, H, W)))
-
-        if scan_type == 'yz-diag':
-            print("Using yz-diag-scan")
-            x_perm = x.permute(0, 1, 4, 3, 2)  # (B, C, X, Y, Z)
-            X, Y, Z = x_perm.shape[2:]
-            z_coords, y_coords = torch.meshgrid(
-                torch.arange(Z, device=x.device),
-                torch.arange(Y, device=x.device),
-                indexing='ij'
-            )
-            
-            diag_order = torch.argsort((z_coords + y_coords).flatten()) #! changed
-            x_flat = x_perm.reshape(B, C, X, Y * Z)[:, :, :, diag_order]
-            flatten = x_flat.reshape(B, C, -1).transpose(-1, -2)
-            unpermute = lambda t: t.reshape(B, C, X, Y, Z).permute(0, 1, 4, 3, 2)
-            return flatten, unpermute
-
-        elif scan_type == 'xy-diag':
-            x_perm = x.permute(0, 1, 2, 4, 3)  # (B, C, Z, X, Y)
-            D, X, Y = x_perm.shape[2:]
-            x_coords, y_coords = torch.meshgrid(
-                torch.arange(X, device=x.device),
-                torch.arange(Y, device=x.device),
-                indexing='ij'
-            )
-            
-            diag_order = torch.argsort((x_coords + y_coords).flatten()) #! changed
-            x_flat = x_perm.reshape(B, C, D, X * Y)[:, :, :, diag_order]
-            flatten = x_flat.reshape(B, C, -1).transpose(-1, -2)
-            unpermute = lambda t: t.reshape(B, C, D, X, Y).permute(0, 1, 2, 4, 3)
-            return flatten, unpermute
-
-        # Default permute-based scan
-        x_perm = x.permute(*permute) if permute else x
-        x_flat = x_perm.reshape(B, C, -1).transpose(-1, -2)
-        
-        return x_flat, unpermute
-
-
-    def flatten_pca_scan(self, x, global_pca_vector):
+    def flatten_multi_pca_scan(self, x):
         """
-        Flatten tensor using a global PCA direction.
+        Flatten x along every global PCA vector (global_pca_vectors, K of them), each in forward and reverse order.
+        The 2K sequences are stacked into the batch dimension so that they go through a single Mamba call. unpermute
+        maps every sequence back to the volume and averages them.
+
+        The stacked (2K, N) permutations are cached per (spatial shape, vectors, device).
 
         Args:
             x: Tensor of shape (B, C, D, H, W)
-            global_pca_vector: Tensor or ndarray of shape (3,) or (1, 3)
 
         Returns:
-            x_flat: (B, N, C)
-            unpermute: function to reverse flattening
+            x_flat: (2K * B, N, C), sequence s of sample b is at index s * B + b
+            unpermute: function (2K * B, N, C) -> (B, C, D, H, W)
         """
-        print("[MambaLayer] Flattening using PCA scan path...")
-
-        if global_pca_vector is None:
-            print("[MambaLayer] Principal vector is None. Skipping PCA flatten.")
-            return None, None
-
-        # Normalize and ensure shape is (3,)
-        if isinstance(global_pca_vector, np.ndarray):
-            global_pca_vector = torch.from_numpy(global_pca_vector)
-        if global_pca_vector.ndim == 2:
-            global_pca_vector = global_pca_vector[0]
-        global_pca_vector = global_pca_vector.to(x.device, dtype=torch.float32)
-
-        print("[MambaLayer] Using PCA direction:", global_pca_vector.cpu().numpy())
+        vectors = self.global_pca_vectors if len(self.global_pca_vectors) > 0 else self.global_pca_vector[None]
+        if self._global_pca_keys is None:
+            self._global_pca_keys = [vector_key(v) for v in vectors]
 
         B, C, D, H, W = x.shape
-        zz, yy, xx = torch.meshgrid(
-            torch.arange(D, device=x.device),
-            torch.arange(H, device=x.device),
-            torch.arange(W, device=x.device),
-            indexing='ij'
+        spatial_shape = (D, H, W)
+        N = D * H * W
+        perms, invs = self._scan_order_cache.get(
+            ('multi_pca', spatial_shape, tuple(self._global_pca_keys), x.device),
+            lambda: self._build_multi_pca_scan_orders(spatial_shape, vectors, x.device)
         )
-        coords = torch.stack([zz, yy, xx], dim=-1).reshape(-1, 3).float()  # (N, 3)
-
-        # Project coords onto vector
-        projections = torch.matmul(coords, global_pca_vector)  # (N,)
-        
-        sorted_idx = torch.argsort(projections)
+        n_seq = perms.shape[0]
 
-        # Flatten x
-        x_flat_list = [x[b].reshape(C, -1)[:, sorted_idx].permute(1, 0) for b in range(B)]  # (N, C)
-        x_flat = torch.stack(x_flat_list)  # (B, N, C)
+        x_flat = x.reshape(B, C, N).index_select(-1, perms.reshape(-1)).reshape(B, C, n_seq, N)
+        x_flat = x_flat.permute(2, 0, 3, 1).reshape(n_seq * B, N, C)
 
         def unpermute(t_flat):
-            if t_flat.ndim != 5:
-                raise ValueError(f"[unpermute] Expected shape (B, C, D, H, W), got {t_flat.shape}")
-
-            t_reshaped = t_flat.reshape(B, C, -1)  # (B, C, N)
-            out = torch.zeros_like(t_reshaped)
-            for b in range(B):
-                out[b, :, sorted_idx] = t_reshaped[b]
-            return out.reshape(B, C, D, H, W)
-
+            t_flat = t_flat.reshape(n_seq, B, N, C).transpose(2, 3)
+            out = gather_tokens(t_flat[0], invs[0], perms[0])
+            for i in range(1, n_seq):
+                out = out + gather_tokens(t_flat[i], invs[i], perms[i])
+            return (out / n_seq).reshape(B, C, D, H, W)
 
         return x_flat, unpermute
 
@@ -302,14 +401,14 @@ class MambaLayer(nn.Module):
         
         if self.local_pca_vectors is None and self.local_pca_coords is None:
             # In first epoch fall bak to global x scan as vectors are not set yet
-            print("[MambaLayer] Using fallback flattening for first epoch.")
-            print("SHape x", x.shape)
+            logger.debug("[MambaLayer] Using fallback flattening for first epoch.")
+            logger.debug("SHape x", x.shape)
             return self.flatten_for_scan(x, scan_type='x')
 
-        print("[MambaLayer] Flattening using local PCA scan path...")
+        logger.debug("[MambaLayer] Flattening using local PCA scan path...")
         B, C, D, H, W = x.shape
         
-        full_shape = (240, 240, 180)
+        full_shape = self.get_pca_reference_shape()
         crop_origin = [ (full - crop) // 2 for full, crop in zip(full_shape, (D, H, W)) ]
         z0, y0, x0 = crop_origin
         
@@ -341,7 +440,7 @@ class MambaLayer(nn.Module):
                 z1, y1, x1 = z0 + patch_size[0], y0 + patch_size[1], x0 + patch_size[2]
 
                 patch = x[b, :, z0:z1, y0:y1, x0:x1]  # (C, dz, dy, dx) = (32, 16, 16, 16)
-                print("Patch shape:", patch.shape, "at coords:", coords[i])
+                logger.debug("Patch shape:", patch.shape, "at coords:", coords[i])
 
                 # Do not include patches that do not match the expected size (C, dz, dy, dx)
                 if patch.shape[1:] != torch.Size(patch_size):  # safety
@@ -375,13 +474,13 @@ class MambaLayer(nn.Module):
             
             if flat_list:
                 x_flat_batches.append(torch.cat(flat_list, dim=0))  # (N_total, C)
-                print("x_flat_batches shape:", x_flat_batches[-1].shape)
+                logger.debug("x_flat_batches shape:", x_flat_batches[-1].shape)
   
             else:
                 x_flat_batches.append(torch.zeros((1, C), device=device))
             
         x_flat = torch.stack(x_flat_batches)  # (B, N_total, C)
-        print("Final x_flat shape:", x_flat.shape)
+        logger.debug("Final x_flat shape:", x_flat.shape)
         
 
         def unpermute(t):
@@ -415,7 +514,7 @@ class MambaLayer(nn.Module):
             x_flat (Tensor): (B, N_total, C)
             unpermute (function): to map flattened outputs back to (B, C, D, H, W)
         """
-        print("[MambaLayer] Flattening using local PCA scan path...")
+        logger.debug("[MambaLayer] Flattening using local PCA scan path...")
         B, C, D, H, W = x.shape
         device = x.device
         patch_size = self.pca_patch_size
@@ -423,11 +522,11 @@ class MambaLayer(nn.Module):
 
         # Handle fallback case for epoch 0
         if self.local_pca_vectors is None or self.local_pca_coords is None:
-            print("[MambaLayer] Local PCA vectors/coords not available. Falling back to x scan.")
+            logger.debug("[MambaLayer] Local PCA vectors/coords not available. Falling back to x scan.")
             return self.flatten_for_scan(x, scan_type='x')
 
         # === Step 1: Compute crop origin from full shape (assuming center crop)
-        full_shape = (240, 240, 180)
+        full_shape = self.get_pca_reference_shape()
         crop_origin = [(f - p) // 2 for f, p in zip(full_shape, (D, H, W))]
         z0, y0, x0 = crop_origin
         
@@ -445,68 +544,49 @@ class MambaLayer(nn.Module):
         coords_crop = coords[within_crop] - torch.tensor([z0, y0, x0], device=device)
         vectors_crop = vectors[within_crop]
         
-        # Pre-allocate flat tensor and voxel counter
-        x_flat = torch.zeros((B, D * H * W, C), device=device)
-        filled_mask = torch.zeros((B, D, H, W), dtype=torch.bool, device=device) # to track filled voxels
-
-
-        x_flat_batches = []
-
-        for b in range(B):
-
-            for i in range(coords_crop.shape[0]):
-                z, y, x_ = coords_crop[i].tolist()
-                patch = x[b, :, z:z+dz, y:y+dy, x_:x_+dx]  # (C, dz, dy, dx)
-
-                if patch.shape[1:] != torch.Size(patch_size):
-                    continue
-
-                zz, yy, xx = torch.meshgrid(
-                    torch.arange(dz, device=device),
-                    torch.arange(dy, device=device),
-                    torch.arange(dx, device=device),
-                    indexing='ij'
-                )
-
-                coords_patch = torch.stack([zz + z, yy + y, xx + x_], dim=-1).reshape(-1, 3).float()
-                #print("Patch coordinates shape:", coords_patch.shape)
-                
-                # Project and sort
-                proj = torch.matmul(coords_patch, vectors_crop[i].squeeze(0).to(device))  # (N,)
-                sort_idx = torch.argsort(proj) # (N)
-                #print("Patch projection shape:", proj.shape, "Sort index shape:", sort_idx.shape)  
-                #print("Patch shape before flattening:", patch.reshape(C, -1).shape)
-                
+        # source voxel of every position of x_flat. Voxels that are not covered by a patch are zero (index N). The
+        # ordering is the same for all samples of the batch
+        N = D * H * W
+        source = torch.full((N,), N, dtype=torch.long, device=device)
+        for i in range(coords_crop.shape[0]):
+            z, y, x_ = coords_crop[i].tolist()
+            if z + dz > D or y + dy > H or x_ + dx > W:
+                continue
+
+            zz, yy, xx = torch.meshgrid(
+                torch.arange(dz, device=device),
+                torch.arange(dy, device=device),
+                torch.arange(dx, device=device),
+                indexing='ij'
+            )
 
-                patch_flat = patch.reshape(C, -1)[:, sort_idx].T  # (N_voxels, C)
-                #print("Patch flat shape:", patch_flat.shape)
-                
-                # Flattened voxel indices in global space
-                # Convert 3D patch coordinates to linear indices
-                global_coords = coords_patch.long() # (N_voxels, 3)
-                # map 3D coordinates to a single index in a flattened array
-                lin_idx = global_coords[:, 0] * (H * W) + global_coords[:, 1] * W + global_coords[:, 2]  # (N,)
+            coords_patch = torch.stack([zz + z, yy + y, xx + x_], dim=-1).reshape(-1, 3).float()
 
-                # Fill into preallocated tensor
-                x_flat[b, lin_idx] = patch_flat
-                filled_mask[b, global_coords[:, 0], global_coords[:, 1], global_coords[:, 2]] = True
+            # Project and sort
+            proj = torch.matmul(coords_patch, vectors_crop[i].squeeze(0).to(device))  # (N,)
+            sort_idx = torch.argsort(proj) # (N)
 
-        #print(f"[MambaLayer] Final x_flat shape: {x_flat.shape}")
-                            
+            # Flattened voxel indices in global space
+            global_coords = coords_patch.long() # (N_voxels, 3)
+            lin_idx = global_coords[:, 0] * (H * W) + global_coords[:, 1] * W + global_coords[:, 2]  # (N,)
 
+            # the patch voxels in scan order go to the positions of the patch
+            source[lin_idx] = lin_idx[sort_idx]
 
+        # positions and voxels of the patches are the same set, so the inverse of source is again N for the rest
+        covered = source < N
+        inverse = torch.full_like(source, N)
+        inverse[source[covered]] = torch.nonzero(covered)[:, 0]
+        x_flat = gather_tokens(x.reshape(B, C, N), source, inverse, partial=True).transpose(1, 2)
+        # unpermute keeps covered voxels in place and zeros the rest
+        identity = torch.where(covered, torch.arange(N, device=device), N)
 
         def unpermute(t):
-            out = torch.zeros((B, C, D, H, W), device=t.device, dtype=t.dtype)
-            for b in range(B):
-                filled_voxels = filled_mask[b].nonzero(as_tuple=False)  # (N, 3)
-                lin_idx = filled_voxels[:, 0] * (H * W) + filled_voxels[:, 1] * W + filled_voxels[:, 2]
-                out[b, :, filled_voxels[:, 0], filled_voxels[:, 1], filled_voxels[:, 2]] = t[b, lin_idx].T
-            return out
+            return gather_tokens(t.transpose(1, 2), identity, identity, partial=True).reshape(B, C, D, H, W)
 
 
 
-        print(f"[MambaLayer] Final x_flat shape: {x_flat.shape}")
+        logger.debug("[MambaLayer] Final x_flat shape:", x_flat.shape)
         return x_flat, unpermute
     
     
@@ -533,66 +613,148 @@ class MambaLayer(nn.Module):
         crop_origin = [(f - c) // 2 for f, c in zip(full_shape, (D_crop, H_crop, W_crop))]
         z0c, y0c, x0c = crop_origin
 
-        flat_all = []
-        index_map_all = []
+        N = D_crop * H_crop * W_crop
 
-        for b in range(B):
-            flat_patches = []
-            voxel_indices = []
+        # the voxels visited by the scan are the same for all samples of the batch
+        voxel_indices = []
+        for coord, vec in zip(coords_list, vectors_list):
+            # shift patch into cropped space
+            zc, yc, xc = coord[0] - z0c, coord[1] - y0c, coord[2] - x0c
 
-            for coord, vec in zip(coords_list, vectors_list):
-                # shift patch into cropped space
-                zc, yc, xc = coord[0] - z0c, coord[1] - y0c, coord[2] - x0c
+            # skip if patch doesn't fit inside crop
+            if not (0 <= zc < D_crop - dz + 1 and
+                    0 <= yc < H_crop - dy + 1 and
+                    0 <= xc < W_crop - dx + 1):
+                continue
 
-                # skip if patch doesn't fit inside crop
-                if not (0 <= zc < D_crop - dz + 1 and
-                        0 <= yc < H_crop - dy + 1 and
-                        0 <= xc < W_crop - dx + 1):
-                    continue
+            zz, yy, xx = torch.meshgrid(
+                torch.arange(dz, device=x.device),
+                torch.arange(dy, device=x.device),
+                torch.arange(dx, device=x.device),
+                indexing='ij'
+            )
+            coords_patch = torch.stack([zz + zc, yy + yc, xx + xc], dim=-1).reshape(-1, 3).float()
+            proj = torch.matmul(coords_patch, vec.to(x.device))
+            sort_idx = torch.argsort(proj)
 
-                patch = x[b, :, zc:zc+dz, yc:yc+dy, xc:xc+dx]
-                zz, yy, xx = torch.meshgrid(
-                    torch.arange(dz, device=x.device),
-                    torch.arange(dy, device=x.device),
-                    torch.arange(dx, device=x.device),
-                    indexing='ij'
-                )
-                coords_patch = torch.stack([zz + zc, yy + yc, xx + xc], dim=-1).reshape(-1, 3).float()
-                proj = torch.matmul(coords_patch, vec.to(x.device))
-                sort_idx = torch.argsort(proj)
+            coords_sorted = coords_patch[sort_idx.long()].long()
+            lin_idx = coords_sorted[:, 0] * H_crop * W_crop + coords_sorted[:, 1] * W_crop + coords_sorted[:, 2]
+            voxel_indices.append(lin_idx)
+
+        if voxel_indices:
+            index_map = torch.cat(voxel_indices, dim=0)  # (N_total,)
+        else:
+            # a single zero token (index N reads zero)
+            index_map = torch.full((1,), N, dtype=torch.long, device=x.device)
+        n_total = index_map.numel()
+        # scan position of every voxel, n_total (zero) for voxels that are not scanned
+        inverse_map = torch.full((N,), n_total, dtype=torch.long, device=x.device)
+        if voxel_indices:
+            inverse_map[index_map] = torch.arange(n_total, device=x.device)
 
-                patch_flat = patch.reshape(C, -1)[:, sort_idx].T
-                flat_patches.append(patch_flat)
+        x_flat = gather_tokens(x.reshape(B, C, N), index_map, inverse_map, partial=True).transpose(1, 2)
 
-                coords_sorted = coords_patch[sort_idx.long()].long()
-                lin_idx = coords_sorted[:, 0] * H_crop * W_crop + coords_sorted[:, 1] * W_crop + coords_sorted[:, 2]
-                voxel_indices.append(lin_idx)
+        def unpermute(t_flat):
+            out = gather_tokens(t_flat.transpose(1, 2), inverse_map, index_map, partial=True)
+            return out.reshape(B, C, D_crop, H_crop, W_crop)
 
-            if flat_patches:
-                flat_cat = torch.cat(flat_patches, dim=0)
-                idx_cat = torch.cat(voxel_indices, dim=0)
+        return x_flat, unpermute
+
+
+
+
+
+
+    def _get_local_pca_scan_order(self, spatial_shape, origin, device):
+        if self._local_pca_key_map is None or self._local_pca_key_map.device != device:
+            if self._precomputed_local_key_map is not None:
+                self._local_pca_key_map = self._precomputed_local_key_map.to(device)
+            else:
+                self._local_pca_key_map = local_pca_key_map(self.get_pca_reference_shape(), self.local_pca_coords,
+                                                            self.local_pca_vectors, tuple(self.pca_patch_size),
+                                                            device)
+        return LocalPCAScan(self._local_pca_key_map, origin).scan_order(spatial_shape, device, self._scan_order_cache)
+
+    def _get_global_pca_scan_order(self, spatial_shape, device):
+        return self.get_pca_scan().scan_order(spatial_shape, device, self._scan_order_cache)
+
+    def flatten_pruned_scan(self, x):
+        """
+        Token pruning: only the voxels of x inside token_mask (see set_token_mask) are scanned, in the order of the
+        global / local PCA scan. Each input is located in the reference volume like for the local PCA scan
+        (set_scan_origins, center crop otherwise); selections are cached per origin. The sequences of a batch are padded
+        at the end to the same length, the scan is causal so this does not change the selected tokens. unpermute
+        scatters the outputs back, all other voxels keep their input value (identity).
+
+        Args:
+            x: (B, C, D, H, W)
+
+        Returns:
+            x_flat: (B, L, C), L = largest number of selected voxels of the batch (can be 0)
+            unpermute: function mapping (B, L, C) back to (B, C, D, H, W)
+        """
+        B, C, D, H, W = x.shape
+        spatial_shape = (D, H, W)
+        N = D * H * W
+
+        def build(origin):
+            if self.scan_type == 'local_pca':
+                perm = self._get_local_pca_scan_order(spatial_shape, origin, x.device)[0]
             else:
-                flat_cat = torch.zeros((1, C), device=x.device)
-                idx_cat = torch.zeros((1,), dtype=torch.long, device=x.device)
+                perm = self._get_global_pca_scan_order(spatial_shape, x.device)[0]
+            return pruned_scan_order(perm, crop_reference_volume(self.token_mask, origin, spatial_shape, False))
 
-            flat_all.append(flat_cat)
-            index_map_all.append(idx_cat)
+        selections = [self._scan_order_cache.get(
+            ('pruned', self.scan_type, spatial_shape, origin, x.device), lambda origin=origin: build(origin)
+        ) for origin in self._get_reference_origins(B, spatial_shape)]
+        L = max(len(i) for i in selections)
+        logger.debug("[MambaLayer] Token pruning:", lambda: [len(i) for i in selections], "of", N, "voxels scanned")
 
-        x_flat = torch.stack(flat_all)       # (B, N_total, C)
-        index_map = torch.stack(index_map_all)  # (B, N_total)
+        # padded positions point to an extra all zero voxel N, which unpermute drops again
+        index = torch.stack([F.pad(i, (0, L - len(i)), value=N) for i in selections])[:, None].expand(B, C, L)
+        x_ext = F.pad(x.reshape(B, C, N), (0, 1))
+        x_flat = torch.gather(x_ext, 2, index).transpose(1, 2)
 
         def unpermute(t_flat):
-            out = torch.zeros((B, C, D_crop * H_crop * W_crop), device=t_flat.device, dtype=t_flat.dtype)
-            for b in range(B):
-                out[b, :, index_map[b]] = t_flat[b].T
-            return out.reshape(B, C, D_crop, H_crop, W_crop)
+            out = x_ext.scatter(2, index, t_flat.transpose(1, 2).to(x_ext.dtype))
+            return out[:, :, :N].reshape(B, C, D, H, W)
 
         return x_flat, unpermute
 
+    def flatten_local_pca_scan_indexed(self, x):
+        """
+        Local PCA scan of x driven by a precomputed per-volume key map (see local_pca_key_map). The scan order of each
+        input is looked up from its true position in the reference volume (set_scan_origins, center crop otherwise)
+        and cached per origin, so tiles at the same position (sliding window) never recompute it. Flattening is a
+        single gather and unpermute a single inverse gather for the whole batch. Every voxel is scanned.
 
+        Args:
+            x: (B, C, D, H, W)
 
+        Returns:
+            x_flat: (B, D * H * W, C)
+            unpermute: function mapping (B, D * H * W, C) back to (B, C, D, H, W)
+        """
+        B, C, D, H, W = x.shape
+        if self.local_pca_vectors is None or self.local_pca_coords is None:
+            # In first epoch fall back to global x scan as vectors are not set yet
+            return self.flatten_for_scan(x, scan_type='x')
+
+        spatial_shape = (D, H, W)
+        orders = [self._get_local_pca_scan_order(spatial_shape, origin, x.device)
+                  for origin in self._get_reference_origins(B, spatial_shape)]
+
+        if all(o is orders[0] for o in orders):
+            perm, inv = orders[0]
+        else:
+            perm = torch.stack([o[0] for o in orders])
+            inv = torch.stack([o[1] for o in orders])
+        x_flat = gather_tokens(x.reshape(B, C, -1), perm, inv).transpose(1, 2)
 
+        def unpermute(t_flat):
+            return gather_tokens(t_flat.transpose(1, 2), inv, perm).reshape(B, C, D, H, W)
 
+        return x_flat, unpermute
 
     def forward(self, x):
         
@@ -601,29 +763,27 @@ class MambaLayer(nn.Module):
         B, C, D, H, W = x.shape
         assert C == self.dim
 
-        if self.scan_type == 'local_pca':
-            #x_flat, unpermute = self.flatten_local_pca_scan(x)
-            x_flat, unpermute = self.flatten_local_pca_scan_tracked(x, self.local_pca_coords, self.local_pca_vectors, self.pca_patch_size, full_shape=(240, 240, 180))
-
-            use_custom_unpermute = True
+        if self.token_mask is not None and self.scan_type in ('global_pca', 'local_pca') and \
+                (self.scan_type == 'global_pca' or self.local_pca_vectors is not None):
+            x_flat, unpermute = self.flatten_pruned_scan(x)
+            if x_flat.shape[1] == 0:
+                # nothing of the input is inside the mask
+                return x
+        elif self.scan_type == 'local_pca':
+            x_flat, unpermute = self.flatten_local_pca_scan_indexed(x)
         elif self.scan_type == 'global_pca':
             x_flat, unpermute = self.flatten_pca_scan(x, self.global_pca_vector)
-            use_custom_unpermute = False
-        elif self.scan_type in ['x', 'y', 'z', 'diag', 'yz-diag', 'xy-diag']:
+        elif self.scan_type == 'multi_pca':
+            x_flat, unpermute = self.flatten_multi_pca_scan(x)
+        elif self.scan_type in self.axis_scans or self.scan_type == 'learned':
             x_flat, unpermute = self.flatten_for_scan(x, self.scan_type)
-            use_custom_unpermute = False
         else:
             raise ValueError(f"Unknown scan type: {self.scan_type}")
+        if self.token_mask is not None and self.scan_type not in ('global_pca', 'local_pca'):
+            logger.warning("[MambaLayer] Token pruning is only implemented for global_pca and local_pca scans, "
+                           "scanning all voxels", interval=600)
 
-        x_norm = self.norm(x_flat)
-        x_mamba = self.mamba(x_norm)
-        
-        if use_custom_unpermute:
-            return unpermute(x_mamba)
-        else:
-            out = x_mamba.transpose(-1, -2).reshape(B, C, *x.shape[2:]) #! CANNOT change this, otherwise x scan is wrong!!!
-            #out_flat = out.permute(0, 2, 3, 4, 1).reshape(B, D*H*W, C) #! flat for global scan
-            return unpermute(out) #  why does "x" work with flattened and unflattened version???
+        return unpermute(self.mamba(self.norm(x_flat)))
 
 
 
@@ -643,7 +803,9 @@ class BasicResBlock(nn.Module):
             nonlin_kwargs={'inplace': True}
         ):
         super().__init__()
-        
+        self.output_channels = output_channels
+        self.stride = maybe_convert_scalar_to_list(conv_op, stride)
+
         self.conv1 = conv_op(input_channels, output_channels, kernel_size, stride=stride, padding=padding)
         self.norm1 = norm_op(output_channels, **norm_op_kwargs)
         self.act1 = nonlin(**nonlin_kwargs)
@@ -665,7 +827,24 @@ class BasicResBlock(nn.Module):
             x = self.conv3(x)
         y += x
         return self.act2(y)
-    
+
+    def compute_conv_feature_map_size(self, input_size):
+        size_after_stride = [i // j for i, j in zip(input_size, self.stride)]
+        n_convs = 3 if self.conv3 is not None else 2
+        return n_convs * np.prod([self.output_channels, *size_after_stride], dtype=np.int64)
+
+
+def _blocks_feature_map_size(blocks, input_size):
+    # compute_conv_feature_map_size of a sequence of blocks (stem / stage / decoder stage)
+    output = np.int64(0)
+    for block in blocks:
+        output += block.compute_conv_feature_map_size(input_size)
+        stride = getattr(block, 'stride', None)
+        if stride is not None:
+            input_size = [i // j for i, j in zip(input_size, stride)]
+    return output
+
+
 class ResidualMambaEncoder(nn.Module):
     def __init__(self,
                  input_size: Tuple[int, ...],
@@ -817,6 +996,9 @@ class ResidualMambaEncoder(nn.Module):
         #self.dropout_op_kwargs = dropout_op_kwargs
         self.conv_bias = conv_bias
         self.kernel_sizes = kernel_sizes
+        # recompute the full resolution stem (BasicResBlock + MambaLayer) in backward instead of keeping its
+        # activations, see UMambaEnc.set_stem_memory_options
+        self.checkpoint_stem = False
         
         
     def extract_stem_features(self, x):
@@ -826,9 +1008,17 @@ class ResidualMambaEncoder(nn.Module):
             x = conv(x)
         return x  # shape: (B, C, D, H, W)
         
+    def _forward_stem_head(self, x):
+        return self.stem[1](self.stem[0](x))
+
     def forward(self, x):
         if self.stem is not None:
-            x = self.stem(x)
+            if self.checkpoint_stem and torch.is_grad_enabled():
+                x = torch.utils.checkpoint.checkpoint(self._forward_stem_head, x, use_reentrant=False)
+            else:
+                x = self._forward_stem_head(x)
+            for block in self.stem[2:]:
+                x = block(x)
         ret = []
         for s in range(len(self.stages)):
             x = self.stages[s](x)
@@ -839,17 +1029,27 @@ class ResidualMambaEncoder(nn.Module):
 
     def compute_conv_feature_map_size(self, input_size):
         #print("Input size encoder initial", input_size)
+        stem_head = np.int64(0)
         if self.stem is not None:
-            output = self.stem.compute_conv_feature_map_size(input_size)
+            stem_head = _blocks_feature_map_size(self.stem[:2], input_size)
+            if self.checkpoint_stem:
+                # only the output of the checkpointed part is kept
+                output = np.prod([self.output_channels[0], *input_size], dtype=np.int64)
+            else:
+                output = stem_head
+            output += _blocks_feature_map_size(self.stem[2:], input_size)
         else:
             output = np.int64(0)
 
         for s in range(len(self.stages)):
             
-            output += self.stages[s].compute_conv_feature_map_size(input_size)
+            output += _blocks_feature_map_size(self.stages[s], input_size)
             input_size = [i // j for i, j in zip(input_size, self.strides[s])]
             #print("Input size encoder", input_size)
 
+        if self.checkpoint_stem:
+            # the stem is recomputed last in backward, when the activations of all later layers are already freed
+            output = max(output, stem_head)
         return output
 
 
@@ -955,7 +1155,7 @@ class UNetResDecoder(nn.Module):
 
         output = np.int64(0)
         for s in range(len(self.stages)):
-            output += self.stages[s].compute_conv_feature_map_size(skip_sizes[-(s+1)])
+            output += _blocks_feature_map_size(self.stages[s], skip_sizes[-(s+1)])
             output += np.prod([self.encoder.output_channels[-(s+2)], *skip_sizes[-(s+1)]], dtype=np.int64)
             if self.deep_supervision or (s == (len(self.stages) - 1)):
                 output += np.prod([self.num_classes, *skip_sizes[-(s+1)]], dtype=np.int64)
@@ -982,7 +1182,7 @@ class UMambaEnc(nn.Module):
                  nonlin_kwargs: dict = None,
                  deep_supervision: bool = False,
                  stem_channels: int = None,
-                 scan_type: str = 'x', #, 'global_pca', 'local_pca', 'pca', 'x', 'y', 'z', 'diag' (yz-diag, xy-diag, etc. are not implemented yet!
+                 scan_type: str = 'x', #, 'global_pca', 'multi_pca', 'local_pca', 'pca', 'x', 'y', 'z', 'diag' (yz-diag, xy-diag, etc. are not implemented yet!
                  pca_patch_size=None,
                  local_pca_vectors=None,
                  local_pca_coords=None,
@@ -1077,6 +1277,94 @@ class UMambaEnc(nn.Module):
             if isinstance(module, MambaLayer):
                 module.set_pca_patch_size(patch_size)
 
+    def set_pca_reference_shape(self, shape):
+        """
+        Set the shape of the volume the local PCA coords refer to for all MambaLayer modules.
+        """
+        for module in self.modules():
+            if isinstance(module, MambaLayer):
+                module.set_pca_reference_shape(shape)
+
+    def set_token_mask(self, mask):
+        """
+        Enable (mask: (D, H, W) in reference volume space) or disable (None) token pruning in all MambaLayer modules.
+        See MambaLayer.flatten_pruned_scan.
+        """
+        for module in self.modules():
+            if isinstance(module, MambaLayer):
+                module.set_token_mask(mask)
+
+    def set_scan_type(self, scan_type: str):
+        """
+        Switch all MambaLayer modules to scan_type ('x', 'global_pca', 'local_pca', 'multi_pca', ...). The vectors
+        etc. the scan type needs must be set separately.
+        """
+        self.scan_type = scan_type
+        self.encoder.scan_type = scan_type
+        for module in self.modules():
+            if isinstance(module, MambaLayer):
+                module.scan_type = scan_type
+
+    def set_learned_scan(self, scan):
+        """
+        Scan all MambaLayer modules along scan (a compiled scan path, see ScanPlan / scan_paths). This also switches
+        them to scan type 'learned': the path is the whole scan, and for inference the network is rebuilt with the
+        default scan type before the plan is applied.
+        """
+        self.scan_type = 'learned'
+        for module in self.modules():
+            if isinstance(module, MambaLayer):
+                module.set_learned_scan(scan)
+                module.scan_type = 'learned'
+
+    def set_precomputed_scan_orders(self, global_vector_key=None, global_orders=None, local_key_map=None):
+        """
+        Hand scan orders computed ahead of time (see ScanPlan) to all MambaLayer modules.
+        """
+        for module in self.modules():
+            if isinstance(module, MambaLayer):
+                module.set_precomputed_scan_orders(global_vector_key, global_orders, local_key_map)
+
+    def set_scan_origins(self, origins, volume_shapes=None):
+        """
+        Set the position of the next input batch in its case(s) for all MambaLayer modules. The stem runs at full
+        resolution so origins are in voxels of the input. See MambaLayer.set_scan_origins.
+        """
+        for module in self.modules():
+            if isinstance(module, MambaLayer):
+                module.set_scan_origins(origins, volume_shapes)
+
+    def clear_scan_origins(self):
+        for module in self.modules():
+            if isinstance(module, MambaLayer):
+                module.clear_scan_origins()
+
+    def compute_mamba_feature_map_size(self, input_size, scan_states: bool = None):
+        """
+        The part of compute_conv_feature_map_size that comes from the (full resolution) stem MambaLayer, see
+        MambaLayer.compute_conv_feature_map_size.
+        """
+        return sum(m.compute_conv_feature_map_size(input_size, scan_states) for m in self.encoder.stem.modules()
+                   if isinstance(m, MambaLayer))
+
+    def scan_buffer_bytes(self, input_size):
+        return sum(m.scan_buffer_bytes(input_size) for m in self.encoder.stem.modules() if isinstance(m, MambaLayer))
+
+    def set_stem_memory_options(self, checkpoint_stem: bool = False, sequence_chunk_size: int = None):
+        """
+        Bound the training memory of the full resolution stem:
+
+        - checkpoint_stem: activation checkpointing of the stem's BasicResBlock + MambaLayer
+        - sequence_chunk_size: the stem Mamba processes its sequence in checkpointed chunks of this many tokens that
+          carry the scan state over (torch backend only, see MambaLayer.set_sequence_chunk_size)
+
+        Both are taken into account by compute_conv_feature_map_size.
+        """
+        self.encoder.checkpoint_stem = checkpoint_stem
+        for module in self.encoder.stem.modules():
+            if isinstance(module, MambaLayer):
+                module.set_sequence_chunk_size(sequence_chunk_size)
+
 
     def forward(self, x):
         skips = self.encoder(x)
@@ -1164,7 +1452,7 @@ def get_umamba_first_3d_from_plans(
     for module in model.modules():
         if isinstance(module, MambaLayer):
             module.scan_type = scan_type
-            if scan_type == 'global_pca' and global_pca_vector is not None:
+            if scan_type in ('global_pca', 'multi_pca') and global_pca_vector is not None:
                 module.set_global_pca_vectors(global_pca_vector)
     
     # Set PCA patch size if provided
@@ -1175,12 +1463,161 @@ def get_umamba_first_3d_from_plans(
 
     # Save the model configuration to output folder if specified
     if output_folder is not None:
-        print(f"Saving model configuration to {output_folder}")
+        logger.info("Saving model configuration to", output_folder)
     
     # print scan type and PCA vectors
-    print(f"Scan type set to: {scan_type}")
+    logger.info("Scan type set to:", scan_type)
         
     
 
 
     return model
+
+
+if __name__ == '__main__':
+    # parity check of the key map based local PCA scan against the per-patch reference implementation. For crops that
+    # are aligned to the patch grid and fully covered by patches both must visit the same patches in the same order and
+    # within every patch the voxels in the order of their projection. The reference sorts with an unstable argsort on
+    # projections of crop coordinates, the key map projects reference volume coordinates, so the order of voxels whose
+    # projections tie (up to float rounding) is not defined by the reference and may differ
+    torch.manual_seed(1234)
+    full_shape = (64, 56, 48)
+    patch_size = (8, 8, 8)
+    layer = MambaLayer(dim=4, scan_type='local_pca')
+    coords = torch.stack(torch.meshgrid(*[torch.arange(0, f - p + 1, p) for f, p in zip(full_shape, patch_size)],
+                                        indexing='ij'), dim=-1).reshape(-1, 3)
+    vectors = F.normalize(torch.randn(coords.shape[0], 3), dim=1)
+    layer.set_local_pca_vectors(vectors, coords)
+    layer.set_pca_patch_size(patch_size)
+    layer.set_pca_reference_shape(full_shape)
+
+    x = torch.randn(2, 4, 48, 40, 32)
+    ref_flat, ref_unpermute = MambaLayer.flatten_local_pca_scan_tracked(x, coords, vectors, patch_size, full_shape)
+    new_flat, new_unpermute = layer.flatten_local_pca_scan_indexed(x)
+    assert ref_flat.shape == new_flat.shape, 'flatten shape mismatch'
+    assert torch.equal(ref_unpermute(ref_flat), new_unpermute(new_flat)), 'unpermute mismatch'
+    # scan both implementations over the linear voxel indices, then compare patch and projection of every position
+    crop_shape = x.shape[2:]
+    voxel_ids = torch.arange(int(np.prod(crop_shape))).float().reshape(1, 1, *crop_shape)
+    ref_ids = MambaLayer.flatten_local_pca_scan_tracked(voxel_ids, coords, vectors, patch_size, full_shape)[0][0, :, 0]
+    new_ids = layer.flatten_local_pca_scan_indexed(voxel_ids)[0][0, :, 0]
+    crop_origin = torch.tensor([(f - c) // 2 for f, c in zip(full_shape, crop_shape)])
+    crop_coords = torch.stack(torch.meshgrid(*[torch.arange(i) for i in crop_shape], indexing='ij'), -1).reshape(-1, 3)
+    patch_of = ((crop_coords + crop_origin) // torch.tensor(patch_size) * torch.tensor(patch_size))
+    patch_index = {tuple(c.tolist()): i for i, c in enumerate(coords)}
+    patch_of = torch.tensor([patch_index[tuple(c)] for c in patch_of.tolist()])
+    projections = (crop_coords.float() * vectors[patch_of]).sum(1)
+    ref_ids, new_ids = ref_ids.long(), new_ids.long()
+    assert torch.equal(patch_of[ref_ids], patch_of[new_ids]), 'flatten mismatch: patch order'
+    assert torch.allclose(projections[ref_ids], projections[new_ids], atol=1e-4), 'flatten mismatch: voxel order'
+    print('local PCA scan parity ok, positions that differ only by tied voxels:', int((ref_ids != new_ids).sum()))
+
+    # samples at different positions of a smaller case: each sample must be scanned like a single center crop at the
+    # same reference position, and unpermute must be the exact inverse
+    case_shape = np.array([56, 48, 40])
+    origins = np.array([[-4, 0, 4], [8, 8, 8]])
+    layer.set_scan_origins(origins, [case_shape] * 2)
+    new_flat, new_unpermute = layer.flatten_local_pca_scan_indexed(x)
+    assert torch.equal(new_unpermute(new_flat), x), 'unpermute is not the inverse'
+    for b, o in enumerate(origins + (np.array(full_shape) - case_shape) // 2):
+        layer.set_scan_origins(o[None])
+        assert torch.equal(layer.flatten_local_pca_scan_indexed(x[b:b + 1])[0], new_flat[b:b + 1]), 'batch mismatch'
+    print('local PCA scan parity ok, tokens:', new_flat.shape[1])
+
+    # multi_pca (all vectors, forward and reverse, stacked into one Mamba call) must equal the average of the single
+    # vector scans run one by one
+    layer = MambaLayer(dim=4, scan_type='multi_pca').eval()
+    vectors = F.normalize(torch.randn(2, 3), dim=1)
+    layer.set_global_pca_vectors(vectors)
+    x = torch.randn(2, 4, 12, 10, 8)
+    with torch.no_grad():
+        reference = 0
+        for v in vectors:
+            x_flat, unpermute = layer.flatten_pca_scan(x, v)
+            for reverse in (False, True):
+                y = layer.mamba(layer.norm(x_flat.flip(1) if reverse else x_flat))
+                y = y.flip(1) if reverse else y
+                reference = reference + unpermute(y)
+        assert torch.allclose(layer(x), reference / 4, atol=1e-6), 'multi_pca mismatch'
+    print('multi PCA scan parity ok, sequences per input:', 2 * len(vectors))
+
+    # token pruning: voxels outside the mask are passed through, the others must get what a Mamba scan over only the
+    # selected voxels (in global PCA order) returns. The second sample selects fewer voxels, padding must not matter
+    layer = MambaLayer(dim=4, scan_type='global_pca').eval()
+    layer.set_global_pca_vectors(torch.tensor([0.2, 0.9, 0.4]))
+    layer.set_pca_reference_shape((24, 20, 16))
+    token_mask = torch.zeros((24, 20, 16), dtype=torch.bool)
+    token_mask[6:18, 4:16, 2:12] = True
+    layer.set_token_mask(token_mask)
+    origins = [(4, 2, 0), (12, 10, 6)]
+    layer.set_scan_origins(origins)
+    x = torch.randn(2, 4, 12, 10, 8)
+    with torch.no_grad():
+        out = layer(x)
+        perm = layer._get_global_pca_scan_order((12, 10, 8), x.device)[0]
+        for b, o in enumerate(origins):
+            m = crop_reference_volume(token_mask, o, (12, 10, 8), False)
+            assert torch.equal(out[b][:, ~m], x[b][:, ~m]), 'pruned voxels changed'
+            selected = pruned_scan_order(perm, m)
+            y = layer.mamba(layer.norm(x[b].reshape(4, -1)[:, selected].T[None]))[0].T
+            assert torch.allclose(out[b].reshape(4, -1)[:, selected], y, atol=1e-6), 'pruned scan mismatch'
+    print('token pruning parity ok, scanned voxels:', [int(crop_reference_volume(token_mask, o, (12, 10, 8),
+                                                                              False).sum()) for o in origins])
+
+    # learned scan: a scan plan compiled from a mask prior must survive the checkpoint round trip and the layer must
+    # scan exactly along the stored permutation
+    from nnunetv2.utilities.scan_plan import ScanPlan
+    prior = np.zeros((24, 20, 16), dtype=np.uint8)
+    prior[4:20, 8:12, 6:10] = 1
+    plan = ScanPlan.build(prior, 'learned', scan_path='pca_hilbert')
+    plan.precompute_scan_orders([(12, 10, 8)])
+    plan = ScanPlan.from_state_dict(plan.state_dict())
+    layer = MambaLayer(dim=4, scan_type='global_pca').eval()
+    layer.set_learned_scan(mamba_layer.LearnedScan(plan.scan_path_orders, name=plan.scan_path))
+    layer.scan_type = 'learned'
+    x = torch.randn(2, 4, 12, 10, 8)
+    with torch.no_grad():
+        perm = torch.from_numpy(plan.scan_path_orders[(12, 10, 8)]).long()
+        y = layer.mamba(layer.norm(x.reshape(2, 4, -1)[:, :, perm].transpose(1, 2))).transpose(1, 2)
+        reference = torch.empty_like(y)
+        reference[:, :, perm] = y
+        assert torch.equal(layer(x), reference.reshape(x.shape)), 'learned scan mismatch'
+    print('learned scan parity ok, scan path:', plan.scan_path, 'prior vector:', plan.global_vector.tolist())
+
+    # scan plans switch the scan type: a network built with the default 'x' scan (like the predictor builds it) must,
+    # once the plan is applied, be identical to one built with the plan's scan type
+    def build_network(scan_type):
+        return UMambaEnc((12, 10, 8), 1, 2, [4, 8], nn.Conv3d, [[3, 3, 3]] * 2, [[1, 1, 1], [2, 2, 2]], 1, 2, 1,
+                         conv_bias=True, norm_op=nn.InstanceNorm3d, norm_op_kwargs={'eps': 1e-5, 'affine': True},
+                         nonlin=nn.LeakyReLU, nonlin_kwargs={'inplace': True}, scan_type=scan_type).eval()
+
+    x = torch.randn(2, 1, 12, 10, 8)
+    for scan_type in ('global_pca', 'local_pca', 'multi_pca'):
+        plan = ScanPlan.build(prior, scan_type, patch_size=(4, 4, 4), n_components=2)
+        plan.precompute_scan_orders([(12, 10, 8)])
+        default_network, reference_network = build_network('x'), build_network(scan_type)
+        reference_network.load_state_dict(default_network.state_dict())
+        with torch.no_grad():
+            x_scan = default_network(x)
+            plan.apply(default_network)
+            plan.apply(reference_network)
+            assert all(m.scan_type == scan_type for m in default_network.modules() if isinstance(m, MambaLayer))
+            assert torch.equal(default_network(x), reference_network(x)), f'{scan_type} plan not applied'
+            assert not torch.allclose(default_network(x), x_scan), f'{scan_type} plan scans like x'
+    print('scan plans switch the scan type ok')
+
+    # token pruning through the predictor: the plan must switch the 'x' network to the pruned scan, so that the Mamba
+    # layers see fewer tokens than the tile has voxels
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    plan = ScanPlan.build(prior, 'global_pca', token_mask_dilation=1)
+    plan.precompute_scan_orders([(12, 10, 8)])
+    predictor = nnUNetPredictor(device=torch.device('cpu'))
+    predictor.network = build_network('x')
+    predictor._maybe_apply_scan_plan(plan)
+    stem_layer = [m for m in predictor.network.encoder.stem.modules() if isinstance(m, MambaLayer)][0]
+    scanned = []
+    stem_layer.mamba.register_forward_hook(lambda module, args, out: scanned.append(args[0].shape[1]))
+    with torch.no_grad():
+        predictor.network(torch.randn(1, 1, 12, 10, 8))
+    assert 0 < scanned[0] < 12 * 10 * 8, f'pruned plan scanned {scanned[0]} tokens'
+    print('token pruning in the predictor ok, scanned tokens:', scanned[0], 'of', 12 * 10 * 8)
@@ -16,12 +16,16 @@ from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager
 from dynamic_network_architectures.building_blocks.helper import get_matching_instancenorm, convert_dim_to_conv_op
 from dynamic_network_architectures.initialization.weight_init import init_last_bn_before_add_to_0
 from nnunetv2.utilities.network_initialization import InitWeights_He
-from mamba_ssm import Mamba
+from nnunetv2.nets.mamba_layer import MambaLayer
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
 from dynamic_network_architectures.building_blocks.helper import maybe_convert_scalar_to_list, get_matching_pool_op
 from torch.cuda.amp import autocast
 from dynamic_network_architectures.building_blocks.residual import BasicBlockD
 from nnunetv2.utilities.pca_utils import extract_patches_and_origins, reassemble_patches
 
+# per-step messages are DEBUG, see nnunetv2/utilities/mamba_logging.py
+logger = get_mamba_logger('UMambaFirst_patch16', interval=10)
+
 
 
 class UpsampleLayer(nn.Module):
@@ -43,142 +47,6 @@ class UpsampleLayer(nn.Module):
         x = self.conv(x)
         return x
 
-class MambaLayer(nn.Module):
-    def __init__(self, dim, d_state=16, d_conv=4, expand=2, scan_type='x'):
-        super().__init__()
-        self.dim = dim
-        self.norm = nn.LayerNorm(dim)
-        self.mamba = Mamba(
-            d_model=dim,
-            d_state=d_state, 
-            d_conv=d_conv, 
-            expand=expand)
-        self.local_pca_vectors = None
-        self.local_pca_coords = None
-        self.scan_type = scan_type
-        self.register_buffer('principal_vector', torch.zeros(3), persistent=True)
-
-    def set_local_pca_vectors(self, vectors, coords):
-        # Ensure both are torch tensors
-        if isinstance(vectors, np.ndarray):
-            vectors = torch.from_numpy(vectors)
-        if isinstance(coords, np.ndarray):
-            coords = torch.from_numpy(coords)
-        self.local_pca_vectors = vectors
-        self.local_pca_coords = coords.long()
-
-    def get_patch_index(self, patch_origin):
-        print("Patch origin:", patch_origin)
-        arr = torch.tensor(patch_origin, dtype=torch.long)
-        if self.local_pca_coords is None:
-            print("[MambaLayer] No local PCA coordinates set. Returning None.")
-            return None
-        # Ensure coords are also long/int
-        coords = self.local_pca_coords
-        if coords.dtype != torch.long:
-            coords = coords.long()
-        matches = torch.all(coords == arr, dim=1)
-        idx = torch.where(matches)[0]
-        return idx[0].item() if len(idx) > 0 else None
-
-    def get_local_pca_vector(self, patch_origin):
-        idx = self.get_patch_index(patch_origin)
-        print("Index of patch origin:", idx)
-        if idx is not None:
-            return self.local_pca_vectors[idx]
-        else:
-            return self.principal_vector
-
-    def set_scan_vector(self, vector):
-        if isinstance(vector, np.ndarray):
-            vector = torch.from_numpy(vector) if isinstance(vector, np.ndarray) else vector
-        self.principal_vector.copy_(vector.to(self.principal_vector.device, dtype=self.principal_vector.dtype))
-
-    def flatten_for_scan(self, x, scan_type='pca', patch_origin=None):
-        B, C, D, H, W = x.shape
-        if scan_type == 'pca':
-            #print("[MambaLayer] Using PCA scan type.")
-            #print("TRYING TO GET LOCAL PCA, failing afterwards ")
-            vector = self.get_local_pca_vector(patch_origin) if patch_origin else self.principal_vector
-            #print("made it")
-            return self.flatten_pca_scan(x, vector)
-
-        permute, unpermute = {
-            'x':  ((0, 1, 4, 3, 2), lambda t: t.reshape(B, C, W, H, D).permute(0, 1, 4, 3, 2)),
-            'y':  ((0, 1, 3, 4, 2), lambda t: t.reshape(B, C, H, W, D).permute(0, 1, 4, 2, 3)),
-            'z':  (None, lambda t: t.transpose(-1, -2).reshape(B, C, D, H, W)),
-        }[scan_type]
-        
-        x_perm = x.permute(*permute) if permute else x
-        x_flat = x_perm.reshape(B, C, -1).transpose(-1, -2)
-        return x_flat, unpermute
-
-    def flatten_pca_scan(self, x, principal_vector):
-        # ! : INCLUDE LOGIC HERE TO FALL BACK TO x!! 
-        """
-        Flattens the input tensor x using the given principal_vector.
-        Input:
-            x: (B, C, D, H, W) tensor
-            principal_vector: (3,) numpy or torch array (should be unit vector)
-        Output:
-            x_flat: (B, N, C) tensor, where N = D*H*W
-            indices: list of sorted indices for each batch
-        """
-        if principal_vector is None:
-            print("[MambaLayer] Principal vector is None. Skipping PCA flatten.")
-            return None, None
-        
-        B, C, D, H, W = x.shape
-        device = x.device
-        zz, yy, xx = torch.meshgrid(
-            torch.arange(D, device=device),
-            torch.arange(H, device=device),
-            torch.arange(W, device=device),
-            indexing='ij'
-        )
-        coords = torch.stack([zz, yy, xx], dim=-1).reshape(-1, 3).float()
-        # Project coordinates onto principal vector
-        if isinstance(principal_vector, np.ndarray):
-            principal_vector = torch.from_numpy(principal_vector).to(device, dtype=torch.float32)
-        else: 
-            principal_vector = principal_vector.to(device, dtype=torch.float32)
-        # : Forse qua niente matmul, ma dot product??? Gets messed up here? 
-        projections = torch.matmul(coords, principal_vector)
-        sorted_idx = torch.argsort(projections)
-
-        x_flat_list = [x[b].reshape(C, -1)[:, sorted_idx].T for b in range(B)]
-        x_flat = torch.stack(x_flat_list)
-
-        def unpermute(t):
-            out = torch.zeros((B, D*H*W, C), device=t.device,  dtype=t.dtype)
-            for b in range(B):
-                out[b, sorted_idx] = t[b]
-            return out.permute(0, 2, 1).reshape(B, C, D, H, W)
-
-        return x_flat, unpermute
-
-    def forward(self, x):
-        if x.dtype in [torch.float16, torch.bfloat16]:
-            x = x.float()
-        B, C = x.shape[:2]
-        assert C == self.dim
-        
-        if self.scan_type == 'pca':
-            if not torch.any(self.principal_vector):
-                print("[MambaLayer] No principal vector. Falling back to 'x'.")
-                x_flat, unpermute = self.flatten_for_scan(x, 'x')
-                #print("x_flat shape:", x_flat.shape)
-                
-            else:
-                x_flat, unpermute = self.flatten_pca_scan(x, self.principal_vector)
-        else:
-            x_flat, unpermute = self.flatten_for_scan(x, self.scan_type)
-
-        x_norm = self.norm(x_flat)
-        x_mamba = self.mamba(x_norm)
-        out = x_mamba.transpose(-1, -2).reshape(B, C, *x.shape[2:])
-        return unpermute(out)
-
 class BasicResBlock(nn.Module):
     def __init__(
             self,
@@ -394,7 +262,7 @@ class ResidualMambaEncoder(nn.Module):
                     x_flat, unpermute = mamba.flatten_pca_scan(patch, principal_vector)
                 
                 else:
-                    print("[ResidualMambaEncoder] Falling back to 'x' scan path.")
+                    logger.debug("[ResidualMambaEncoder] Falling back to 'x' scan path.")
                     x_flat, unpermute = mamba.flatten_for_scan(patch, scan_type='x')
                 x_norm = mamba.norm(x_flat)
                 x_mamba = mamba.mamba(x_norm)
@@ -674,7 +542,7 @@ def get_umamba_first_3d_from_plans(
         if os.path.isfile(vec_path) and os.path.isfile(coord_path):
             vectors = np.load(vec_path)
             coords = np.load(coord_path)
-            print(f"[Network] Loaded {len(vectors)} local PCA vectors and {len(coords)} coords.")
+            logger.info("[Network] Loaded", len(vectors), "local PCA vectors and", len(coords), "coords.")
 
             # Ensure correct types
             vectors = torch.from_numpy(vectors).float()
@@ -683,9 +551,9 @@ def get_umamba_first_3d_from_plans(
             for module in model.modules():
                 if hasattr(module, "set_local_pca_vectors"):
                     module.set_local_pca_vectors(vectors, coords)
-                    print(f"[Network] Set local PCA vectors for module: {module.__class__.__name__}")
+                    logger.info("[Network] Set local PCA vectors for module:", module.__class__.__name__)
         else:
-            print("[Network] No PCA vector/coord files found. Skipping injection.")
+            logger.info("[Network] No PCA vector/coord files found. Skipping injection.")
 
 
     return model
@@ -0,0 +1,289 @@
+import math
+import os
+from typing import Callable, Dict
+
+import torch
+import torch.utils.checkpoint
+from torch import nn
+from torch.nn import functional as F
+
+# Implementation behind the Mamba blocks of all networks in nnunetv2/nets:
+# - mamba_ssm: the CUDA kernels of the mamba_ssm package (fast, GPU only)
+# - torch: TorchMamba below, plain PyTorch (CPU nodes, CI, debugging). Same parameters and state dict keys
+# - auto (default): mamba_ssm if it can be imported and a GPU is available, torch otherwise
+# Set via environment variable, e.g. nnUNet_mamba_backend=torch. The backend only matters when a network is built,
+# checkpoints can be loaded with either of them.
+default_mamba_backend = os.environ.get('nnUNet_mamba_backend', 'auto').lower()
+
+_MAMBA_BACKENDS: Dict[str, Callable[[], type]] = {}
+
+
+def register_mamba_backend(name: str, loader: Callable[[], type]) -> None:
+    """
+    loader returns the module class. It is only called when the backend is used, so backends can import optional
+    dependencies in there. The class must accept mamba_ssm.Mamba's constructor arguments and map (B, L, C) -> (B, L, C).
+    """
+    _MAMBA_BACKENDS[name.lower()] = loader
+
+
+def available_mamba_backends():
+    return sorted(_MAMBA_BACKENDS.keys())
+
+
+def _load_mamba_ssm() -> type:
+    from mamba_ssm import Mamba as MambaSSM
+    return MambaSSM
+
+
+def _mamba_ssm_usable() -> bool:
+    if not torch.cuda.is_available():
+        return False
+    try:
+        _load_mamba_ssm()
+    except ImportError:
+        return False
+    return True
+
+
+def resolve_mamba_backend(backend: str = None) -> str:
+    backend = (default_mamba_backend if backend is None else backend).lower()
+    if backend == 'auto':
+        return 'mamba_ssm' if _mamba_ssm_usable() else 'torch'
+    if backend not in _MAMBA_BACKENDS:
+        raise ValueError(f'Unknown mamba backend {backend}. Available: {available_mamba_backends()} and auto')
+    return backend
+
+
+def get_mamba_class(backend: str = None) -> type:
+    return _MAMBA_BACKENDS[resolve_mamba_backend(backend)]()
+
+
+def Mamba(*args, backend: str = None, **kwargs) -> nn.Module:
+    """
+    Drop-in replacement for mamba_ssm.Mamba that builds the block with the selected backend (default:
+    nnUNet_mamba_backend, see above).
+    """
+    return get_mamba_class(backend)(*args, **kwargs)
+
+
+def _linear_recurrence(a: torch.Tensor, u: torch.Tensor, h0: torch.Tensor, chunk_size: int) -> torch.Tensor:
+    """
+    h_t = a_t * h_{t-1} + u_t for all t, with h_{-1} = h0.
+
+    a, u: (L, *S), h0: (*S). Returns h: (L, *S). Time is the leading dimension so that the states of one step are
+    contiguous.
+
+    The sequence is split into chunks of chunk_size. All chunks are scanned in parallel (chunk_size sequential steps on
+    (L / chunk_size, *S) tensors), which gives the states within each chunk assuming zero state at its start. The true
+    states entering the chunks are a recurrence of the same form over L / chunk_size elements, solved by recursion, and
+    are added back with the cumulative decay within the chunk. Only products of a (in [0, 1]) are used, so this is as
+    stable as the sequential scan.
+    """
+    # without autograd the steps are written in place (out=), which saves a copy per step
+    inplace = not (torch.is_grad_enabled() and (a.requires_grad or u.requires_grad or h0.requires_grad))
+    l = u.shape[0]
+    if l <= chunk_size:
+        h = torch.empty_like(u)
+        prev = h0
+        for t in range(l):
+            if inplace:
+                prev = torch.addcmul(u[t], a[t], prev, out=h[t])
+            else:
+                prev = a[t] * prev + u[t]
+                h[t] = prev
+        return h
+
+    n_chunks = math.ceil(l / chunk_size)
+    pad = n_chunks * chunk_size - l
+    if pad > 0:
+        a = torch.cat((a, a.new_ones((pad, *a.shape[1:]))))
+        u = torch.cat((u, u.new_zeros((pad, *u.shape[1:]))))
+    a = a.view(n_chunks, chunk_size, *a.shape[1:])
+    u = u.view(n_chunks, chunk_size, *u.shape[1:])
+
+    h = torch.empty_like(u)
+    decay = torch.empty_like(a)
+    h[:, 0] = u[:, 0]
+    decay[:, 0] = a[:, 0]
+    h_prev, decay_prev = u[:, 0], a[:, 0]
+    for t in range(1, chunk_size):
+        if inplace:
+            torch.addcmul(u[:, t], a[:, t], h[:, t - 1], out=h[:, t])
+            torch.mul(a[:, t], decay[:, t - 1], out=decay[:, t])
+        else:
+            h_prev = a[:, t] * h_prev + u[:, t]
+            decay_prev = a[:, t] * decay_prev
+            h[:, t] = h_prev
+            decay[:, t] = decay_prev
+
+    # state at the end of each chunk, then the state entering each chunk
+    ends = _linear_recurrence(decay[:, -1], h[:, -1], h0, chunk_size)
+    starts = torch.cat((h0[None], ends[:-1]))[:, None]
+    if inplace:
+        h.addcmul_(decay, starts)
+    else:
+        h = h + decay * starts
+    return h.view(n_chunks * chunk_size, *h.shape[2:])[:l]
+
+
+def selective_scan(u: torch.Tensor, delta: torch.Tensor, A: torch.Tensor, B: torch.Tensor, C: torch.Tensor,
+                   D: torch.Tensor = None, z: torch.Tensor = None, delta_bias: torch.Tensor = None,
+                   delta_softplus: bool = False, return_last_state: bool = False, initial_state: torch.Tensor = None,
+                   chunk_size: int = 16, max_block_elements: int = 2 ** 21):
+    """
+    Plain PyTorch version of mamba_ssm.ops.selective_scan_interface.selective_scan_fn (same arguments and semantics,
+    real valued, B and C input dependent). initial_state continues a scan from the last state of a previous call.
+
+    u, delta, z: (b, d, l), A: (d, n), B, C: (b, n, l), D, delta_bias: (d,), initial_state: (b, d, n).
+    Returns y (b, d, l) or (y, last_state) if return_last_state.
+
+    The hidden states (l, b, n, d) are never materialized for the whole sequence: the sequence is processed in blocks
+    of at most max_block_elements state elements, carrying the last state over. Within a block the recurrence is solved
+    with _linear_recurrence.
+    """
+    dtype_in = u.dtype
+    u, delta, A, B, C = u.float(), delta.float(), A.float(), B.float(), C.float()
+    b, d, l = u.shape
+    n = A.shape[1]
+
+    block_size = max(chunk_size, max_block_elements // (b * d * n) // chunk_size * chunk_size)
+    h = u.new_zeros((b, n, d)) if initial_state is None else initial_state.float().transpose(1, 2)
+    y = []
+    for start in range(0, l, block_size):
+        end = min(start + block_size, l)
+        delta_blk = delta[:, :, start:end]
+        if delta_bias is not None:
+            delta_blk = delta_blk + delta_bias.float()[:, None]
+        if delta_softplus:
+            delta_blk = F.softplus(delta_blk)
+        u_blk = u[:, :, start:end]
+        # time leading, d innermost (longest vectorized dimension): (l, b, n, d)
+        a = torch.exp(delta_blk.permute(2, 0, 1).contiguous()[:, :, None] * A.t())
+        bu = (delta_blk * u_blk).permute(2, 0, 1).contiguous()[:, :, None] * \
+            B[:, :, start:end].permute(2, 0, 1).contiguous()[..., None]
+        states = _linear_recurrence(a, bu, h, chunk_size)
+        h = states[-1]
+        y_blk = torch.einsum('lbnd,lbn->bdl', states, C[:, :, start:end].permute(2, 0, 1))
+        if D is not None:
+            y_blk = y_blk + u_blk * D.float()[:, None]
+        if z is not None:
+            y_blk = y_blk * F.silu(z[:, :, start:end].float())
+        y.append(y_blk.to(dtype_in))
+    y = torch.cat(y, dim=2)
+    return (y, h.transpose(1, 2)) if return_last_state else y
+
+
+class TorchMamba(nn.Module):
+    """
+    Plain PyTorch Mamba block. Parameters, their initialization and state dict keys are those of
+    mamba_ssm.modules.mamba_simple.Mamba, so weights can be moved between the two. Decoding (inference_params) is not
+    supported. chunk_size and block_size only affect speed and memory, see selective_scan and forward.
+
+    With checkpoint_blocks, every block of the forward runs under activation checkpointing while gradients are
+    required: only the scan state and the conv context carried between blocks are kept for backward, the
+    intermediates of a block are recomputed. Training memory then no longer grows with the expanded inner dimension
+    times the sequence length.
+    """
+    def __init__(self, d_model, d_state=16, d_conv=4, expand=2, dt_rank="auto", dt_min=0.001, dt_max=0.1,
+                 dt_init="random", dt_scale=1.0, dt_init_floor=1e-4, conv_bias=True, bias=False, use_fast_path=True,
+                 layer_idx=None, device=None, dtype=None, chunk_size: int = 16, block_size: int = None,
+                 checkpoint_blocks: bool = False):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        self.d_model = d_model
+        self.d_state = d_state
+        self.d_conv = d_conv
+        self.expand = expand
+        self.d_inner = int(self.expand * self.d_model)
+        self.dt_rank = math.ceil(self.d_model / 16) if dt_rank == "auto" else dt_rank
+        self.layer_idx = layer_idx
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.checkpoint_blocks = checkpoint_blocks
+
+        self.in_proj = nn.Linear(self.d_model, self.d_inner * 2, bias=bias, **factory_kwargs)
+        self.conv1d = nn.Conv1d(in_channels=self.d_inner, out_channels=self.d_inner, bias=conv_bias,
+                                kernel_size=d_conv, groups=self.d_inner, padding=d_conv - 1, **factory_kwargs)
+        self.activation = "silu"
+        self.act = nn.SiLU()
+        self.x_proj = nn.Linear(self.d_inner, self.dt_rank + self.d_state * 2, bias=False, **factory_kwargs)
+        self.dt_proj = nn.Linear(self.dt_rank, self.d_inner, bias=True, **factory_kwargs)
+
+        # Initialize special dt projection to preserve variance at initialization
+        dt_init_std = self.dt_rank ** -0.5 * dt_scale
+        if dt_init == "constant":
+            nn.init.constant_(self.dt_proj.weight, dt_init_std)
+        elif dt_init == "random":
+            nn.init.uniform_(self.dt_proj.weight, -dt_init_std, dt_init_std)
+        else:
+            raise NotImplementedError
+
+        # Initialize dt bias so that F.softplus(dt_bias) is between dt_min and dt_max
+        dt = torch.exp(
+            torch.rand(self.d_inner, **factory_kwargs) * (math.log(dt_max) - math.log(dt_min)) + math.log(dt_min)
+        ).clamp(min=dt_init_floor)
+        # Inverse of softplus: https://github.com/pytorch/pytorch/issues/72759
+        inv_dt = dt + torch.log(-torch.expm1(-dt))
+        with torch.no_grad():
+            self.dt_proj.bias.copy_(inv_dt)
+        self.dt_proj.bias._no_reinit = True
+
+        # S4D real initialization
+        A = torch.arange(1, self.d_state + 1, dtype=torch.float32, device=device)[None].repeat(self.d_inner, 1)
+        self.A_log = nn.Parameter(torch.log(A))
+        self.A_log._no_weight_decay = True
+
+        # D "skip" parameter
+        self.D = nn.Parameter(torch.ones(self.d_inner, device=device))
+        self.D._no_weight_decay = True
+
+        self.out_proj = nn.Linear(self.d_inner, self.d_model, bias=bias, **factory_kwargs)
+
+    def forward(self, hidden_states: torch.Tensor, inference_params=None) -> torch.Tensor:
+        """
+        hidden_states: (B, L, D). Returns the same shape
+
+        The sequence is processed in blocks of block_size tokens, carrying the scan state and the d_conv - 1 tokens of
+        causal conv context over. This keeps the memory of the intermediates (several times the size of hidden_states
+        at full length) bounded. The default (scan states of a block have 2 ** 21 elements, 8 MB) keeps the scan of a
+        block in the CPU cache, which is about twice as fast as larger blocks.
+        """
+        if inference_params is not None:
+            raise NotImplementedError('TorchMamba does not support step-wise decoding')
+        b, seqlen, _ = hidden_states.shape
+        block_size = self.block_size if self.block_size is not None else \
+            max(self.chunk_size, 2 ** 21 // (b * self.d_inner * self.d_state))
+        checkpoint_blocks = self.checkpoint_blocks and torch.is_grad_enabled()
+
+        out = []
+        state = None
+        for start in range(0, seqlen, block_size):
+            end = min(start + block_size, seqlen)
+            context = min(start, self.d_conv - 1)
+            if checkpoint_blocks:
+                y, state = torch.utils.checkpoint.checkpoint(self._forward_block, hidden_states[:, start - context:end],
+                                                             context, state, use_reentrant=False)
+            else:
+                y, state = self._forward_block(hidden_states[:, start - context:end], context, state)
+            out.append(y)
+        return torch.cat(out, dim=1)
+
+    def _forward_block(self, hidden_states: torch.Tensor, context: int, state: torch.Tensor):
+        # hidden_states: (B, context + block length, D), the first context tokens only feed the causal conv
+        xz = self.in_proj(hidden_states).transpose(1, 2)
+        x, z = xz.chunk(2, dim=1)
+        x = self.act(self.conv1d(x)[..., context:hidden_states.shape[1]])
+        z = z[..., context:]
+
+        x_dbl = self.x_proj(x.transpose(1, 2))
+        dt, B, C = torch.split(x_dbl, [self.dt_rank, self.d_state, self.d_state], dim=-1)
+        dt = (dt @ self.dt_proj.weight.t()).transpose(1, 2)
+
+        y, state = selective_scan(x, dt, -torch.exp(self.A_log.float()), B.transpose(1, 2), C.transpose(1, 2),
+                                  self.D.float(), z=z, delta_bias=self.dt_proj.bias.float(), delta_softplus=True,
+                                  return_last_state=True, initial_state=state, chunk_size=self.chunk_size)
+        return self.out_proj(y.transpose(1, 2)), state
+
+
+register_mamba_backend('mamba_ssm', _load_mamba_ssm)
+register_mamba_backend('torch', lambda: TorchMamba)
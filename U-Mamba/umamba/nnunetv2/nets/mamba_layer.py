@@ -0,0 +1,440 @@
+from typing import Dict, Hashable, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+
+from nnunetv2.nets.mamba_backends import Mamba
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
+from nnunetv2.utilities.scan_orders import ScanOrderCache, gather_tokens, inverse_permutation, pca_scan_order, \
+    tile_scan_order, vector_key
+
+# per-step messages are DEBUG, see nnunetv2/utilities/mamba_logging.py
+logger = get_mamba_logger('mamba_layer', interval=10)
+
+
+class ScanStrategy(object):
+    """
+    Order in which a Mamba layer visits the voxels of a (B, C, D, H, W) feature map.
+
+    A strategy builds a scan permutation per spatial shape (perm: scan position -> flat voxel index in C order, and
+    its inverse). Orders are built once and then served from a ScanOrderCache, keyed by key() + shape + device, so
+    key() must contain every parameter the ordering depends on. Flattening and unflattening are then a single gather
+    each (gather_tokens), for every strategy.
+    """
+    def key(self) -> Hashable:
+        raise NotImplementedError
+
+    def build(self, spatial_shape: Tuple[int, ...], device) -> Tuple[torch.Tensor, torch.Tensor]:
+        raise NotImplementedError
+
+    def scan_order(self, spatial_shape: Tuple[int, ...], device, cache: ScanOrderCache = None) \
+            -> Tuple[torch.Tensor, torch.Tensor]:
+        if cache is None:
+            return self.build(spatial_shape, device)
+        return cache.get((self.key(), spatial_shape, device), lambda: self.build(spatial_shape, device))
+
+    def unscan_order(self, spatial_shape: Tuple[int, ...], device, cache: ScanOrderCache = None) \
+            -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        (index, inverse) that map the scanned sequence back to the volume. The inverse of the scan order.
+        """
+        perm, inv = self.scan_order(spatial_shape, device, cache)
+        return inv, perm
+
+    def flatten(self, x: torch.Tensor, cache: ScanOrderCache = None):
+        """
+        Args:
+            x: (B, C, D, H, W)
+            cache: where to keep the index tensors (usually the one of the layer)
+
+        Returns:
+            x_flat: (B, N, C) in scan order
+            unpermute: function mapping (B, N, C) back to (B, C, D, H, W)
+        """
+        B, C, D, H, W = x.shape
+        spatial_shape = (D, H, W)
+        perm, inv = self.scan_order(spatial_shape, x.device, cache)
+        index, inverse = self.unscan_order(spatial_shape, x.device, cache)
+        x_flat = gather_tokens(x.reshape(B, C, -1), perm, inv).transpose(1, 2)
+
+        def unpermute(t_flat):
+            return gather_tokens(t_flat.transpose(1, 2), index, inverse).reshape(B, C, D, H, W)
+
+        return x_flat, unpermute
+
+
+def _axis_permuted_indices(spatial_shape, axis_order) -> torch.Tensor:
+    return torch.arange(int(np.prod(spatial_shape))).reshape(spatial_shape).permute(*axis_order)
+
+
+class AxisScan(ScanStrategy):
+    """
+    Raster scan with the spatial axes of (D, H, W) reordered by axis_order (the last one varies fastest). (0, 1, 2)
+    scans in memory order.
+
+    transposed_unscan reproduces the unpermute of the original 'z' (and 'diag') scans: it was applied to the output
+    after it had already been reshaped to (B, C, D, H, W) and transposed its last two axes, which is a gather with the
+    (0, 2, 1) scan order instead of the inverse of the scan. Checkpoints trained with it depend on it.
+    """
+    def __init__(self, axis_order: Sequence[int], transposed_unscan: bool = False):
+        self.axis_order = tuple(int(i) for i in axis_order)
+        self.transposed_unscan = transposed_unscan
+
+    def key(self):
+        return 'axis', self.axis_order
+
+    def build(self, spatial_shape, device):
+        perm = _axis_permuted_indices(spatial_shape, self.axis_order).reshape(-1).to(device)
+        return perm, inverse_permutation(perm)
+
+    def unscan_order(self, spatial_shape, device, cache=None):
+        if self.transposed_unscan:
+            return AxisScan((0, 2, 1)).scan_order(spatial_shape, device, cache)
+        return super().unscan_order(spatial_shape, device, cache)
+
+
+class DiagonalScan(ScanStrategy):
+    """
+    Diagonal scan in plane, a pair of spatial axes (of (D, H, W) = (z, y, x)). The volume is scanned slice by slice
+    along the remaining axis, each slice along its diagonals: voxels are sorted by i + j (anti=False) or i - j
+    (anti=True), where i, j are their coordinates along plane[0], plane[1], and by i within a diagonal.
+    """
+    def __init__(self, plane: Sequence[int] = (1, 0), anti: bool = False):
+        self.plane = tuple(int(i) for i in plane)
+        if len(self.plane) != 2 or len(set(self.plane)) != 2 or not set(self.plane) <= {0, 1, 2}:
+            raise ValueError(f"plane must be two different spatial axes out of 0, 1, 2, got {plane}")
+        self.anti = anti
+
+    def key(self):
+        return 'diagonal', self.plane, self.anti
+
+    def build(self, spatial_shape, device):
+        a, b = self.plane
+        c = 3 - a - b
+        coords = [torch.arange(s, device=device).reshape([-1 if k == axis else 1 for k in range(3)])
+                  for axis, s in enumerate(spatial_shape)]
+        i, j = coords[a], coords[b]
+        diagonal = i - j + (spatial_shape[b] - 1) if self.anti else i + j
+        n_diagonals = spatial_shape[a] + spatial_shape[b] - 1
+        # unique per voxel, so sorting it is the scan order
+        key = (coords[c] * n_diagonals + diagonal) * spatial_shape[a] + i
+        perm = torch.argsort(key.expand(*spatial_shape).reshape(-1))
+        return perm, inverse_permutation(perm)
+
+
+class LegacyDiagonalScan(AxisScan):
+    """
+    The yz-diag / xy-diag scans of the original flatten_for_scan, to run checkpoints trained with them as they were
+    trained. The volume permuted by axis_order is scanned plane by plane along its first axis, within a plane by
+    argsort of the sum of the in-plane coordinates. With swap_plane_grid that sum is computed on the transposed plane
+    grid (so for non-square planes these are not diagonals), and unscan_order only undoes the axis permutation, not
+    the ordering within the planes. Ties are in the order of the same (not stable) torch.argsort call on the same
+    device as the original, so that the scans stay identical to it.
+    """
+    def __init__(self, axis_order: Sequence[int], swap_plane_grid: bool = False):
+        super().__init__(axis_order)
+        self.swap_plane_grid = swap_plane_grid
+
+    def key(self):
+        return 'legacy_diagonal', self.axis_order, self.swap_plane_grid
+
+    def build(self, spatial_shape, device):
+        indices = _axis_permuted_indices(spatial_shape, self.axis_order)
+        A, P, Q = indices.shape
+        grid = (Q, P) if self.swap_plane_grid else (P, Q)
+        coords_0, coords_1 = torch.meshgrid(torch.arange(grid[0], device=device), torch.arange(grid[1], device=device),
+                                            indexing='ij')
+        plane_order = torch.argsort((coords_0 + coords_1).flatten())
+        perm = indices.to(device).reshape(A, P * Q)[:, plane_order].reshape(-1)
+        return perm, inverse_permutation(perm)
+
+    def unscan_order(self, spatial_shape, device, cache=None):
+        return AxisScan(self.axis_order).unscan_order(spatial_shape, device, cache)
+
+
+class GlobalPCAScan(ScanStrategy):
+    """
+    Visits voxels sorted by their projection onto vector ((3,), (z, y, x)), see pca_scan_order.
+
+    key: vector_key(vector), computed (device -> host copy) if not given
+    precomputed: {(spatial shape, vector key): (N,) perm} of orders computed ahead of time (ScanPlan)
+    """
+    def __init__(self, vector, key: Tuple[float, ...] = None,
+                 precomputed: Dict[Tuple[Tuple[int, ...], Tuple[float, ...]], torch.Tensor] = None):
+        vector = torch.as_tensor(vector)
+        self.vector = vector[0] if vector.ndim == 2 else vector
+        self.vector_key = vector_key(self.vector) if key is None else key
+        self.precomputed = precomputed
+
+    def key(self):
+        return 'global_pca', self.vector_key
+
+    def build(self, spatial_shape, device):
+        perm = None if self.precomputed is None else self.precomputed.get((spatial_shape, self.vector_key))
+        if perm is None:
+            return pca_scan_order(spatial_shape, self.vector, device)
+        perm = perm.to(device)
+        return perm, inverse_permutation(perm)
+
+
+class LocalPCAScan(ScanStrategy):
+    """
+    Local PCA scan of a tile at origin in the reference volume described by key_map (see local_pca_key_map and
+    tile_scan_order). The key map is not part of key(), caches must be cleared when it changes.
+    """
+    def __init__(self, key_map: torch.Tensor, origin: Sequence[int]):
+        self.key_map = key_map
+        self.origin = tuple(int(i) for i in origin)
+
+    def key(self):
+        return 'local_pca', self.origin
+
+    def build(self, spatial_shape, device):
+        return tile_scan_order(self.key_map.to(device), self.origin, spatial_shape)
+
+
+class LearnedScan(ScanStrategy):
+    """
+    Fixed scan permutations, one per spatial shape ({(D, H, W): (N,) perm}), e.g. a learned or space filling scan
+    path compiled ahead of time.
+    """
+    def __init__(self, orders: Dict[Tuple[int, ...], torch.Tensor], name: str = 'learned'):
+        self.orders = {tuple(int(i) for i in k): torch.as_tensor(v).long() for k, v in orders.items()}
+        self.name = name
+
+    def key(self):
+        return 'learned', self.name
+
+    def build(self, spatial_shape, device):
+        if spatial_shape not in self.orders:
+            raise ValueError(f"Scan {self.name} has no order for spatial shape {spatial_shape}, available: "
+                             f"{sorted(self.orders.keys())}")
+        perm = self.orders[spatial_shape].to(device)
+        return perm, inverse_permutation(perm)
+
+
+_AXIS_NAMES = {'z': 0, 'y': 1, 'x': 2}
+
+# axis scans of the original flatten_for_scan (the input is (B, C, Z, Y, X)) and the diagonal / anti-diagonal scans
+# of every plane: '<ab>-diag' / '<ab>-antidiag' scans the diagonals of the a, b plane (i along a), slice by slice
+# along the third axis. 'yz-diag' and 'xy-diag' slice along the same axis as the original ones did
+AXIS_SCANS = {
+    'x': AxisScan((2, 1, 0)),
+    'y': AxisScan((1, 2, 0)),
+    'z': AxisScan((0, 1, 2), transposed_unscan=True),
+    **{f'{a}{b}-{kind}': DiagonalScan((_AXIS_NAMES[a], _AXIS_NAMES[b]), anti=kind == 'antidiag')
+       for a in _AXIS_NAMES for b in _AXIS_NAMES if a != b for kind in ('diag', 'antidiag')},
+    'yz-diag-legacy': LegacyDiagonalScan((2, 1, 0), swap_plane_grid=True),
+    'xy-diag-legacy': LegacyDiagonalScan((0, 2, 1)),
+}
+
+
+class MambaLayer(nn.Module):
+    """
+    LayerNorm + Mamba over the voxels of a (B, C, D, H, W) feature map, flattened in the order of a ScanStrategy:
+
+    - the axis and diagonal scans of axis_scans (by name)
+    - 'pca': global PCA scan along the scan vector (set_scan_vector), x scan while it is not set. With a patch origin
+      flatten_for_scan uses the local PCA vector of that patch (set_local_pca_vectors)
+    - 'learned': the scan set with set_learned_scan
+
+    Index tensors are built once per (strategy, shape, device) and cached. The network modules subclass this and
+    choose axis_scans and the name of the scan vector buffer so that their state dicts stay unchanged.
+    """
+    axis_scans: Dict[str, ScanStrategy] = AXIS_SCANS
+    scan_vector_name = 'principal_vector'
+
+    def __init__(self, dim, d_state=16, d_conv=4, expand=2, scan_type='x'):
+        super().__init__()
+        self.dim = dim
+        self.norm = nn.LayerNorm(dim)
+        self.mamba = Mamba(
+            d_model=dim,
+            d_state=d_state,
+            d_conv=d_conv,
+            expand=expand)
+        self.scan_type = scan_type
+        self.local_pca_vectors = None
+        self.local_pca_coords = None
+        self.learned_scan = None
+        self.register_buffer(self.scan_vector_name, torch.zeros(3), persistent=True)
+        # bounded because orders can be cached per vector / tile origin
+        self._scan_order_cache = ScanOrderCache(max_entries=16)
+        self._scan_vector_key = None
+
+    @property
+    def scan_vector(self) -> torch.Tensor:
+        return getattr(self, self.scan_vector_name)
+
+    def scan_vector_key(self):
+        # computed once per vector, not per step (it requires a device -> host copy)
+        if self._scan_vector_key is None:
+            self._scan_vector_key = vector_key(self.scan_vector)
+        return self._scan_vector_key
+
+    def set_scan_vector(self, vector):
+        logger.debug("Setting scan vector to:", vector)
+        if isinstance(vector, np.ndarray):
+            vector = torch.from_numpy(vector)
+        self.scan_vector.copy_(vector.reshape(3).to(self.scan_vector.device, dtype=self.scan_vector.dtype))
+        self._invalidate_scan_orders()
+
+    def set_local_pca_vectors(self, vectors, coords):
+        if isinstance(vectors, np.ndarray):
+            vectors = torch.from_numpy(vectors)
+        if isinstance(coords, np.ndarray):
+            coords = torch.from_numpy(coords)
+        self.local_pca_vectors = vectors
+        self.local_pca_coords = coords.long()
+        logger.info("[MambaLayer] Loaded", len(vectors), "local PCA vectors.")
+        self._invalidate_scan_orders()
+
+    def get_patch_index(self, patch_origin):
+        if self.local_pca_coords is None:
+            logger.debug("[MambaLayer] No local PCA coordinates set. Returning None.")
+            return None
+        matches = torch.all(self.local_pca_coords == torch.tensor(patch_origin, dtype=torch.long), dim=1)
+        idx = torch.where(matches)[0]
+        return idx[0].item() if len(idx) > 0 else None
+
+    def get_local_pca_vector(self, patch_origin):
+        idx = self.get_patch_index(patch_origin)
+        return self.local_pca_vectors[idx] if idx is not None else self.scan_vector
+
+    def set_learned_scan(self, scan: ScanStrategy):
+        self.learned_scan = scan
+        self._invalidate_scan_orders()
+
+    def _invalidate_scan_orders(self, keep_precomputed: bool = False):
+        self._scan_order_cache.clear()
+        self._scan_vector_key = None
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # loading a checkpoint (e.g. another fold) can replace the scan vector
+        super()._load_from_state_dict(*args, **kwargs)
+        self._invalidate_scan_orders(keep_precomputed=True)
+
+    def _apply(self, fn, *args, **kwargs):
+        # cached index tensors live on a device; .to()/.cuda() must not keep serving the old ones
+        self._invalidate_scan_orders(keep_precomputed=True)
+        return super()._apply(fn, *args, **kwargs)
+
+    def get_pca_scan(self, vector=None) -> GlobalPCAScan:
+        if vector is None or vector is self.scan_vector:
+            return GlobalPCAScan(self.scan_vector, self.scan_vector_key())
+        return GlobalPCAScan(vector)
+
+    def get_scan_strategy(self, scan_type: str) -> ScanStrategy:
+        if scan_type in self.axis_scans:
+            return self.axis_scans[scan_type]
+        if scan_type == 'pca':
+            return self.get_pca_scan()
+        if scan_type == 'learned':
+            if self.learned_scan is None:
+                raise RuntimeError("[MambaLayer] scan type 'learned' requires set_learned_scan")
+            return self.learned_scan
+        raise ValueError(f"Unsupported scan type: {scan_type}")
+
+    def flatten_for_scan(self, x, scan_type='x', patch_origin=None):
+        """
+        Args:
+            x: (B, C, D, H, W)
+            scan_type: see the class docstring
+            patch_origin: origin of x in the volume the local PCA vectors refer to ('pca' only)
+
+        Returns:
+            x_flat: (B, N, C)
+            unpermute: function mapping (B, N, C) back to (B, C, D, H, W)
+        """
+        if scan_type == 'pca':
+            vector = self.get_local_pca_vector(patch_origin) if patch_origin is not None else self.scan_vector
+            return self.flatten_pca_scan(x, vector)
+        return self.get_scan_strategy(scan_type).flatten(x, self._scan_order_cache)
+
+    def flatten_pca_scan(self, x, principal_vector):
+        """
+        Like flatten_for_scan, along principal_vector ((3,) or (1, 3), numpy or torch). Returns None, None if there is
+        no vector.
+        """
+        if principal_vector is None:
+            logger.warning("[MambaLayer] Principal vector is None. Skipping PCA flatten.", interval=60)
+            return None, None
+        return self.get_pca_scan(principal_vector).flatten(x, self._scan_order_cache)
+
+    def flatten(self, x):
+        if self.scan_type == 'pca' and not any(self.scan_vector_key()):
+            logger.warning("[MambaLayer] PCA vector not set. Falling back to 'x' scan.", interval=600)
+            return self.flatten_for_scan(x, 'x')
+        return self.flatten_for_scan(x, self.scan_type)
+
+    def forward(self, x):
+        if x.dtype in [torch.float16, torch.bfloat16]:
+            x = x.float()
+        assert x.shape[1] == self.dim
+        x_flat, unpermute = self.flatten(x)
+        return unpermute(self.mamba(self.norm(x_flat)))
+
+
+if __name__ == '__main__':
+    # round trip of every scan: unpermute(flatten(x)) must be x and the gradient must come back unchanged. Not for the
+    # reproduced quirks of the original 'z' and diagonal scans
+    cache = ScanOrderCache()
+    for shape in ((4, 5, 6), (7, 3, 5), (1, 8, 2)):
+        x = torch.randn(2, 3, *shape, requires_grad=True)
+        for name, scan in AXIS_SCANS.items():
+            if getattr(scan, 'transposed_unscan', False) or isinstance(scan, LegacyDiagonalScan):
+                continue
+            x_flat, unpermute = scan.flatten(x, cache)
+            assert x_flat.shape == (2, int(np.prod(shape)), 3)
+            out = unpermute(x_flat)
+            assert torch.equal(out, x), f'{name} round trip failed for {shape}'
+            grad = torch.randn_like(out)
+            assert torch.equal(torch.autograd.grad(out, x, grad)[0], grad), f'{name} gradient mismatch for {shape}'
+
+            if isinstance(scan, DiagonalScan):
+                # slice by slice, diagonal by diagonal, and consecutive voxels of a diagonal are neighbours on it
+                perm = scan.scan_order(shape, x.device, cache)[0]
+                coords = torch.stack(torch.unravel_index(perm, shape), dim=1)
+                a, b = scan.plane
+                i, j, c = coords[:, a], coords[:, b], coords[:, 3 - a - b]
+                d = i - j if scan.anti else i + j
+                order = c * (shape[a] + shape[b]) + d + shape[b]
+                assert torch.all(order[1:] >= order[:-1]), f'{name} is not a diagonal scan for {shape}'
+                same = order[1:] == order[:-1]
+                assert torch.all(i[1:][same] - i[:-1][same] == 1), f'{name} skips voxels of a diagonal for {shape}'
+    print('scan round trip ok:', ', '.join(n for n, s in AXIS_SCANS.items()
+                                          if not (getattr(s, 'transposed_unscan', False) or
+                                                  isinstance(s, LegacyDiagonalScan))))
+
+    # the legacy diagonal scans must flatten and unpermute exactly like the original flatten_for_scan, also for planes
+    # that are not square
+    def original_diagonal_scan(x, scan_type):
+        B, C, D, H, W = x.shape
+        if scan_type == 'yz-diag':
+            x_perm = x.permute(0, 1, 4, 3, 2)
+            X, Y, Z = x_perm.shape[2:]
+            z_coords, y_coords = torch.meshgrid(torch.arange(Z, device=x.device), torch.arange(Y, device=x.device),
+                                                indexing='ij')
+            diag_order = torch.argsort((z_coords + y_coords).flatten())
+            x_flat = x_perm.reshape(B, C, X, Y * Z)[:, :, :, diag_order]
+            return x_flat.reshape(B, C, -1).transpose(-1, -2), \
+                lambda t: t.reshape(B, C, X, Y, Z).permute(0, 1, 4, 3, 2)
+        x_perm = x.permute(0, 1, 2, 4, 3)
+        D, X, Y = x_perm.shape[2:]
+        x_coords, y_coords = torch.meshgrid(torch.arange(X, device=x.device), torch.arange(Y, device=x.device),
+                                            indexing='ij')
+        diag_order = torch.argsort((x_coords + y_coords).flatten())
+        x_flat = x_perm.reshape(B, C, D, X * Y)[:, :, :, diag_order]
+        return x_flat.reshape(B, C, -1).transpose(-1, -2), lambda t: t.reshape(B, C, D, X, Y).permute(0, 1, 2, 4, 3)
+
+    for shape in ((4, 5, 6), (7, 3, 5), (2, 9, 4), (3, 24, 17)):
+        x = torch.randn(2, 3, *shape)
+        for name in ('yz-diag', 'xy-diag'):
+            ref_flat, ref_unpermute = original_diagonal_scan(x, name)
+            x_flat, unpermute = AXIS_SCANS[f'{name}-legacy'].flatten(x, cache)
+            assert torch.equal(x_flat, ref_flat), f'{name}-legacy flatten differs from the original for {shape}'
+            # the original unpermute takes (B, C, N)
+            assert torch.equal(unpermute(x_flat), ref_unpermute(ref_flat.transpose(-1, -2))), \
+                f'{name}-legacy unpermute differs from the original for {shape}'
+    print('legacy diagonal scan parity ok')
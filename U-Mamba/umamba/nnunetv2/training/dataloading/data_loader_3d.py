@@ -14,6 +14,10 @@ class nnUNetDataLoader3D(nnUNetDataLoaderBase):
         
         seg_all = np.zeros(self.seg_shape, dtype=np.int16)
         case_properties = []
+        # where the final (center cropped after augmentation) patch lies in its case. Scan strategies that depend on
+        # the position in the volume (local PCA) need this
+        patch_origins = np.zeros((len(selected_keys), len(self.final_patch_size)), dtype=np.int64)
+        case_shapes = np.zeros_like(patch_origins)
 
         for j, i in enumerate(selected_keys):
             # oversampling foreground will improve stability of model training, especially if many patches are empty
@@ -34,6 +38,8 @@ class nnUNetDataLoader3D(nnUNetDataLoaderBase):
             # plt.savefig(f"/home/stud/user/user/project_dir/visualization/patch{i}{j}.png")
             dim = len(shape)
             bbox_lbs, bbox_ubs = self.get_bbox(shape, force_fg, properties['class_locations'])
+            patch_origins[j] = np.array(bbox_lbs) + (np.array(self.patch_size) - np.array(self.final_patch_size)) // 2
+            case_shapes[j] = shape
 
             # whoever wrote this knew what he was doing (hint: it was me). We first crop the data to the region of the
             # bbox that actually lies within the data. This will result in a smaller array which is then faster to pad.
@@ -70,7 +76,8 @@ class nnUNetDataLoader3D(nnUNetDataLoaderBase):
             #self.plot_slices(data_all[j])
             #################
 
-        return {'data': data_all, 'seg': seg_all, 'properties': case_properties, 'keys': selected_keys}
+        return {'data': data_all, 'seg': seg_all, 'properties': case_properties, 'keys': selected_keys,
+                'patch_origins': patch_origins, 'case_shapes': case_shapes}
 
     def plot_slices(self, patch):
         # Plot the middle slice of each dimension
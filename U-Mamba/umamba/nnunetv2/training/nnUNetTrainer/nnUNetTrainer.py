@@ -25,6 +25,7 @@ from torch._dynamo import OptimizedModule
 from nnunetv2.configuration import ANISO_THRESHOLD, default_num_processes
 from nnunetv2.evaluation.evaluate_predictions import compute_metrics_on_folder
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, resample_and_save
+from nnunetv2.inference.export_queue import ExportQueue
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
 #from nnunetv2.inference.predict_from_raw_data_pca import PCAAwarePredictor
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian
@@ -52,7 +53,6 @@ from nnunetv2.training.loss.dice import get_tp_fp_fn_tn, MemoryEfficientSoftDice
 from nnunetv2.training.lr_scheduler.polylr import PolyLRScheduler
 from nnunetv2.utilities.collate_outputs import collate_outputs
 from nnunetv2.utilities.default_n_proc_DA import get_allowed_n_proc_DA
-from nnunetv2.utilities.file_path_utilities import check_workers_alive_and_busy
 from nnunetv2.utilities.get_network_from_plans import get_network_from_plans
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
 from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot, determine_num_input_channels
@@ -1189,10 +1189,18 @@ class nnUNetTrainer(object):
                     'trainer_name': self.__class__.__name__,
                     'inference_allowed_mirroring_axes': self.inference_allowed_mirroring_axes,
                 }
+                checkpoint.update(self._get_additional_checkpoint_entries())
                 torch.save(checkpoint, filename)
             else:
                 self.print_to_log_file('No checkpoint written, checkpointing is disabled')
 
+    def _get_additional_checkpoint_entries(self) -> dict:
+        """
+        Trainers that need more than the network weights at inference time (e.g. scan plans of PCA Mamba trainers)
+        can add entries to the checkpoint here
+        """
+        return {}
+
     def load_checkpoint(self, filename_or_checkpoint: Union[dict, str]) -> None:
         if not self.was_initialized:
             self.initialize()
@@ -1243,104 +1251,97 @@ class nnUNetTrainer(object):
                                         self.inference_allowed_mirroring_axes)
 
         with multiprocessing.get_context("spawn").Pool(default_num_processes) as segmentation_export_pool:
-            worker_list = [i for i in segmentation_export_pool._pool]
-            validation_output_folder = join(self.output_folder, 'validation')
-            maybe_mkdir_p(validation_output_folder)
-
-            # we cannot use self.get_tr_and_val_datasets() here because we might be DDP and then we have to distribute
-            # the validation keys across the workers.
-            _, val_keys = self.do_split()
-            if self.is_ddp:
-                val_keys = val_keys[self.local_rank:: dist.get_world_size()]
-
-            dataset_val = nnUNetDataset(self.preprocessed_dataset_folder, val_keys,
-                                        folder_with_segs_from_previous_stage=self.folder_with_segs_from_previous_stage,
-                                        num_images_properties_loading_threshold=0)
-
-            next_stages = self.configuration_manager.next_stage_names
-
-            if next_stages is not None:
-                _ = [maybe_mkdir_p(join(self.output_folder_base, 'predicted_next_stage', n)) for n in next_stages]
-
-            results = []
-
-            for k in dataset_val.keys():
-                proceed = not check_workers_alive_and_busy(segmentation_export_pool, worker_list, results,
-                                                 allowed_num_queued=2)
-                while not proceed:
-                    sleep(0.1)
-                    proceed = not check_workers_alive_and_busy(segmentation_export_pool, worker_list, results,
-                                                     allowed_num_queued=2)
+            # logits go to the workers through a ring of shared memory buffers, see ExportQueue
+            export_queue = ExportQueue(segmentation_export_pool)
+            try:
+                validation_output_folder = join(self.output_folder, 'validation')
+                maybe_mkdir_p(validation_output_folder)
 
-                self.print_to_log_file(f"predicting {k}")
-                data, seg, properties = dataset_val.load_case(k)
+                # we cannot use self.get_tr_and_val_datasets() here because we might be DDP and then we have to distribute
+                # the validation keys across the workers.
+                _, val_keys = self.do_split()
+                if self.is_ddp:
+                    val_keys = val_keys[self.local_rank:: dist.get_world_size()]
 
-                if self.is_cascaded:
-                    data = np.vstack((data, convert_labelmap_to_one_hot(seg[-1], self.label_manager.foreground_labels,
-                                                                        output_dtype=data.dtype)))
-                with warnings.catch_warnings():
-                    # ignore 'The given NumPy array is not writable' warning
-                    warnings.simplefilter("ignore")
-                    data = torch.from_numpy(data)
+                dataset_val = nnUNetDataset(self.preprocessed_dataset_folder, val_keys,
+                                            folder_with_segs_from_previous_stage=self.folder_with_segs_from_previous_stage,
+                                            num_images_properties_loading_threshold=0)
 
-                output_filename_truncated = join(validation_output_folder, k)
+                next_stages = self.configuration_manager.next_stage_names
 
-                try:
-                    prediction = predictor.predict_sliding_window_return_logits(data)
-                except RuntimeError:
-                    predictor.perform_everything_on_device = False
-                    prediction = predictor.predict_sliding_window_return_logits(data)
-                    predictor.perform_everything_on_device = True
-
-                prediction = prediction.cpu()
-
-                # this needs to go into background processes
-                results.append(
-                    segmentation_export_pool.starmap_async(
-                        export_prediction_from_logits, (
-                            (prediction, properties, self.configuration_manager, self.plans_manager,
-                             self.dataset_json, output_filename_truncated, save_probabilities),
-                        )
-                    )
-                )
-                # for debug purposes
-                # export_prediction(prediction_for_export, properties, self.configuration, self.plans, self.dataset_json,
-                #              output_filename_truncated, save_probabilities)
-
-                # if needed, export the softmax prediction for the next stage
                 if next_stages is not None:
-                    for n in next_stages:
-                        next_stage_config_manager = self.plans_manager.get_configuration(n)
-                        expected_preprocessed_folder = join(nnUNet_preprocessed, self.plans_manager.dataset_name,
-                                                            next_stage_config_manager.data_identifier)
-
-                        try:
-                            # we do this so that we can use load_case and do not have to hard code how loading training cases is implemented
-                            tmp = nnUNetDataset(expected_preprocessed_folder, [k],
-                                                num_images_properties_loading_threshold=0)
-                            d, s, p = tmp.load_case(k)
-                        except FileNotFoundError:
-                            self.print_to_log_file(
-                                f"Predicting next stage {n} failed for case {k} because the preprocessed file is missing! "
-                                f"Run the preprocessing for this configuration first!")
-                            continue
-
-                        target_shape = d.shape[1:]
-                        output_folder = join(self.output_folder_base, 'predicted_next_stage', n)
-                        output_file = join(output_folder, k + '.npz')
-
-                        # resample_and_save(prediction, target_shape, output_file, self.plans_manager, self.configuration_manager, properties,
-                        #                   self.dataset_json)
-                        results.append(segmentation_export_pool.starmap_async(
-                            resample_and_save, (
-                                (prediction, target_shape, output_file, self.plans_manager,
-                                 self.configuration_manager,
-                                 properties,
-                                 self.dataset_json),
-                            )
-                        ))
-
-            _ = [r.get() for r in results]
+                    _ = [maybe_mkdir_p(join(self.output_folder_base, 'predicted_next_stage', n)) for n in next_stages]
+
+                for k in dataset_val.keys():
+                    export_queue.wait_for_capacity()
+
+                    self.print_to_log_file(f"predicting {k}")
+                    data, seg, properties = dataset_val.load_case(k)
+
+                    if self.is_cascaded:
+                        data = np.vstack((data, convert_labelmap_to_one_hot(seg[-1], self.label_manager.foreground_labels,
+                                                                            output_dtype=data.dtype)))
+                    with warnings.catch_warnings():
+                        # ignore 'The given NumPy array is not writable' warning
+                        warnings.simplefilter("ignore")
+                        data = torch.from_numpy(data)
+
+                    output_filename_truncated = join(validation_output_folder, k)
+
+                    try:
+                        prediction = predictor.predict_sliding_window_return_logits(data)
+                    except RuntimeError:
+                        predictor.perform_everything_on_device = False
+                        prediction = predictor.predict_sliding_window_return_logits(data)
+                        predictor.perform_everything_on_device = True
+
+                    prediction = prediction.cpu()
+
+                    # shared with every export job of this case (segmentation and next stages)
+                    prediction = export_queue.share(prediction)
+
+                    # this needs to go into background processes
+                    export_queue.submit(export_prediction_from_logits,
+                                        (prediction, properties, self.configuration_manager, self.plans_manager,
+                                         self.dataset_json, output_filename_truncated, save_probabilities))
+                    # for debug purposes
+                    # export_prediction(prediction_for_export, properties, self.configuration, self.plans, self.dataset_json,
+                    #              output_filename_truncated, save_probabilities)
+
+                    # if needed, export the softmax prediction for the next stage
+                    if next_stages is not None:
+                        for n in next_stages:
+                            next_stage_config_manager = self.plans_manager.get_configuration(n)
+                            expected_preprocessed_folder = join(nnUNet_preprocessed, self.plans_manager.dataset_name,
+                                                                next_stage_config_manager.data_identifier)
+
+                            try:
+                                # we do this so that we can use load_case and do not have to hard code how loading training cases is implemented
+                                tmp = nnUNetDataset(expected_preprocessed_folder, [k],
+                                                    num_images_properties_loading_threshold=0)
+                                d, s, p = tmp.load_case(k)
+                            except FileNotFoundError:
+                                self.print_to_log_file(
+                                    f"Predicting next stage {n} failed for case {k} because the preprocessed file is missing! "
+                                    f"Run the preprocessing for this configuration first!")
+                                continue
+
+                            target_shape = d.shape[1:]
+                            output_folder = join(self.output_folder_base, 'predicted_next_stage', n)
+                            output_file = join(output_folder, k + '.npz')
+
+                            # resample_and_save(prediction, target_shape, output_file, self.plans_manager, self.configuration_manager, properties,
+                            #                   self.dataset_json)
+                            export_queue.submit(resample_and_save,
+                                                (prediction, target_shape, output_file, self.plans_manager,
+                                                 self.configuration_manager, properties, self.dataset_json))
+                    export_queue.release(prediction)
+                    del prediction
+
+                _ = export_queue.get_results()
+            finally:
+                # also on errors, the buffers live in /dev/shm
+                export_queue.close()
 
         if self.is_ddp:
             dist.barrier()
@@ -27,6 +27,7 @@ from nnunetv2.training.data_augmentation.custom_transforms.limited_length_multit
 from nnunetv2.training.dataloading.utils import get_case_identifiers, unpack_dataset
 from nnunetv2.training.loss.dice import get_tp_fp_fn_tn
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
 from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager, PlansManager
 from nnunetv2.utilities.collate_outputs import collate_outputs 
 
@@ -39,7 +40,10 @@ from scipy.spatial import ConvexHull, Delaunay
 from scipy.ndimage import binary_dilation
 
 from nnunetv2.training.dataloading.convex_data_loader_3d import nnUNetDataLoader3D_convex
-from nnunetv2.nets.UMambaFirst import MambaLayer
+from nnunetv2.nets.mamba_layer import MambaLayer
+
+logger = get_mamba_logger('nnUNetTrainerMambaFirstStem_PCA')
+
 class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
     """
     A custom nnUNetTrainer that applies ConvexHullTransform during training.
@@ -157,9 +161,9 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
             return None
 
         mamba_layer = find_mamba_layer(self.network)
-        print("Found MambaLayer:", mamba_layer is not None)
+        logger.debug("Found MambaLayer:", mamba_layer is not None)
         if mamba_layer is not None:
-            print("[PCA] Attempting to load PCA scan vector...")
+            logger.debug("[PCA] Attempting to load PCA scan vector...")
             pca_vector_path = os.path.join(self.output_folder, 'pca_scan_vector.npy')
             if os.path.exists(pca_vector_path):
                 try:
@@ -171,7 +175,7 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
             else:
                 self.print_to_log_file("[PCA] No PCA scan vector found yet. Using fallback scan order.")
         else:
-            print("[PCA] Network does not have a mamba layer or PCA scan type is not set. Using fallback scan order.")
+            logger.debug("[PCA] Network does not have a mamba layer or PCA scan type is not set. Using fallback scan order.")
             
             
     def on_epoch_end(self):
@@ -217,7 +221,7 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
         
         # Adding pca for scan path #! user 
         if self.current_epoch == 0 and self.local_rank == 0:
-            print("Computing PCA scan path from ground truth masks...")
+            logger.info("Computing PCA scan path from ground truth masks...")
 
         dataset_tr, _ = self.get_tr_and_val_datasets()
         all_masks = []
@@ -225,11 +229,11 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
         for key in dataset_tr.keys():
             _, seg, _ = dataset_tr.load_case(key)  # seg shape: (1, D, H, W)
             # print shape of seg
-            print(f"Shape of segmentation for key {key}: {seg.shape}")
+            logger.debug("Shape of segmentation for key", key, seg.shape)
             seg = seg[0]  # assume binary mask
             all_masks.append(seg)
             # print size of all_masks
-            print(f"Size of all_masks after appending key {key}: {len(all_masks)}")
+            logger.debug("Size of all_masks after appending key", key, len(all_masks))
 
         # Find max shape along each dimension
         shapes = [mask.shape for mask in all_masks]
@@ -262,9 +266,9 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
             principal_vector = pca.components_[0]
             np.save(os.path.join(self.output_folder, "pca_scan_vector.npy"), principal_vector)
             # unit vector (array of length 3) representing main direction of variance among  coords in mask region
-            print(f"PCA vector saved to: {self.output_folder}/pca_scan_vector.npy")
+            logger.info("PCA vector saved to:", os.path.join(self.output_folder, "pca_scan_vector.npy"))
         else:
-            print("No foreground voxels found in mean mask.")
+            logger.info("No foreground voxels found in mean mask.")
 
     ## second version of it 
     def on_train_epoch_end(self, train_outputs: List[dict]):
@@ -280,12 +284,12 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
             proj = proj.reshape(D, H, W)
             img = nib.Nifti1Image(proj.astype(np.float32), np.eye(4))
             nib.save(img, output_path)
-            print(f"[PCA] Saved voxel-wise PCA projection to: {output_path}")
+            logger.info("[PCA] Saved voxel-wise PCA projection to:", output_path)
 
         def save_pca_scan_line_overlay(mean_np, principal_vector, output_path, threshold=0.05, num_points=50):
             coords = np.argwhere(mean_np > threshold)
             if len(coords) == 0:
-                print("[PCA] No foreground voxels found to build scan line.")
+                logger.info("[PCA] No foreground voxels found to build scan line.")
                 return
             center = coords.mean(axis=0)
             length = min(mean_np.shape) * 0.9
@@ -300,7 +304,7 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
             scan_line = binary_dilation(scan_line, iterations=1).astype(np.uint8)
             scan_nifti = nib.Nifti1Image(scan_line, np.eye(4))
             nib.save(scan_nifti, output_path)
-            print(f"[PCA] Scan line overlay saved to: {output_path}")
+            logger.info("[PCA] Scan line overlay saved to:", output_path)
 
         outputs = collate_outputs(train_outputs)
 
@@ -315,7 +319,7 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
 
         # --- PCA scan path logic ---
         if self.current_epoch == 0 and self.local_rank == 0:
-            print("Computing PCA scan path from segmentation masks...")
+            logger.info("Computing PCA scan path from segmentation masks...")
             dataset_tr, _ = self.get_tr_and_val_datasets()
             model = self.network
             model.eval()
@@ -408,9 +412,9 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
                 np.save(os.path.join(self.output_folder, "pca_scan_vector.npy"), principal_vector)
                 save_pca_projection_nifti(mean_np.shape, principal_vector, os.path.join(self.output_folder, "pca_projection.nii.gz"))
                 save_pca_scan_line_overlay(mean_np, principal_vector, os.path.join(self.output_folder, "scan_vector_overlay.nii.gz"))
-                print(f"[PCA] PCA vector saved to: {principal_vector}")
+                logger.info("[PCA] PCA vector saved to:", principal_vector)
             else:
-                print("[PCA] No meaningful foreground voxels found inside brain mask.")
+                logger.info("[PCA] No meaningful foreground voxels found inside brain mask.")
 
             # --- Centerline extraction and overlay (2D slice-by-slice) ---
             binary_mask = (mean_np > 0.05).astype(np.uint8)
@@ -422,7 +426,7 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
                 skeleton_nifti = nib.Nifti1Image(skeleton.astype(np.uint8), np.eye(4))
                 skeleton_path = os.path.join(self.output_folder, "centerline_skeleton.nii.gz")
                 nib.save(skeleton_nifti, skeleton_path)
-                print(f"[Centerline] 2D-slice skeleton/centerline saved to: {skeleton_path}")
+                logger.info("[Centerline] 2D-slice skeleton/centerline saved to:", skeleton_path)
 
                 # Overlay skeleton on mean projection and save
                 overlay = mean_np.copy()
@@ -430,9 +434,9 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
                 overlay_nifti = nib.Nifti1Image(overlay.astype(np.float32), np.eye(4))
                 overlay_path = os.path.join(self.output_folder, "mean_projection_with_centerline.nii.gz")
                 nib.save(overlay_nifti, overlay_path)
-                print(f"[Centerline] Overlay saved to: {overlay_path}")
+                logger.info("[Centerline] Overlay saved to:", overlay_path)
             else:
-                print("[Centerline] No foreground voxels for skeletonization.")
+                logger.info("[Centerline] No foreground voxels for skeletonization.")
         
     @staticmethod
     def build_network_architecture(plans_manager: PlansManager,
@@ -451,7 +455,7 @@ class nnUNetTrainerMambaFirstStem_PCA(nnUNetTrainer):
             raise NotImplementedError("Only 2D and 3D models are supported")
 
         
-        print("UMambaEnc: {}".format(model))
+        logger.debug("UMambaEnc:", model)
 
         return model
 
@@ -27,10 +27,13 @@ from nnunetv2.training.data_augmentation.custom_transforms.limited_length_multit
 from nnunetv2.training.dataloading.utils import get_case_identifiers, unpack_dataset
 from nnunetv2.training.loss.dice import get_tp_fp_fn_tn
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
 from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager, PlansManager
+from nnunetv2.utilities.scan_plan import ScanPlan
 from nnunetv2.utilities.collate_outputs import collate_outputs 
 from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot, determine_num_input_channels
-from nnunetv2.utilities.pca_utils import get_patch_coords, compute_local_pca, compute_global_pca, extract_patch, extract_patches_and_origins
+from nnunetv2.utilities.pca_utils import get_patch_coords, compute_local_pca, compute_global_pca, extract_patch, \
+    extract_patches_and_origins, load_or_compute_mean_mask
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from torch._dynamo import OptimizedModule
@@ -46,6 +49,8 @@ from scipy.ndimage import binary_dilation
 from nnunetv2.training.dataloading.convex_data_loader_3d import nnUNetDataLoader3D_convex
 from nnunetv2.nets.UMambaFirst import MambaLayer
 
+logger = get_mamba_logger('nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba')
+
 class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
     """
     A custom nnUNetTrainer that generally applies PCA to the stem features of the model.
@@ -53,8 +58,19 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
 
     def __init__(self, plans, configuration, fold, dataset_json, unpack_dataset=True, device=torch.device('cuda'), **kwargs):
         # Extract custom args and REMOVE them from kwargs before passing to base class
-        self.scan_type = kwargs.pop('scan_type', 'global_pca') # kwargs.pop('scan_type', 'global_pca') # : 'global_pca', 'local_pca', 'x', 'y', 'z', 'xy_scan', 'diag'
+        self.scan_type = kwargs.pop('scan_type', 'global_pca') # kwargs.pop('scan_type', 'global_pca') # : 'global_pca', 'multi_pca', 'local_pca', 'learned', 'x', 'y', 'z', 'xy_scan', 'diag'
         self.pca_patch_size = kwargs.pop('pca_patch_size', None)
+        # multi_pca: number of principal components to scan along (each forward and reverse, 2K sequences per input)
+        self.pca_n_components = kwargs.pop('pca_n_components', 2)
+        # token pruning (global_pca / local_pca): the stem Mamba only scans the voxels of the mean mask dilated by this
+        # many voxels, all other voxels pass through unchanged. None scans everything
+        self.token_pruning_dilation = kwargs.pop('token_pruning_dilation', None)
+        # bound the activation memory of the full resolution stem (see UMambaEnc.set_stem_memory_options): activation
+        # checkpointing of BasicResBlock + MambaLayer and / or chunked scans carrying the SSM state (torch backend)
+        self.checkpoint_stem = kwargs.pop('checkpoint_stem', False)
+        self.stem_chunk_size = kwargs.pop('stem_chunk_size', None)
+        # learned: scan path compiled from the mean mask prior into a static permutation (see utilities/scan_paths.py)
+        self.scan_path = kwargs.pop('scan_path', 'pca_hilbert')
 
 
         # Ensure patch size is tuple
@@ -69,6 +85,12 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
         if self.scan_type == 'local_pca' and self.pca_patch_size is not None:
             patch_str = "_".join(str(i) for i in self.pca_patch_size)
             scan_str += f"_patch{patch_str}"
+        elif self.scan_type == 'multi_pca':
+            scan_str += f"_k{self.pca_n_components}"
+        elif self.scan_type == 'learned':
+            scan_str += f"_{self.scan_path}"
+        if self.token_pruning_dilation is not None and self.scan_type in ('global_pca', 'local_pca'):
+            scan_str += f"_pruned{self.token_pruning_dilation}"
         self.output_folder_base = os.path.join(
             nnUNet_results, plans['dataset_name'],
             self.__class__.__name__ + '__' + plans['plans_name'] + "__" + configuration + f"_{scan_str}") \
@@ -82,6 +104,11 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
         self.local_pca_vectors = None
         self.local_pca_coords = None
         self.global_pca_vector = None
+        # shape of the (centered) mean mask the local PCA coords refer to
+        self.pca_reference_shape = None
+        # PCA vectors are computed once per training (see on_train_start) and only recomputed if the mask changes
+        self.scan_plan = None
+        self._applied_scan_plan_hash = None
         
         
     def initialize(self):
@@ -99,10 +126,16 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
                 self.pca_patch_size if self.scan_type == 'local_pca' else None,
                 self.local_pca_vectors if self.scan_type == 'local_pca' else None,
                 self.local_pca_coords if self.scan_type == 'local_pca' else None,
-                self.global_pca_vector if self.scan_type == 'global_pca' else None,
+                self.global_pca_vector if self.scan_type in ('global_pca', 'multi_pca') else None,
                 self.output_folder
             ).to(self.device)
-            print("net initialized with scan type:", self.scan_type, "and pca patch size:", self.pca_patch_size)
+            logger.info("net initialized with scan type:", self.scan_type, "and pca patch size:", self.pca_patch_size)
+            if self.checkpoint_stem or self.stem_chunk_size is not None:
+                self.network.set_stem_memory_options(self.checkpoint_stem, self.stem_chunk_size)
+                feature_map_size = self.network.compute_conv_feature_map_size(self.configuration_manager.patch_size)
+                self.print_to_log_file(f"Stem memory options: checkpointing {self.checkpoint_stem}, sequence chunk "
+                                       f"size {self.stem_chunk_size}. Feature map elements per sample: "
+                                       f"{feature_map_size / 1e6:.0f}M")
             if self._do_i_compile():
                 self.print_to_log_file('Using torch.compile...')
                 self.network = torch.compile(self.network)
@@ -146,123 +179,75 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
         self.plot_network_architecture()
         self._save_debug_information()
         
-        # Determin global PCA vectors if scan_type is global_pca
-        if self.scan_type == "global_pca" or self.scan_type == "local_pca":
-            self.print_to_log_file("Computing global and local PCA vectors using stem features of GT...")
-            
-            # -- Efficient mask loading --
+        # Determine the global / local PCA vectors (the scan plan) from the mean mask of the training cases
+        if self.scan_type in ("global_pca", "multi_pca", "local_pca", "learned"):
+            if self.scan_type == "local_pca" and self.pca_patch_size is None:
+                self.pca_patch_size = (16, 16, 16)  # Default patch size if not provided
+                self.print_to_log_file(f"[PCA] Using default patch size: {self.pca_patch_size}")
+
+            # -- Streaming mean mask, cached per training split --
             dataset_tr, _ = self.get_tr_and_val_datasets()
-            all_masks = []
-            
-            for key in dataset_tr.keys():
-                _, seg, _ = dataset_tr.load_case(key)  # seg: (1, D, H, W)
-                all_masks.append(seg[0])  # drop channel dim
-                
-            shapes = [m.shape for m in all_masks]
-            max_shape = np.max(np.stack(shapes), axis=0)
-
-            def pad_centered(arr, target_shape):
-                return np.pad(arr, [( (t - s) // 2, (t - s + 1) // 2 ) for s, t in zip(arr.shape, target_shape)],
-                            mode='constant', constant_values=0)
-
-            all_masks = np.stack([pad_centered(m, max_shape) for m in all_masks])  # (N, D, H, W)
-            mean_mask = np.mean(all_masks, axis=0)  # (D, H, W)
+            mean_mask, from_cache = load_or_compute_mean_mask(
+                dataset_tr, list(dataset_tr.keys()), self.preprocessed_dataset_folder,
+                num_threads=max(1, min(8, get_allowed_n_proc_DA())))
+            self.print_to_log_file(f"[PCA] {'Loaded' if from_cache else 'Computed'} mean mask of "
+                                   f"{len(dataset_tr.keys())} training cases, shape {mean_mask.shape}")
             binary_mask_np = (mean_mask > 0.05).astype(np.uint8)
 
-            # Save binary mask as NIfTI
-            import nibabel as nib
-            affine = np.eye(4)
-            binary_mask_nifti = nib.Nifti1Image(binary_mask_np, affine)
-            output_path = os.path.join(self.output_folder, "global_pca_binary_mask.nii.gz")
-            nib.save(binary_mask_nifti, output_path)
-            self.print_to_log_file(f"[PCA] Saved binary mask to {output_path}")
-
-            # -- Pass binary mask through stem --
-            binary_mask_tensor = torch.from_numpy(binary_mask_np).float().to(self.device)
-            if self.num_input_channels > 1:
-                binary_mask_tensor = binary_mask_tensor.repeat(self.num_input_channels, 1, 1, 1).unsqueeze(0)  # (1, C, D, H, W)
+            # a plan restored from a checkpoint (load_checkpoint) is reused if its inputs did not change
+            patch_size = self.pca_patch_size if self.scan_type == "local_pca" else None
+            n_components = self.pca_n_components if self.scan_type == "multi_pca" else 1
+            dilation = self.token_pruning_dilation if self.scan_type in ("global_pca", "local_pca") else None
+            scan_path = self.scan_path if self.scan_type == "learned" else None
+            source_hash = ScanPlan.compute_source_hash(binary_mask_np, self.scan_type, patch_size, n_components,
+                                                       dilation, scan_path)
+            if self.scan_plan is not None and self.scan_plan.is_valid_for(source_hash):
+                self.print_to_log_file("[PCA] Scan plan is up to date, reusing it.")
             else:
-                binary_mask_tensor = binary_mask_tensor.unsqueeze(0)  # (1, 1, D, H, W)
-            print(f"[PCA] Binary mask shape: {binary_mask_tensor.shape}")
-            
-            # Pass binary mask through stem to extract features
-            self.network.eval()
-            with torch.no_grad():
-                stem_feats = self.network.extract_stem_features(binary_mask_tensor)  # (B, C, D, H, W)
-
-            # -- Perform PCA on spatial distribution of stem features --
-            stem_feats = stem_feats.squeeze(0).permute(1, 2, 3, 0).cpu().numpy()  # (D, H, W, C)
-            binary_coords = np.argwhere(binary_mask_np > 0)  # (N, 3)
-        
-            if self.scan_type == "global_pca":
-                if len(binary_coords) > 0:
-                    # Extract corresponding features
-                    
-                    pca = PCA(n_components=1)
-                    pca.fit(binary_coords)
-
-                    pca_vecs = pca.components_  # (2, 3)
-                    self.global_pca_vectors = torch.from_numpy(pca_vecs).float()
-                    self.network.set_global_pca_vectors(self.global_pca_vectors.to(self.device))
-
-                    np.save(os.path.join(self.output_folder, "pca_feature_vectors.npy"), pca_vecs)
-                    self.print_to_log_file("[PCA] PCA vectors computed from stem features and saved.")
-                    self.print_to_log_file(f"[PCA] PCA vector shape: {pca_vecs.shape}")
-                else:
-                    self.print_to_log_file("[PCA] No foreground voxels found for PCA on stem features.")
-                    
-                    
-                    
-            if self.scan_type == "local_pca":
-                if self.pca_patch_size is None:
-                    self.pca_patch_size = (16, 16, 16)  # Default patch size if not provided
-                    self.print_to_log_file(f"[PCA] Using default patch size: {self.pca_patch_size}")
-                # patch the input stem features
-                self.print_to_log_file("[PCA] Extracting patches and origins from stem features...")
-                binary_mask_tensor_np = binary_mask_np.astype(np.uint8)[None, None]  # Add batch and channel dimensions # (1, 1, 240, 240, 180)
-                print(f"[PCA] Binary mask tensor shape: {binary_mask_tensor_np.shape}")
-                # Extract patches and their coordinates
-                patches, coords = extract_patches_and_origins(binary_mask_tensor_np, self.pca_patch_size)
-
-                all_vectors = []
-                all_coords = []
-
-                for patch, coord in zip(patches, coords):
-                    #print("Shape of patch:", patch.shape)
-                    patch = patch.squeeze(0)
-                    #print("Shape of patch after squeeze:", patch.shape)
-                    # Get the 3D coordinates of foreground voxels within this patch
-                    foreground_coords = np.argwhere(patch > 0)  # shape: (N, 3) (why (0, 3))??? 
-        
-                    
-                    if foreground_coords.shape[0] < 4:
-                        continue
-                    #print("Shape of foreground_coords:", foreground_coords.shape[0])
-                    
-                    pca = PCA(n_components=1)
-                    try:
-                        pca.fit(foreground_coords)
-                        vector = torch.tensor(pca.components_[0], dtype=torch.float32)
-                        vector = vector / (vector.norm() + 1e-8)
-                    except Exception as e:
-                        self.print_to_log_file(f"[PCA] PCA failed for local patch at {coord}: {e}")
-                        continue
+                self.print_to_log_file("[PCA] Computing scan plan (PCA vectors) from the binary mean mask...")
+                self.scan_plan = ScanPlan.build(binary_mask_np, self.scan_type, patch_size, device=self.device,
+                                                source_hash=source_hash, n_components=n_components,
+                                                token_mask_dilation=dilation, scan_path=scan_path)
+
+                # Save binary mask as NIfTI
+                output_path = os.path.join(self.output_folder, "global_pca_binary_mask.nii.gz")
+                nib.save(nib.Nifti1Image(binary_mask_np, np.eye(4)), output_path)
+                self.print_to_log_file(f"[PCA] Saved binary mask to {output_path}")
+
+            # scan orders for the training / inference patch size are stored with the plan in the checkpoints
+            self.scan_plan.precompute_scan_orders([self.configuration_manager.patch_size])
+            if self.scan_plan.is_empty:
+                self.print_to_log_file("[PCA] No foreground voxels / valid local patches found, using fallback scan.")
+            self._apply_scan_plan()
+
+    def _apply_scan_plan(self):
+        """
+        Set the scan plan in the network. No-op if it is already set, so this is free to call every epoch.
+        """
+        if self.scan_plan is None or self._applied_scan_plan_hash == self.scan_plan.source_hash:
+            return
+        network = self.network.module if self.is_ddp else self.network
+        if isinstance(network, OptimizedModule):
+            network = network._orig_mod
+        self.scan_plan.apply(network, self.device)
+
+        if self.scan_plan.scan_path is not None:
+            prior = None if self.scan_plan.global_vector is None else self.scan_plan.global_vector.tolist()
+            self.print_to_log_file(f"[PCA] Scanning along the compiled {self.scan_plan.scan_path} scan path (prior "
+                                   f"vector {prior}).")
+        elif self.scan_plan.global_vector is not None:
+            self.global_pca_vector = torch.from_numpy(self.scan_plan.global_vector).to(self.device)
+            self.print_to_log_file(f"[PCA] Set global PCA vector(s) {self.scan_plan.global_vector.tolist()}.")
+        if self.scan_plan.local_vectors is not None:
+            self.local_pca_vectors = torch.from_numpy(self.scan_plan.local_vectors).to(self.device)
+            self.local_pca_coords = torch.from_numpy(self.scan_plan.local_coords).to(self.device)
+            self.pca_reference_shape = self.scan_plan.reference_shape
+            self.print_to_log_file(f"[PCA] Set {len(self.local_pca_vectors)} coordinate-based local PCA vectors.")
+        if self.scan_plan.token_mask is not None:
+            self.print_to_log_file(f"[PCA] Token pruning: scanning {self.scan_plan.token_mask.mean() * 100:.1f}% of the "
+                                   f"reference volume (mask dilated by {self.scan_plan.token_mask_dilation} voxels).")
+        self._applied_scan_plan_hash = self.scan_plan.source_hash
 
-                    all_vectors.append(vector) # Shape: (3,)
-                    #print("Shape of vector:", vector.shape)
-                    #print("Shape of coord:", coord)
-                    all_coords.append(coord) # Shape: (3,)
-
-                if all_vectors:
-                    self.local_pca_vectors = torch.stack(all_vectors).squeeze().to(self.device)
-                    self.local_pca_coords = torch.tensor(all_coords).long().to(self.device)
-                    self.network.set_local_pca_vectors(self.local_pca_vectors, self.local_pca_coords)
-                    self.network.set_pca_patch_size(self.pca_patch_size)
-                    self.print_to_log_file(f"[PCA] Set {len(all_vectors)} coordinate-based local PCA vectors.")
-                else:
-                    self.print_to_log_file("[PCA] No valid local patches found.")
-            
-            
     def on_train_epoch_end2(self, train_outputs: List[dict]):
         super().on_train_epoch_end(train_outputs)
 
@@ -295,9 +280,9 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
                 if self.num_input_channels > 1:
                     prediction = prediction.repeat(1, self.network.num_input_channels, 1, 1, 1)
 
-                print(f"[PCA] Prediction shape: {prediction.shape}")
+                logger.debug("[PCA] Prediction shape:", prediction.shape)
                 feats = self.network.extract_stem_features(prediction)
-                print(f"[PCA] Stem features shape: {feats.shape}")
+                logger.debug("[PCA] Stem features shape:", feats.shape)
                 #stem_feats = stem_feats.squeeze(0).permute(1, 2, 3, 0).cpu().numpy()  # (D, H, W, C)
                 #coords = np.argwhere(binary_mask_np > 0)  # (N, 3)
                 patches, coords = extract_patches_and_origins(feats, self.pca_patch_size)
@@ -329,75 +314,25 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
             
         self.network.set_local_pca_vectors(self.local_pca_vectors, self.local_pca_coords)
 
-    def on_train_epoch_end(self, train_outputs: List[dict]):
-        super().on_train_epoch_end(train_outputs)
-
-        if self.scan_type != "local_pca":
+    def _set_scan_origins_from_batch(self, batch: dict):
+        # the local PCA scan and token pruning need to know where the patch lies in its case, see nnUNetDataLoader3D
+        if self.scan_type != "local_pca" and (self.scan_plan is None or self.scan_plan.token_mask is None):
             return
-
-        self.print_to_log_file("[PCA] Updating local PCA vectors from saved binary mask...")
-
-        # === Load binary mask ===
-        import nibabel as nib
-        mask_path = os.path.join(self.output_folder, "global_pca_binary_mask.nii.gz")
-        if not os.path.exists(mask_path):
-            self.print_to_log_file(f"[PCA] Mask file not found: {mask_path}")
-            return
-
-        binary_mask_nifti = nib.load(mask_path)
-        binary_mask_np = binary_mask_nifti.get_fdata().astype(np.uint8)
-        binary_mask_np = (binary_mask_np > 0).astype(np.uint8)[None, None]  # Add batch and channel dimensions # (1, 1, 240, 240, 180)
-        print(f"[PCA] Binary mask shape TRAIN EPOCH END: {binary_mask_np.shape}")
-
-        # === Convert to tensor and prepare shape ===
-        binary_mask_tensor = torch.from_numpy(binary_mask_np).float().to(self.device)
-  
-        self.network.eval()
-        with torch.no_grad():
-            feats = self.network.extract_stem_features(binary_mask_tensor)  # (1, C, D, H, W)
-
-        # === Extract patches ===
-        self.print_to_log_file(f"[PCA] Extracting local patches from stem features...")
-        patches, coords = extract_patches_and_origins(feats, self.pca_patch_size)
-
-        all_vectors = []
-        all_coords = []
-
-        for patch, coord in zip(patches, coords):
-            patch = patch.squeeze(0)  # (C, D, H, W)
-            mask_patch = binary_mask_np[
-                coord[0]:coord[0]+self.pca_patch_size[0],
-                coord[1]:coord[1]+self.pca_patch_size[1],
-                coord[2]:coord[2]+self.pca_patch_size[2]
-            ]
-
-            foreground_coords = np.argwhere(mask_patch > 0)  # (N, 3)
-
-            if foreground_coords.shape[0] < 4:
-                continue
-
-            try:
-                pca = PCA(n_components=1)
-                pca.fit(foreground_coords)
-                vector = torch.tensor(pca.components_[0], dtype=torch.float32)
-                vector = vector / (vector.norm() + 1e-8)
-            except Exception as e:
-                self.print_to_log_file(f"[PCA] PCA failed for local patch at {coord}: {e}")
-                continue
-
-            all_vectors.append(vector)
-            all_coords.append(coord)
-
-        # === Store updated PCA vectors ===
-        if all_vectors:
-            self.local_pca_vectors = torch.stack(all_vectors).to(self.device)
-            self.local_pca_coords = torch.tensor(all_coords).long().to(self.device)
-            self.network.set_local_pca_vectors(self.local_pca_vectors, self.local_pca_coords)
-            self.print_to_log_file(f"[PCA] Updated local PCA vectors from binary mask.")
+        network = self.network.module if self.is_ddp else self.network
+        if isinstance(network, OptimizedModule):
+            network = network._orig_mod
+        if 'patch_origins' in batch:
+            network.set_scan_origins(batch['patch_origins'], batch['case_shapes'])
         else:
-            self.print_to_log_file("[PCA] No valid patches found in binary mask.")
+            network.clear_scan_origins()
 
+    def train_step(self, batch: dict) -> dict:
+        self._set_scan_origins_from_batch(batch)
+        return super().train_step(batch)
 
+    def validation_step(self, batch: dict) -> dict:
+        self._set_scan_origins_from_batch(batch)
+        return super().validation_step(batch)
 
     def on_train_epoch_start(self):
         self.network.train()
@@ -408,39 +343,9 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
             f"Current learning rate: {np.round(self.optimizer.param_groups[0]['lr'], decimals=5)}")
         self.logger.log('lrs', self.optimizer.param_groups[0]['lr'], self.current_epoch)
 
-        mamba_layer = self.network.encoder.stem[1]
-        print("Scan type:", self.scan_type)
-        if self.scan_type in ("local_pca", "global_pca"):
-            print("Found MambaLayer:", mamba_layer is not None)
-            if mamba_layer is not None:
-                print("[PCA] Attempting to load PCA scan vector...")
-                if self.scan_type == "local_pca":
-                    vectors_path = os.path.join(self.output_folder, "local_pca_vectors.npy")
-                    coords_path = os.path.join(self.output_folder, "local_pca_coords.npy")
-                    if os.path.exists(vectors_path) and os.path.exists(coords_path):
-                        vectors = np.load(vectors_path)
-                        coords = np.load(coords_path)
-                        mamba_layer.set_local_pca_vectors(vectors, coords)
-                        self.print_to_log_file("[PCA] Local PCA vectors loaded.")
-                    else:
-                        self.print_to_log_file("[PCA] Local PCA vectors not found.")
-                elif self.scan_type == "global_pca":
-                    pca_vector_path = os.path.join(self.output_folder, 'pca_feature_vectors.npy')
-                    print(f"[PCA] Looking for global PCA vector at {pca_vector_path}")
-                    if os.path.exists(pca_vector_path):
-                        try:
-                            pca_vector = np.load(pca_vector_path)
-                            mamba_layer.set_global_pca_vectors(pca_vector)
-                            self.print_to_log_file("[PCA] Global PCA vector successfully loaded and set.")
-                        except Exception as e:
-                            self.print_to_log_file(f"[PCA] Failed to load global PCA vector: {e}")
-                    else:
-                        self.print_to_log_file("[PCA] No global PCA vector found yet. Using fallback scan order.")
-            else:
-                print("[PCA] Network does not have a mamba layer or PCA scan type is not set. Using fallback scan order.")
-                
-                
-                
+        # the scan plan does not change during training, this only does something if it was replaced
+        self._apply_scan_plan()
+
     def on_epoch_end(self):
         self.logger.log('epoch_end_timestamps', time(), self.current_epoch)
 
@@ -468,33 +373,18 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
 
         self.current_epoch += 1
 
-    def save_checkpoint(self, filename: str) -> None:
-        super().save_checkpoint(filename)
-
-        if self.scan_type == "local_pca":
-            if hasattr(self, "local_pca_vectors") and hasattr(self, "local_pca_coords"):
-                np.save(os.path.join(self.output_folder, "local_pca_vectors.npy"),
-                        self.local_pca_vectors.detach().cpu().numpy())
-                np.save(os.path.join(self.output_folder, "local_pca_coords.npy"),
-                        self.local_pca_coords.detach().cpu().numpy())
-                self.print_to_log_file("Saved local PCA vectors and coordinates.")
-                
-        elif self.scan_type == "global_pca":
-            print("self.global_pca_vector BEFORE SAVING:", self.global_pca_vector)
-            if hasattr(self.network, "global_pca_vector") and self.global_pca_vector is not None:
-                np.save(os.path.join(self.output_folder, "global_pca_vector.npy"),
-                        self.global_pca_vector.detach().cpu().numpy())
-                self.print_to_log_file("Saved global PCA vector.")
-            else:
-                self.print_to_log_file("Global PCA vector is None, not saving.")
-                
+    def _get_additional_checkpoint_entries(self) -> dict:
+        # the scan plan is needed to run the network, see nnUNetPredictor.initialize_from_trained_model_folder
+        return {'scan_plan': self.scan_plan.state_dict()} if self.scan_plan is not None else {}
 
     def load_checkpoint(self, filename_or_checkpoint: Union[dict, str]) -> None:
         if not self.was_initialized:
             self.initialize()
 
         if isinstance(filename_or_checkpoint, str):
-            checkpoint = torch.load(filename_or_checkpoint, map_location=self.device)
+            checkpoint = torch.load(filename_or_checkpoint, map_location=self.device, weights_only=False)
+        else:
+            checkpoint = filename_or_checkpoint
         new_state_dict = {}
         for k, value in checkpoint['network_weights'].items():
             key = k
@@ -522,6 +412,9 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
         if self.grad_scaler is not None:
             if checkpoint['grad_scaler_state'] is not None:
                 self.grad_scaler.load_state_dict(checkpoint['grad_scaler_state'])
+        if checkpoint.get('scan_plan') is not None:
+            # validated against the current mask in on_train_start, applied there
+            self.scan_plan = ScanPlan.from_state_dict(checkpoint['scan_plan'])
         self.print_to_log_file("Checkpoint loaded and PCA vectors (if available) restored.")
     
     @staticmethod
@@ -540,7 +433,7 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
         ) -> nn.Module:
         
         output_folder = os.environ.get("UMAMBA_OUTPUT_FOLDER")
-        print(f"UMamba output folder: {output_folder}")
+        logger.debug("UMamba output folder:", output_folder)
         
         if len(configuration_manager.patch_size) == 2:
             model = get_umamba_enc_2d_from_plans(plans_manager, dataset_json, configuration_manager,
@@ -557,5 +450,5 @@ class nnUNetTrainerMambaFirstStem_PCA_PSU_Mamba(nnUNetTrainer):
         else:
             raise NotImplementedError("Only 2D and 3D models are supported")
 
-        print("UMambaEnc: {}".format(model))
+        logger.debug("UMambaEnc:", model)
         return model
\ No newline at end of file
@@ -22,6 +22,7 @@ from nnunetv2.training.data_augmentation.custom_transforms.limited_length_multit
 from nnunetv2.training.dataloading.utils import get_case_identifiers, unpack_dataset
 from nnunetv2.training.loss.dice import get_tp_fp_fn_tn
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
 from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager, PlansManager
 from nnunetv2.utilities.collate_outputs import collate_outputs 
 
@@ -38,6 +39,9 @@ from scipy.ndimage import binary_dilation
 
 from nnunetv2.training.dataloading.convex_data_loader_3d import nnUNetDataLoader3D_convex
 
+logger = get_mamba_logger('nnUNetTrainerPCApath')
+
+
 class nnUNetTrainerPCApath(nnUNetTrainer):
     """
     A custom nnUNetTrainer that applies ConvexHullTransform during training.
@@ -161,12 +165,12 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
 
         # Inject PCA scan vector if available
         # print attributes of self.network
-        print(hasattr(self.network, 'mamba_layer'))
-        print("zaaaaaa")
+        logger.debug(hasattr(self.network, 'mamba_layer'))
+        logger.debug("zaaaaaa")
 
         # 
         if hasattr(self.network, 'mamba_layer'): #and getattr(self.network, 'mamba_scan_type', '') == 'pca':
-            print("[PCA] Attempting to load PCA scan vector...")
+            logger.debug("[PCA] Attempting to load PCA scan vector...")
             pca_vector_path = os.path.join(self.output_folder, 'pca_scan_vector.npy')
             if os.path.exists(pca_vector_path):
                 try:
@@ -178,7 +182,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
             else:
                 self.print_to_log_file("[PCA] No PCA scan vector found yet. Using fallback scan order.")
         else:
-            print("[PCA] Network does not have a mamba layer or PCA scan type is not set. Using fallback scan order.")
+            logger.debug("[PCA] Network does not have a mamba layer or PCA scan type is not set. Using fallback scan order.")
             
     def on_epoch_end(self):
         self.logger.log('epoch_end_timestamps', time(), self.current_epoch)
@@ -223,7 +227,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
         
         # Adding pca for scan path #! user 
         if self.current_epoch == 0 and self.local_rank == 0:
-            print("Computing PCA scan path from ground truth masks...")
+            logger.info("Computing PCA scan path from ground truth masks...")
 
         dataset_tr, _ = self.get_tr_and_val_datasets()
         all_masks = []
@@ -231,11 +235,11 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
         for key in dataset_tr.keys():
             _, seg, _ = dataset_tr.load_case(key)  # seg shape: (1, D, H, W)
             # print shape of seg
-            print(f"Shape of segmentation for key {key}: {seg.shape}")
+            logger.debug("Shape of segmentation for key", key, seg.shape)
             seg = seg[0]  # assume binary mask
             all_masks.append(seg)
             # print size of all_masks
-            print(f"Size of all_masks after appending key {key}: {len(all_masks)}")
+            logger.debug("Size of all_masks after appending key", key, len(all_masks))
 
         # Find max shape along each dimension
         shapes = [mask.shape for mask in all_masks]
@@ -268,9 +272,9 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
             principal_vector = pca.components_[0]
             np.save(os.path.join(self.output_folder, "pca_scan_vector.npy"), principal_vector)
             # unit vector (array of length 3) representing main direction of variance among  coords in mask region
-            print(f"PCA vector saved to: {self.output_folder}/pca_scan_vector.npy")
+            logger.info("PCA vector saved to:", os.path.join(self.output_folder, "pca_scan_vector.npy"))
         else:
-            print("No foreground voxels found in mean mask.")
+            logger.info("No foreground voxels found in mean mask.")
 
     ## second version of it 
     def on_train_epoch_end(self, train_outputs: List[dict]):
@@ -290,14 +294,14 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
 
             img = nib.Nifti1Image(proj.astype(np.float32), np.eye(4))
             nib.save(img, output_path)
-            print(f"[PCA] Saved voxel-wise PCA projection to: {output_path}")
+            logger.info("[PCA] Saved voxel-wise PCA projection to:", output_path)
 
         def save_pca_scan_line_overlay(mean_np, principal_vector, output_path, threshold=0.05, num_points=50):
             if isinstance(mean_np, torch.Tensor):
                 mean_np = mean_np.cpu().numpy()
             coords = np.argwhere(mean_np > threshold)
             if len(coords) == 0:
-                print("[PCA] No foreground voxels found to build scan line.")
+                logger.info("[PCA] No foreground voxels found to build scan line.")
                 return
 
             center = coords.mean(axis=0)
@@ -315,7 +319,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
             scan_line = binary_dilation(scan_line, iterations=1).astype(np.uint8)
             scan_nifti = nib.Nifti1Image(scan_line, np.eye(4))
             nib.save(scan_nifti, output_path)
-            print(f"[PCA] Scan line overlay saved to: {output_path}")
+            logger.info("[PCA] Scan line overlay saved to:", output_path)
             
             
         outputs = collate_outputs(train_outputs)
@@ -331,7 +335,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
 
         # --- PCA scan path logic ---
         if self.current_epoch == 0 and self.local_rank == 0:
-            print("Computing PCA scan path from ground truth masks...")
+            logger.info("Computing PCA scan path from ground truth masks...")
 
             dataset_tr, _ = self.get_tr_and_val_datasets()
             model = self.network
@@ -381,7 +385,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
             # Save the projected map for debugging
             mean_nifti = nib.Nifti1Image(mean_np, np.eye(4))
             nib.save(mean_nifti, os.path.join(self.output_folder, "mean_projection.nii.gz"))
-            print(f"[PCA] Saved mean projection to: {self.output_folder}/mean_projection.nii.gz")
+            logger.info("[PCA] Saved mean projection to:", os.path.join(self.output_folder, "mean_projection.nii.gz"))
 
             # Get coordinates of high-activation regions
             coords = np.argwhere(mean_np > 0.05)
@@ -397,8 +401,8 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
                 
                 save_pca_projection_nifti(mean_projection.shape, principal_vector, os.path.join(self.output_folder, "pca_projection.nii.gz"))
                 save_pca_scan_line_overlay(mean_projection, principal_vector, os.path.join(self.output_folder, "scan_vector_overlay.nii.gz"))
-                print(f"[PCA] projection saved to: {self.output_folder}/pca_projection.nii.gz")
-                print(f"[PCA] scan line overlay saved to: {self.output_folder}/scan_vector_overlay.nii.gz")
+                logger.info("[PCA] projection saved to:", os.path.join(self.output_folder, "pca_projection.nii.gz"))
+                logger.info("[PCA] scan line overlay saved to:", os.path.join(self.output_folder, "scan_vector_overlay.nii.gz"))
 
                 # Create an empty volume for the scan line
                 scan_line = np.zeros_like(mean_np, dtype=np.uint8)
@@ -426,12 +430,12 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
                 scan_nifti = nib.Nifti1Image(scan_line, scan_affine)
                 nib.save(scan_nifti, os.path.join(self.output_folder, "scan_vector_overlay.nii.gz"))
 
-                print(f"[PCA] Scan line overlay saved to: {self.output_folder}/scan_vector_overlay.nii.gz")
+                logger.info("[PCA] Scan line overlay saved to:", os.path.join(self.output_folder, "scan_vector_overlay.nii.gz"))
 
                 
-                print(f"[PCA] Scan vector saved to: {self.output_folder}/pca_scan_vector.npy")
+                logger.info("[PCA] Scan vector saved to:", os.path.join(self.output_folder, "pca_scan_vector.npy"))
             else:
-                print("[PCA] No meaningful foreground voxels found.")
+                logger.info("[PCA] No meaningful foreground voxels found.")
         
         
 
@@ -456,7 +460,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
             raise NotImplementedError("Only 2D and 3D models are supported")
 
         
-        print("UMambaEnc: {}".format(model))
+        logger.debug("UMambaEnc:", model)
 
         return model
 
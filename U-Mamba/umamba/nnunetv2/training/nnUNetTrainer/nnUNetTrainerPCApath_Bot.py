@@ -20,6 +20,7 @@ from nnunetv2.training.data_augmentation.custom_transforms.limited_length_multit
 from nnunetv2.training.dataloading.utils import get_case_identifiers, unpack_dataset
 from nnunetv2.training.loss.dice import get_tp_fp_fn_tn
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
 from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager, PlansManager
 from nnunetv2.utilities.collate_outputs import collate_outputs 
 
@@ -35,6 +36,9 @@ from scipy.ndimage import binary_dilation
 
 from nnunetv2.training.dataloading.convex_data_loader_3d import nnUNetDataLoader3D_convex
 
+logger = get_mamba_logger('nnUNetTrainerPCApath_Bot')
+
+
 class nnUNetTrainerPCApath(nnUNetTrainer):
     """
     A custom nnUNetTrainer that applies ConvexHullTransform during training.
@@ -158,12 +162,12 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
 
         # Inject PCA scan vector if available
         # print attributes of self.network
-        print(hasattr(self.network, 'mamba_layer'))
-        print("zaaaaaa")
+        logger.debug(hasattr(self.network, 'mamba_layer'))
+        logger.debug("zaaaaaa")
 
         # 
         if hasattr(self.network, 'mamba_layer'): #and getattr(self.network, 'mamba_scan_type', '') == 'pca':
-            print("[PCA] Attempting to load PCA scan vector...")
+            logger.debug("[PCA] Attempting to load PCA scan vector...")
             pca_vector_path = os.path.join(self.output_folder, 'pca_scan_vector.npy')
             if os.path.exists(pca_vector_path):
                 try:
@@ -175,7 +179,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
             else:
                 self.print_to_log_file("[PCA] No PCA scan vector found yet. Using fallback scan order.")
         else:
-            print("[PCA] Network does not have a mamba layer or PCA scan type is not set. Using fallback scan order.")
+            logger.debug("[PCA] Network does not have a mamba layer or PCA scan type is not set. Using fallback scan order.")
             
     def on_epoch_end(self):
         self.logger.log('epoch_end_timestamps', time(), self.current_epoch)
@@ -220,7 +224,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
         
         # Adding pca for scan path #! user 
         if self.current_epoch == 0 and self.local_rank == 0:
-            print("Computing PCA scan path from ground truth masks...")
+            logger.info("Computing PCA scan path from ground truth masks...")
 
         dataset_tr, _ = self.get_tr_and_val_datasets()
         all_masks = []
@@ -228,11 +232,11 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
         for key in dataset_tr.keys():
             _, seg, _ = dataset_tr.load_case(key)  # seg shape: (1, D, H, W)
             # print shape of seg
-            print(f"Shape of segmentation for key {key}: {seg.shape}")
+            logger.debug("Shape of segmentation for key", key, seg.shape)
             seg = seg[0]  # assume binary mask
             all_masks.append(seg)
             # print size of all_masks
-            print(f"Size of all_masks after appending key {key}: {len(all_masks)}")
+            logger.debug("Size of all_masks after appending key", key, len(all_masks))
 
         # Find max shape along each dimension
         shapes = [mask.shape for mask in all_masks]
@@ -265,9 +269,9 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
             principal_vector = pca.components_[0]
             np.save(os.path.join(self.output_folder, "pca_scan_vector.npy"), principal_vector)
             # unit vector (array of length 3) representing main direction of variance among  coords in mask region
-            print(f"PCA vector saved to: {self.output_folder}/pca_scan_vector.npy")
+            logger.info("PCA vector saved to:", os.path.join(self.output_folder, "pca_scan_vector.npy"))
         else:
-            print("No foreground voxels found in mean mask.")
+            logger.info("No foreground voxels found in mean mask.")
 
     ## second version of it 
     def on_train_epoch_end(self, train_outputs: List[dict]):
@@ -284,7 +288,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
 
         # --- PCA scan path logic ---
         if self.current_epoch == 0 and self.local_rank == 0:
-            print("Computing PCA scan path from ground truth masks...")
+            logger.info("Computing PCA scan path from ground truth masks...")
 
             dataset_tr, _ = self.get_tr_and_val_datasets()
             model = self.network
@@ -334,7 +338,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
             # Save the projected map for debugging
             mean_nifti = nib.Nifti1Image(mean_np, np.eye(4))
             nib.save(mean_nifti, os.path.join(self.output_folder, "mean_projection.nii.gz"))
-            print(f"[PCA] Saved mean projection to: {self.output_folder}/mean_projection.nii.gz")
+            logger.info("[PCA] Saved mean projection to:", os.path.join(self.output_folder, "mean_projection.nii.gz"))
 
             # Get coordinates of high-activation regions
             coords = np.argwhere(mean_np > 0.05)
@@ -373,12 +377,12 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
                 scan_nifti = nib.Nifti1Image(scan_line, scan_affine)
                 nib.save(scan_nifti, os.path.join(self.output_folder, "scan_vector_overlay.nii.gz"))
 
-                print(f"[PCA] Scan line overlay saved to: {self.output_folder}/scan_vector_overlay.nii.gz")
+                logger.info("[PCA] Scan line overlay saved to:", os.path.join(self.output_folder, "scan_vector_overlay.nii.gz"))
 
                 
-                print(f"[PCA] Scan vector saved to: {self.output_folder}/pca_scan_vector.npy")
+                logger.info("[PCA] Scan vector saved to:", os.path.join(self.output_folder, "pca_scan_vector.npy"))
             else:
-                print("[PCA] No meaningful foreground voxels found.")
+                logger.info("[PCA] No meaningful foreground voxels found.")
 
 
    
@@ -400,7 +404,7 @@ class nnUNetTrainerPCApath(nnUNetTrainer):
             raise NotImplementedError("Only 2D and 3D models are supported")
 
         
-        print("UMambaEnc: {}".format(model))
+        logger.debug("UMambaEnc:", model)
 
         return model
 
@@ -21,19 +21,30 @@ class nnUNetTrainerBenchmark_5epochs_noDataLoading(nnUNetTrainerBenchmark_5epoch
         num_input_channels = determine_num_input_channels(
             self.plans_manager, self.configuration_manager, self.dataset_json
         )
-        patch_size = self.configuration_manager.patch_size
-        dummy_data = torch.rand((self.batch_size, num_input_channels, *patch_size), device=self.device)
-        if self.enable_deep_supervision:
-            dummy_target = [
-                torch.round(
-                    torch.rand((self.batch_size, 1, *[int(i * j) for i, j in zip(patch_size, k)]), device=self.device)
-                    * max(self.label_manager.all_labels)
-                )
-                for k in self._get_deep_supervision_scales()
-            ]
-        else:
+        if not self.enable_deep_supervision:
             raise NotImplementedError("This trainer does not support deep supervision")
-        self.dummy_batch = {"data": dummy_data, "target": dummy_target}
+        self.dummy_batch = self.make_dummy_batch(self.batch_size, num_input_channels,
+                                                 self.configuration_manager.patch_size,
+                                                 self._get_deep_supervision_scales(),
+                                                 max(self.label_manager.all_labels), self.device)
+
+    @staticmethod
+    def make_dummy_batch(batch_size: int, num_input_channels: int, patch_size, deep_supervision_scales,
+                         max_label: int, device: torch.device) -> dict:
+        """
+        Random data and a random target per deep supervision scale (deep_supervision_scales None: full resolution
+        target only), in the format train_step / validation_step expect.
+        """
+        dummy_data = torch.rand((batch_size, num_input_channels, *patch_size), device=device)
+        if deep_supervision_scales is None:
+            deep_supervision_scales = [[1] * len(patch_size)]
+        dummy_target = [
+            torch.round(
+                torch.rand((batch_size, 1, *[int(i * j) for i, j in zip(patch_size, k)]), device=device) * max_label
+            )
+            for k in deep_supervision_scales
+        ]
+        return {"data": dummy_data, "target": dummy_target}
 
     def get_dataloaders(self):
         return None, None
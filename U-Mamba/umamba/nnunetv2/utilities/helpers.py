@@ -19,6 +19,23 @@ def empty_cache(device: torch.device):
         pass
 
 
+def get_available_memory(device: torch.device):
+    """
+    Memory (in bytes) that can still be allocated on device, None if unknown. For cuda this includes memory that is
+    reserved by the caching allocator but not in use.
+    """
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    elif device.type == 'cpu':
+        try:
+            import os
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return None
+    return None
+
+
 class dummy_context(object):
     def __enter__(self):
         pass
@@ -0,0 +1,82 @@
+import logging
+import os
+import sys
+from time import time
+
+# Log level of the Mamba networks and PCA trainers. DEBUG shows per-step scan information (slow, may sync with the GPU),
+# INFO (default) only shows setup messages, WARNING and above silences them.
+# Set via environment variable, e.g. nnUNet_mamba_log_level=DEBUG
+default_mamba_log_level = os.environ.get('nnUNet_mamba_log_level', 'INFO').upper()
+
+_ROOT_NAME = 'nnunetv2.mamba'
+
+
+def _configure_root_logger() -> logging.Logger:
+    root = logging.getLogger(_ROOT_NAME)
+    if not root.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('[%(name)s] %(message)s'))
+        root.addHandler(handler)
+        root.propagate = False
+        root.setLevel(default_mamba_log_level)
+    return root
+
+
+def set_mamba_log_level(level) -> None:
+    _configure_root_logger().setLevel(level.upper() if isinstance(level, str) else level)
+
+
+class RateLimitedLogger(object):
+    """
+    Thin wrapper around logging.Logger for code that runs every step.
+
+    - print-style arguments: log.debug('x_flat shape:', x_flat.shape). Nothing is formatted unless the level is enabled
+    - arguments can be callables (e.g. lambda: vector.cpu().numpy()). They are only evaluated if the message is emitted,
+      so expensive or syncing values cost nothing at the default level
+    - rate limiting: the same message (identified by key, default: the first argument) is emitted at most once every
+      `interval` seconds. Suppressed repetitions are counted and reported with the next emitted message
+    """
+    def __init__(self, name: str, interval: float = 0.):
+        _configure_root_logger()
+        self.logger = logging.getLogger(f'{_ROOT_NAME}.{name}')
+        self.interval = interval
+        self._last_emitted = {}
+        self._suppressed = {}
+
+    def is_enabled_for(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level, args, key, interval):
+        if not self.logger.isEnabledFor(level):
+            return
+        interval = self.interval if interval is None else interval
+        if interval > 0:
+            key = args[0] if key is None else key
+            now = time()
+            if now - self._last_emitted.get(key, -interval) < interval:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return
+            self._last_emitted[key] = now
+            n_suppressed = self._suppressed.pop(key, 0)
+        else:
+            n_suppressed = 0
+        msg = ' '.join(str(a() if callable(a) else a) for a in args)
+        if n_suppressed > 0:
+            msg += f' ({n_suppressed} similar messages suppressed)'
+        self.logger.log(level, msg)
+
+    def debug(self, *args, key=None, interval: float = None):
+        self._log(logging.DEBUG, args, key, interval)
+
+    def info(self, *args, key=None, interval: float = None):
+        self._log(logging.INFO, args, key, interval)
+
+    def warning(self, *args, key=None, interval: float = None):
+        self._log(logging.WARNING, args, key, interval)
+
+    def error(self, *args, key=None, interval: float = None):
+        self._log(logging.ERROR, args, key, interval)
+
+
+def get_mamba_logger(name: str, interval: float = 0.) -> RateLimitedLogger:
+    return RateLimitedLogger(name, interval)
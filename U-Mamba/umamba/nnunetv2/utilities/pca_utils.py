@@ -8,6 +8,9 @@ import torch
 import numpy as np
 from sklearn.decomposition import PCA as SKPCA
 
+from nnunetv2.utilities.mamba_logging import get_mamba_logger
+
+logger = get_mamba_logger('pca_utils')
 
 
 def get_patch_coords(volume_shape, patch_size, stride=None):
@@ -101,37 +104,35 @@ def compute_local_pca(volume, patch_coords, patch_size, n_components=2, use_skle
         patch_coords (list): List of (z, y, x) tuples
         patch_size (tuple): (d, h, w)
         n_components (int): Number of PCA components
-        use_sklearn (bool): If True, use sklearn.PCA; else use torch.linalg.svd
+        use_sklearn (bool): If True, use sklearn.PCA per patch; else batched_pca on all patches at once
 
     Returns:
         dict: Mapping from coord to PCA basis (Tensor of shape [n_components, C])
     """
     pca_vectors = {}
 
+    if not use_sklearn:
+        # all patches at once, see batched_pca
+        flats = torch.stack([extract_patch(volume, coord, patch_size).reshape(volume.shape[0], -1).T
+                             for coord in patch_coords])  # shape: (patches, voxels, channels)
+        vecs, _ = batched_pca(flats, n_components=n_components)
+        vecs = vecs.to(volume.dtype)
+        for coord, vec in zip(patch_coords, vecs):
+            pca_vectors[coord] = vec
+        return pca_vectors
+
     for coord in patch_coords:
         patch = extract_patch(volume, coord, patch_size)  # shape: (C, d, h, w)
         flat = patch.reshape(patch.shape[0], -1).T  # shape: (voxels, channels)
 
-        if use_sklearn:
-            try:
-                flat_np = flat.cpu().numpy()
-                pca = SKPCA(n_components=n_components)
-                pca.fit(flat_np)
-                vec = torch.tensor(pca.components_, dtype=flat.dtype)
-            except Exception as e:
-                print(f"[SKLearn PCA] Failed at coord {coord} with error: {e}")
-                vec = torch.eye(flat.shape[1])[:n_components]
-        else:
-            try:
-                centered = flat - flat.mean(dim=0, keepdim=True)
-                # Use SVD for PCA
-                # torch.linalg.svd returns U, S, Vh; we need Vh for PCA components
-                # Note: S is singular values, not needed for PCA vectors
-                u, s, vh = torch.linalg.svd(centered, full_matrices=False)
-                vec = vh[:n_components]
-            except Exception as e:
-                print(f"[Torch PCA] Failed at coord {coord} with error: {e}")
-                vec = torch.eye(flat.shape[1], device=flat.device)[:n_components]
+        try:
+            flat_np = flat.cpu().numpy()
+            pca = SKPCA(n_components=n_components)
+            pca.fit(flat_np)
+            vec = torch.tensor(pca.components_, dtype=flat.dtype)
+        except Exception as e:
+            print(f"[SKLearn PCA] Failed at coord {coord} with error: {e}")
+            vec = torch.eye(flat.shape[1])[:n_components]
 
         pca_vectors[coord] = vec
 
@@ -153,7 +154,7 @@ def compute_global_pca(prediction_map, n_components=2):
     flat_map = prediction_map.flatten()
     
     # Perform PCA
-    print("DEBUG: Computing global PCA...")
+    logger.debug("Computing global PCA...")
     pca = PCA(n_components=n_components)
     pca.fit(flat_map.reshape(-1, 1))
     
@@ -186,3 +187,180 @@ def reassemble_patches(patches, coords, volume_shape, patch_size):
     return full_volume
 
 
+
+def _centered_slices(shape, target_shape):
+    # same placement as np.pad with ((t - s) // 2, (t - s + 1) // 2)
+    return tuple(slice((t - s) // 2, (t - s) // 2 + s) for s, t in zip(shape, target_shape))
+
+
+def pad_centered(array: np.ndarray, target_shape) -> np.ndarray:
+    """
+    array zero-padded to target_shape (>= array.shape), centered like the segmentations of compute_mean_mask
+    """
+    padded = np.zeros(tuple(target_shape), dtype=array.dtype)
+    padded[_centered_slices(array.shape, target_shape)] = array
+    return padded
+
+
+def compute_mean_mask(dataset, keys, num_threads: int = 4, max_in_flight: int = None):
+    """
+    Voxel-wise mean of the segmentations of all cases in keys, each zero-padded (centered) to the largest shape.
+
+    Equivalent to np.mean(np.stack([pad_centered(seg) for seg in segs]), axis=0), but memory stays bounded by one
+    accumulator plus max_in_flight segmentations: segmentations are memory-mapped through dataset.load_case (the
+    .npy files written by unpack_dataset), read in a thread pool and added into a running sum one at a time.
+
+    Args:
+        dataset: nnUNetDataset
+        keys: case identifiers
+        num_threads: number of loader threads
+        max_in_flight: max number of segmentations held in memory at once. Default: 2 * num_threads
+
+    Returns:
+        mean_mask: (D, H, W) float32 array
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    keys = list(keys)
+    assert len(keys) > 0, 'no cases to compute the mean mask from'
+    if max_in_flight is None:
+        max_in_flight = 2 * num_threads
+
+    # opening the memmap only reads the header, this is cheap
+    shapes = np.array([dataset.load_case(k)[1].shape[1:] for k in keys])
+    max_shape = tuple(int(i) for i in np.max(shapes, axis=0))
+
+    def load_seg(key):
+        return np.asarray(dataset.load_case(key)[1][0])
+
+    acc = np.zeros(max_shape, dtype=np.float64)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = deque()
+        for k in keys:
+            pending.append(executor.submit(load_seg, k))
+            if len(pending) >= max_in_flight:
+                seg = pending.popleft().result()
+                acc[_centered_slices(seg.shape, max_shape)] += seg
+        while pending:
+            seg = pending.popleft().result()
+            acc[_centered_slices(seg.shape, max_shape)] += seg
+    return (acc / len(keys)).astype(np.float32)
+
+
+def mean_mask_cache_file(folder: str, keys) -> str:
+    """
+    Cache file of the mean mask of the cases in keys. The name depends only on the set of cases, so all trainings on
+    the same split (restarts, other scan types) share it.
+    """
+    import hashlib
+    identifier = hashlib.sha1('\n'.join(sorted(keys)).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(folder, f'pca_mean_mask_{identifier}.npy')
+
+
+def load_or_compute_mean_mask(dataset, keys, cache_folder: str = None, num_threads: int = 4):
+    """
+    compute_mean_mask with a disk cache in cache_folder (None disables caching).
+
+    Returns:
+        mean_mask, loaded_from_cache
+    """
+    cache_file = mean_mask_cache_file(cache_folder, keys) if cache_folder is not None else None
+    if cache_file is not None and os.path.isfile(cache_file):
+        return np.load(cache_file), True
+
+    mean_mask = compute_mean_mask(dataset, keys, num_threads)
+    if cache_file is not None:
+        # write to a temporary file first so that concurrent trainings never see a partial file
+        tmp_file = f'{cache_file[:-4]}_{os.getpid()}.tmp.npy'
+        try:
+            np.save(tmp_file, mean_mask)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logger.warning(f'Could not cache mean mask in {cache_folder}: {e}')
+    return mean_mask, False
+
+
+def batched_pca(x: torch.Tensor, mask: torch.Tensor = None, n_components: int = 1):
+    """
+    PCA of many small point sets at once. Gives the same components as fitting sklearn.decomposition.PCA on every set
+    separately (same sign convention: the largest absolute entry of every component is positive), up to floating
+    point precision. Components of eigenvalues with multiplicity > 1 are not unique. There the result can differ for
+    sets with less than 10 * F samples (sklearn uses an SVD instead of the covariance for those) and on GPU.
+
+    All covariance matrices are computed with one einsum and solved with one batched eigh, in float64, on the device
+    of x.
+
+    Args:
+        x: (P, V, F) samples of each set, or (V, F) if all sets share the same samples (e.g. voxel coordinates of a
+           patch) and only differ in mask
+        mask: (P, V) bool, which samples belong to each set. None: all
+        n_components: number of components
+
+    Returns:
+        components: (P, n_components, F) float64, rows of sets with less than 2 samples are undefined
+        n_samples: (P,) number of samples per set
+    """
+    x = x.double()
+    if mask is None:
+        assert x.ndim == 3, 'mask is required if x is shared by all sets'
+        mask = torch.ones(x.shape[:2], dtype=torch.bool, device=x.device)
+    m = mask.to(device=x.device, dtype=torch.float64)
+    n = m.sum(1)
+
+    if x.ndim == 2:
+        s = m @ x
+        xtx = (m @ (x[:, :, None] * x[:, None, :]).flatten(1)).view(-1, x.shape[1], x.shape[1])
+    else:
+        s = torch.einsum('pv,pvf->pf', m, x)
+        xtx = torch.einsum('pv,pvf,pvg->pfg', m, x, x)
+
+    # same as sklearn's covariance_eigh solver: center the gram matrix instead of the data
+    n_ = n.clamp_min(1)[:, None]
+    mean = s / n_
+    cov = (xtx - n_[:, :, None] * mean[:, :, None] * mean[:, None, :]) / (n_[:, :, None] - 1).clamp_min(1)
+    if cov.device.type == 'cpu':
+        # numpy's eigh is what sklearn uses. Same LAPACK call -> same vectors also for (near) degenerate eigenvalues
+        eigenvectors = torch.from_numpy(np.linalg.eigh(cov.numpy())[1])
+    else:
+        _, eigenvectors = torch.linalg.eigh(cov)
+    components = eigenvectors.flip(-1)[..., :n_components].transpose(1, 2)
+
+    # sklearn.utils.extmath.svd_flip(u_based_decision=False)
+    max_abs = torch.argmax(components.abs(), dim=-1, keepdim=True)
+    signs = torch.sign(torch.gather(components, -1, max_abs))
+    return components * signs, n
+
+
+def local_pca_from_mask(mask, patch_size, min_voxels: int = 4, device=None):
+    """
+    Local PCA scan directions: first principal component of the foreground voxel coordinates of every patch of a
+    non-overlapping patch grid (same grid and order as extract_patches_and_origins). Patches with less than min_voxels
+    foreground voxels are skipped.
+
+    Args:
+        mask: (D, H, W) binary numpy array or tensor
+        patch_size: (dz, dy, dx)
+        min_voxels: minimum number of foreground voxels
+        device: device to compute on. None: device of mask (cpu for numpy arrays)
+
+    Returns:
+        coords: (P, 3) long tensor of patch origins (z, y, x)
+        vectors: (P, 3) float32 tensor of unit length PCA vectors
+    """
+    from nnunetv2.utilities.scan_orders import voxel_coordinates
+
+    mask = torch.as_tensor(np.asarray(mask) if not isinstance(mask, torch.Tensor) else mask, device=device) > 0
+    grid = [s // p for s, p in zip(mask.shape, patch_size)]
+    (gz, gy, gx), (dz, dy, dx) = grid, patch_size
+    patches = mask[:gz * dz, :gy * dy, :gx * dx].reshape(gz, dz, gy, dy, gx, dx)
+    patches = patches.permute(0, 2, 4, 1, 3, 5).reshape(gz * gy * gx, dz * dy * dx)
+
+    origins = torch.stack(torch.meshgrid(*[torch.arange(g, device=mask.device) * p for g, p in zip(grid, patch_size)],
+                                         indexing='ij'), dim=-1).reshape(-1, 3)
+    keep = patches.sum(1) >= min_voxels
+    if not torch.any(keep):
+        return origins[:0], torch.zeros((0, 3), dtype=torch.float32, device=mask.device)
+
+    components, _ = batched_pca(voxel_coordinates(patch_size, mask.device), patches[keep], n_components=1)
+    return origins[keep], components[:, 0].float()
@@ -0,0 +1,227 @@
+from collections import OrderedDict
+from typing import Callable, Hashable, Sequence, Tuple
+
+import numpy as np
+import torch
+
+
+class ScanOrderCache(object):
+    """
+    Small dict-backed cache for scan-order index tensors.
+
+    Entries are (perm, inv) tuples of long tensors where perm maps scan position -> flat voxel index and inv maps
+    flat voxel index -> scan position (pruned scans only store the selected voxels in scan order). Keys must contain
+    everything the ordering depends on (spatial shape, scan parameters, device), so that a cached entry can be reused
+    without any geometry computation.
+
+    If max_entries is set the least recently used entries are dropped, which bounds memory when the keys vary a lot
+    (for example one entry per tile origin).
+    """
+    def __init__(self, max_entries: int = None):
+        self._orders = OrderedDict()
+        self.max_entries = max_entries
+
+    def get(self, key: Hashable, builder: Callable[[], Tuple[torch.Tensor, torch.Tensor]]):
+        order = self._orders.get(key)
+        if order is None:
+            order = builder()
+            self._orders[key] = order
+            if self.max_entries is not None and len(self._orders) > self.max_entries:
+                self._orders.popitem(last=False)
+        else:
+            self._orders.move_to_end(key)
+        return order
+
+    def clear(self):
+        self._orders.clear()
+
+    def __len__(self):
+        return len(self._orders)
+
+
+def vector_key(vector) -> Tuple[float, ...]:
+    """
+    Hashable representation of a scan vector. This moves the vector to host, so only call it when the vector is set,
+    not on the hot path.
+    """
+    if isinstance(vector, torch.Tensor):
+        vector = vector.detach().cpu().numpy()
+    return tuple(float(i) for i in np.round(np.asarray(vector, dtype=np.float64).reshape(-1), 6))
+
+
+def inverse_permutation(perm: torch.Tensor) -> torch.Tensor:
+    inv = torch.empty_like(perm)
+    inv[perm] = torch.arange(perm.numel(), device=perm.device, dtype=perm.dtype)
+    return inv
+
+
+def _gather_last(x: torch.Tensor, index: torch.Tensor, partial: bool) -> torch.Tensor:
+    if partial:
+        # index value x.shape[-1] reads zero
+        x = torch.nn.functional.pad(x, (0, 1))
+    # gather with an expanded (stride 0) index, on CPU index_select along the last dim is several times slower
+    index = index[None, None] if index.ndim == 1 else index[:, None]
+    return torch.gather(x, -1, index.expand(x.shape[0], x.shape[1], -1))
+
+
+class _TokenGather(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, index, inverse, partial):
+        # only the index tensors are kept for backward
+        ctx.save_for_backward(inverse)
+        ctx.partial = partial
+        return _gather_last(x, index, partial)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad):
+        inverse, = ctx.saved_tensors
+        return _gather_last(grad, inverse, ctx.partial), None, None, None
+
+
+def gather_tokens(x: torch.Tensor, index: torch.Tensor, inverse: torch.Tensor, partial: bool = False) \
+        -> torch.Tensor:
+    """
+    out[b, c, i] = x[b, c, index[i]] (or index[b, i]) as an autograd Function whose backward is the inverse gather
+    grad_x[b, c, j] = grad[b, c, inverse[j]]. Unlike index_select / gather / index assignment this keeps nothing but
+    the index tensors for backward and never allocates a zero filled buffer to scatter gradients into.
+
+    Args:
+        x: (B, C, N_in)
+        index: (N_out,) or (B, N_out) long
+        inverse: (N_in,) or (B, N_in) long, the inverse map of index
+        partial: index does not need to be a permutation. Value N_in in index reads zero, value N_out in inverse gets
+        zero gradient (voxels that are not read). Every voxel may be read at most once
+
+    Returns:
+        (B, C, N_out)
+    """
+    return _TokenGather.apply(x, index, inverse, partial)
+
+
+def voxel_coordinates(spatial_shape: Sequence[int], device=None) -> torch.Tensor:
+    """
+    (N, 3) float tensor with the (z, y, x) coordinate of every voxel in C order.
+    """
+    grids = torch.meshgrid(*[torch.arange(s, device=device, dtype=torch.float32) for s in spatial_shape],
+                           indexing='ij')
+    return torch.stack(grids, dim=-1).reshape(-1, len(spatial_shape))
+
+
+def pca_scan_order(spatial_shape: Sequence[int], vector: torch.Tensor, device=None) \
+        -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Scan order that visits voxels sorted by their projection onto vector. Ties are broken by raster order (stable
+    sort) so the ordering is deterministic across devices.
+
+    Args:
+        spatial_shape: (D, H, W)
+        vector: (3,) scan direction in (z, y, x)
+        device: device the index tensors should live on
+
+    Returns:
+        perm, inv: (N,) long tensors
+    """
+    coords = voxel_coordinates(spatial_shape, device)
+    vector = torch.as_tensor(vector).to(device=coords.device, dtype=torch.float32).reshape(-1)
+    projections = torch.matmul(coords, vector)
+    perm = torch.sort(projections, stable=True)[1]
+    return perm, inverse_permutation(perm)
+
+
+def local_pca_key_map(reference_shape: Sequence[int], coords, vectors, patch_size: Sequence[int], device=None) \
+        -> torch.Tensor:
+    """
+    Scan key for every voxel of the reference volume (the space the local PCA vectors were computed in). Sorting
+    voxels by key gives the local PCA scan: patch grid cells are visited in raster order, voxels within a cell are
+    sorted by their projection onto that cell's PCA vector. Cells without a vector (too little foreground, partial
+    cells at the border) are scanned in raster order.
+
+    Every voxel has a unique key, so any crop of the reference volume can be scanned by sorting the keys of the crop
+    (see tile_scan_order). This makes the scan independent of where the crop is located.
+
+    Args:
+        reference_shape: (D, H, W) of the reference volume
+        coords: (N, 3) patch start coordinates (z, y, x), must lie on the patch grid
+        vectors: (N, 3) or (N, k, 3) PCA vector per patch (only the first component is used)
+        patch_size: (dz, dy, dx)
+        device: device the key map should live on
+
+    Returns:
+        key_map: (D, H, W) int32 tensor
+    """
+    n_voxels = int(np.prod(patch_size))
+    grid_shape = [(r + p - 1) // p for r, p in zip(reference_shape, patch_size)]
+    assert np.prod(grid_shape) * n_voxels < np.iinfo(np.int32).max, 'reference volume too large for int32 keys'
+
+    # raster key for all voxels: cell id * voxels per cell + raster index within the cell
+    axes = [torch.arange(r, device=device, dtype=torch.int32) for r in reference_shape]
+    cell = [(a // p).reshape(shp) for a, p, shp in zip(axes, patch_size, ((-1, 1, 1), (1, -1, 1), (1, 1, -1)))]
+    local = [(a % p).reshape(shp) for a, p, shp in zip(axes, patch_size, ((-1, 1, 1), (1, -1, 1), (1, 1, -1)))]
+    cell_id = (cell[0] * grid_shape[1] + cell[1]) * grid_shape[2] + cell[2]
+    local_id = (local[0] * patch_size[1] + local[1]) * patch_size[2] + local[2]
+    key_map = (cell_id * n_voxels + local_id).contiguous()
+
+    coords = torch.as_tensor(coords).to(device=device, dtype=torch.long).reshape(-1, 3)
+    vectors = torch.as_tensor(vectors).to(device=device, dtype=torch.float32)
+    if vectors.ndim == 3:
+        vectors = vectors[:, 0]
+    shape_t = torch.as_tensor(reference_shape, device=device, dtype=torch.long)
+    patch_size_t = torch.as_tensor(patch_size, device=device, dtype=torch.long)
+    valid = torch.all((coords >= 0) & (coords + patch_size_t <= shape_t) & (coords % patch_size_t == 0), dim=1)
+    coords, vectors = coords[valid], vectors[valid]
+    if coords.shape[0] == 0:
+        return key_map
+
+    # (P, V, 3) voxel positions of all patches with a PCA vector, rank of each voxel along the vector
+    positions = coords[:, None, :].float() + voxel_coordinates(patch_size, device)[None]
+    projections = torch.bmm(positions, vectors[:, :, None])[..., 0]
+    order = torch.sort(projections, dim=1, stable=True)[1]
+    ranks = torch.empty_like(order)
+    ranks.scatter_(1, order, torch.arange(n_voxels, device=device).expand_as(order).contiguous())
+
+    cells = coords // patch_size_t
+    patch_cell_id = (cells[:, 0] * grid_shape[1] + cells[:, 1]) * grid_shape[2] + cells[:, 2]
+    positions = positions.long()
+    linear = (positions[..., 0] * reference_shape[1] + positions[..., 1]) * reference_shape[2] + positions[..., 2]
+    key_map.view(-1)[linear.reshape(-1)] = (patch_cell_id[:, None] * n_voxels + ranks).reshape(-1).int()
+    return key_map
+
+
+def crop_reference_volume(volume: torch.Tensor, origin: Sequence[int], tile_shape: Sequence[int], fill_value) \
+        -> torch.Tensor:
+    """
+    Crop of a reference volume at origin. The tile may extend beyond the volume (negative origin, padded cases), those
+    voxels are fill_value.
+    """
+    tile = torch.full(tuple(tile_shape), fill_value, dtype=volume.dtype, device=volume.device)
+    src, dst = [], []
+    for o, t, r in zip(origin, tile_shape, volume.shape):
+        lb, ub = max(o, 0), min(o + t, r)
+        if ub <= lb:
+            return tile
+        src.append(slice(lb, ub))
+        dst.append(slice(lb - o, ub - o))
+    tile[tuple(dst)] = volume[tuple(src)]
+    return tile
+
+
+def pruned_scan_order(perm: torch.Tensor, token_mask: torch.Tensor) -> torch.Tensor:
+    """
+    The voxels of a scan order (perm, (N,)) that are inside token_mask (tile shaped bool), in scan order.
+    """
+    return perm[token_mask.reshape(-1)[perm]]
+
+
+def tile_scan_order(key_map: torch.Tensor, origin: Sequence[int], tile_shape: Sequence[int]) \
+        -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Scan order of a tile located at origin (may be negative / extend beyond the reference volume) in the reference
+    volume described by key_map. Voxels outside the reference volume are scanned last, in raster order.
+
+    Returns:
+        perm, inv: (N,) long tensors, N = prod(tile_shape)
+    """
+    keys = crop_reference_volume(key_map, origin, tile_shape, torch.iinfo(torch.int32).max)
+    perm = torch.sort(keys.reshape(-1), stable=True)[1]
+    return perm, inverse_permutation(perm)
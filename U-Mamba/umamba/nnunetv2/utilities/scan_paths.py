@@ -0,0 +1,175 @@
+from typing import Sequence, Tuple
+
+import numpy as np
+import torch
+
+from nnunetv2.utilities.scan_orders import voxel_coordinates
+
+# scan paths that compile_scan_path can build. The pca_ ones need the scan vector of the prior (the first principal
+# component of the binary mean mask, like global_pca), the others use it only to orient the curve if it is given
+SCAN_PATHS = ('hilbert', 'morton', 'pca_hilbert', 'pca_morton')
+
+# thickness (in voxels, along the scan vector) of the slabs of the pca_ scan paths
+DEFAULT_SLAB_THICKNESS = 4
+
+
+def _n_bits(spatial_shape: Sequence[int]) -> int:
+    return max(1, int(np.ceil(np.log2(max(spatial_shape)))))
+
+
+def _interleave(coords: Sequence[np.ndarray], n_bits: int) -> np.ndarray:
+    # coords[0] is the most significant axis
+    codes = np.zeros_like(coords[0])
+    for bit in range(n_bits - 1, -1, -1):
+        for c in coords:
+            codes = (codes << 1) | ((c >> bit) & 1)
+    return codes
+
+
+def morton_codes(coords: np.ndarray, n_bits: int) -> np.ndarray:
+    """
+    Z-order (Morton) index of integer coordinates (N, 3) in a cube of side 2 ** n_bits. The first axis is the most
+    significant one, so it varies slowest at the coarsest level.
+    """
+    coords = np.asarray(coords, dtype=np.int64)
+    return _interleave([coords[:, i] for i in range(coords.shape[1])], n_bits)
+
+
+def hilbert_codes(coords: np.ndarray, n_bits: int) -> np.ndarray:
+    """
+    Hilbert curve index of integer coordinates (N, 3) in a cube of side 2 ** n_bits (Skilling, "Programming the
+    Hilbert curve", 2004, vectorized over the points). Consecutive indices are face neighbours.
+    """
+    x = [np.array(c, dtype=np.int64) for c in np.asarray(coords, dtype=np.int64).T]
+    n = len(x)
+    # inverse undo excess work
+    q = 1 << (n_bits - 1)
+    while q > 1:
+        p = q - 1
+        for i in range(n):
+            hit = (x[i] & q) != 0
+            t = np.where(hit, 0, (x[0] ^ x[i]) & p)
+            x[0] = np.where(hit, x[0] ^ p, x[0] ^ t)
+            x[i] = x[i] ^ t
+        q >>= 1
+    # gray encode
+    for i in range(1, n):
+        x[i] = x[i] ^ x[i - 1]
+    t = np.zeros_like(x[0])
+    q = 1 << (n_bits - 1)
+    while q > 1:
+        t = np.where((x[n - 1] & q) != 0, t ^ (q - 1), t)
+        q >>= 1
+    return _interleave([c ^ t for c in x], n_bits)
+
+
+_CURVES = {'hilbert': hilbert_codes, 'morton': morton_codes}
+
+
+def _oriented_coordinates(spatial_shape: Sequence[int], vector=None) -> Tuple[np.ndarray, Tuple[int, ...]]:
+    """
+    (N, 3) int64 voxel coordinates in C order, with the axes reordered by decreasing absolute component of vector and
+    mirrored where the component is negative. Without a vector the axes are left as they are.
+    """
+    coords = voxel_coordinates(spatial_shape).numpy().astype(np.int64)
+    if vector is None:
+        return coords, tuple(spatial_shape)
+    vector = np.asarray(vector, dtype=np.float64).reshape(-1)
+    axes = np.argsort(-np.abs(vector), kind='stable')
+    for a in range(len(spatial_shape)):
+        if vector[a] < 0:
+            coords[:, a] = spatial_shape[a] - 1 - coords[:, a]
+    return coords[:, axes], tuple(spatial_shape[a] for a in axes)
+
+
+def space_filling_scan_order(spatial_shape: Sequence[int], curve: str = 'hilbert', vector=None) -> torch.Tensor:
+    """
+    Scan permutation ((N,) long, scan position -> flat voxel index in C order) that visits the voxels along a Hilbert
+    or Morton curve. The curve is laid over the smallest power of two cube containing the volume and the voxels
+    outside the volume are skipped, so for other shapes the path jumps where it leaves and re-enters the volume.
+
+    vector: (3,) (z, y, x) direction to align the curve to, e.g. the principal component of the foreground prior. The
+    axis with the largest component is then the most significant one of the curve (visited last at the coarsest
+    level) and the curve runs along the direction of vector.
+    """
+    if curve not in _CURVES:
+        raise ValueError(f'curve must be one of {tuple(_CURVES.keys())}, got {curve}')
+    spatial_shape = tuple(int(i) for i in spatial_shape)
+    coords, oriented_shape = _oriented_coordinates(spatial_shape, vector)
+    codes = _CURVES[curve](coords, _n_bits(oriented_shape))
+    return torch.from_numpy(np.argsort(codes, kind='stable'))
+
+
+def pca_curve_scan_order(spatial_shape: Sequence[int], vector, curve: str = 'hilbert',
+                         slab_thickness: int = DEFAULT_SLAB_THICKNESS) -> torch.Tensor:
+    """
+    Scan permutation that follows vector like pca_scan_order, but keeps neighbouring voxels close in the sequence:
+    the volume is cut into slabs of slab_thickness voxels orthogonal to vector, the slabs are visited along vector and
+    the voxels within a slab along a space filling curve (aligned to vector, see space_filling_scan_order).
+    pca_scan_order visits the same slabs (in the limit of slab_thickness 1) but within a slab sorts voxels by a
+    projection, which jumps across the whole slab at every step.
+    """
+    if curve not in _CURVES:
+        raise ValueError(f'curve must be one of {tuple(_CURVES.keys())}, got {curve}')
+    spatial_shape = tuple(int(i) for i in spatial_shape)
+    vector = np.asarray(vector, dtype=np.float64).reshape(-1)
+    vector = vector / (np.linalg.norm(vector) + 1e-8)
+    projections = voxel_coordinates(spatial_shape).numpy().astype(np.float64) @ vector
+    slabs = np.floor((projections - projections.min()) / slab_thickness).astype(np.int64)
+    coords, oriented_shape = _oriented_coordinates(spatial_shape, vector)
+    n_bits = _n_bits(oriented_shape)
+    codes = _CURVES[curve](coords, n_bits)
+    perm = np.lexsort((codes, slabs))
+    return torch.from_numpy(perm)
+
+
+def compile_scan_path(scan_path: str, spatial_shape: Sequence[int], vector=None,
+                      slab_thickness: int = DEFAULT_SLAB_THICKNESS) -> np.ndarray:
+    """
+    Static scan permutation of scan_path (one of SCAN_PATHS) for inputs of spatial_shape, as (N,) int32 (the way
+    ScanPlan stores scan orders). At run time scanning with it is a single gather, see LearnedScan.
+
+    vector: (3,) or (1, 3) scan vector of the prior. Required for the pca_ scan paths; if it is None (no foreground
+    in the prior) those fall back to the plain curve
+    """
+    if scan_path not in SCAN_PATHS:
+        raise ValueError(f'scan_path must be one of {SCAN_PATHS}, got {scan_path}')
+    curve = scan_path.split('_')[-1]
+    if vector is not None:
+        vector = np.asarray(vector, dtype=np.float64).reshape(-1, 3)[0]
+    if scan_path.startswith('pca_') and vector is not None:
+        perm = pca_curve_scan_order(spatial_shape, vector, curve, slab_thickness)
+    else:
+        perm = space_filling_scan_order(spatial_shape, curve, vector)
+    return perm.int().numpy()
+
+
+def scan_path_locality(perm, spatial_shape: Sequence[int]) -> Tuple[float, float]:
+    """
+    Mean and 99th percentile of the euclidean distance between consecutive voxels of a scan permutation. 1 means
+    every step goes to a face neighbour.
+    """
+    coords = voxel_coordinates(spatial_shape).numpy()[np.asarray(perm, dtype=np.int64)]
+    steps = np.linalg.norm(np.diff(coords, axis=0), axis=1)
+    return float(steps.mean()), float(np.percentile(steps, 99))
+
+
+if __name__ == '__main__':
+    from nnunetv2.utilities.scan_orders import pca_scan_order
+
+    # on a power of two cube the Hilbert curve only makes face neighbour steps, in any orientation
+    for vector in (None, (0.2, -0.9, 0.4), (-1., 0., 0.)):
+        perm = space_filling_scan_order((8, 8, 8), 'hilbert', vector)
+        assert torch.equal(torch.sort(perm)[0], torch.arange(512))
+        assert scan_path_locality(perm, (8, 8, 8))[1] == 1., f'hilbert steps are not unit steps for {vector}'
+
+    vector = np.array([0.3, 0.8, -0.5])
+    for shape in ((32, 32, 32), (40, 56, 24)):
+        n = int(np.prod(shape))
+        print(f'{shape}: mean / p99 step length')
+        for name, perm in [('raster', np.arange(n)), ('global_pca', pca_scan_order(shape, torch.tensor(vector))[0])] + \
+                [(s, compile_scan_path(s, shape, vector)) for s in SCAN_PATHS]:
+            perm = np.asarray(perm)
+            assert np.array_equal(np.sort(perm), np.arange(n)), f'{name} is not a permutation for {shape}'
+            mean, p99 = scan_path_locality(perm, shape)
+            print(f'  {name:>12} {mean:8.2f} {p99:8.2f}')
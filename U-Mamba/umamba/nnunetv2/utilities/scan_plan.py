@@ -0,0 +1,230 @@
+import hashlib
+from typing import Tuple
+
+import numpy as np
+import torch
+from scipy.ndimage import binary_dilation, generate_binary_structure
+from sklearn.decomposition import PCA
+
+from nnunetv2.utilities.pca_utils import local_pca_from_mask
+from nnunetv2.utilities.scan_orders import pca_scan_order, local_pca_key_map, vector_key
+from nnunetv2.utilities.scan_paths import SCAN_PATHS, compile_scan_path
+
+# Bump whenever the way a scan plan is computed changes. Plans with a different version are rebuilt.
+SCAN_PLAN_VERSION = 1
+
+
+class ScanPlan(object):
+    """
+    Everything the PCA scans of the Mamba layers depend on, computed once from the binary mean mask of the training
+    cases:
+
+    - global_pca: global_vector (1, 3)
+    - multi_pca: global_vector (K, 3), the first K principal components
+    - local_pca: local_vectors (P, 3), local_coords (P, 3), patch_size and reference_shape (shape of the mask the
+      coords refer to)
+    - learned: scan_path (one of scan_paths.SCAN_PATHS) and global_vector (1, 3), the prior the path is aligned to.
+      The Mamba layers scan along the compiled path (scan type 'learned'), not along the vector
+    - token pruning (optional, global_pca / local_pca): token_mask (reference_shape, bool), the mask dilated by
+      token_mask_dilation voxels. The Mamba layers then only scan the voxels inside it
+
+    source_hash identifies the inputs (mask content, scan type, patch size, token mask dilation, scan path,
+    SCAN_PLAN_VERSION). A plan only needs to be
+    rebuilt if the hash of the current inputs differs from it, see is_valid_for.
+
+    The plan is stored in the training checkpoints (key 'scan_plan') together with precomputed scan orders
+    (precompute_scan_orders), so that inference does not need to rebuild them:
+
+    - global_pca / multi_pca: scan permutation per tile shape (global_scan_orders) for the normalized global vector,
+      (N,) for one vector and (K, N) for K vectors
+    - local_pca: key map of the reference volume (local_key_map, int32), tile orders are a sort of a crop of it
+    - learned: the compiled scan path per tile shape (scan_path_orders, (N,) int32). The layers only gather with it
+    """
+    def __init__(self, scan_type: str, source_hash: str, patch_size: Tuple[int, ...] = None,
+                 reference_shape: Tuple[int, ...] = None, global_vector: np.ndarray = None,
+                 local_vectors: np.ndarray = None, local_coords: np.ndarray = None, version: int = SCAN_PLAN_VERSION,
+                 global_scan_orders: dict = None, local_key_map: np.ndarray = None, token_mask: np.ndarray = None,
+                 token_mask_dilation: int = None, scan_path: str = None, scan_path_orders: dict = None):
+        self.scan_type = scan_type
+        self.source_hash = source_hash
+        self.patch_size = tuple(int(i) for i in patch_size) if patch_size is not None else None
+        self.reference_shape = tuple(int(i) for i in reference_shape) if reference_shape is not None else None
+        self.global_vector = global_vector
+        self.local_vectors = local_vectors
+        self.local_coords = local_coords
+        self.version = version
+        self.global_scan_orders = {} if global_scan_orders is None else global_scan_orders
+        self.local_key_map = local_key_map
+        self.token_mask = token_mask
+        self.token_mask_dilation = token_mask_dilation
+        self.scan_path = scan_path
+        self.scan_path_orders = {} if scan_path_orders is None else scan_path_orders
+
+    @staticmethod
+    def compute_source_hash(binary_mask: np.ndarray, scan_type: str, patch_size: Tuple[int, ...] = None,
+                            n_components: int = 1, token_mask_dilation: int = None, scan_path: str = None) -> str:
+        binary_mask = np.ascontiguousarray(binary_mask > 0)
+        h = hashlib.sha1()
+        if n_components != 1:
+            scan_type = f'{scan_type}x{n_components}'
+        if token_mask_dilation is not None:
+            scan_type = f'{scan_type}|pruned{token_mask_dilation}'
+        if scan_path is not None:
+            scan_type = f'{scan_type}|{scan_path}'
+        h.update(f'{SCAN_PLAN_VERSION}|{scan_type}|{patch_size}|{binary_mask.shape}'.encode('utf-8'))
+        h.update(np.packbits(binary_mask).tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def build(cls, binary_mask: np.ndarray, scan_type: str, patch_size: Tuple[int, ...] = None, device=None,
+              source_hash: str = None, n_components: int = 1, token_mask_dilation: int = None,
+              scan_path: str = None) -> 'ScanPlan':
+        """
+        Args:
+            binary_mask: (D, H, W) binary mean mask of the training cases
+            scan_type: 'global_pca', 'multi_pca', 'local_pca' or 'learned'
+            patch_size: local PCA patch size (local_pca only)
+            device: device the local PCA is computed on
+            source_hash: compute_source_hash of the inputs, if the caller already has it
+            n_components: number of principal components (multi_pca only)
+            token_mask_dilation: enables token pruning: the Mamba layers only scan the voxels of binary_mask dilated by
+            this many voxels (global_pca and local_pca only). None disables it
+            scan_path: the scan path to compile (learned only), see scan_paths.SCAN_PATHS
+        """
+        if scan_type != 'multi_pca':
+            n_components = 1
+        if scan_type not in ('global_pca', 'local_pca'):
+            token_mask_dilation = None
+        if scan_type != 'learned':
+            scan_path = None
+        elif scan_path not in SCAN_PATHS:
+            raise ValueError(f'scan_path must be one of {SCAN_PATHS}, got {scan_path}')
+        if source_hash is None:
+            source_hash = cls.compute_source_hash(binary_mask, scan_type, patch_size, n_components,
+                                                  token_mask_dilation, scan_path)
+        plan = cls(scan_type, source_hash, patch_size=patch_size if scan_type == 'local_pca' else None,
+                   reference_shape=binary_mask.shape, scan_path=scan_path)
+
+        if scan_type in ('global_pca', 'multi_pca', 'learned'):
+            binary_coords = np.argwhere(binary_mask > 0)
+            if len(binary_coords) >= n_components:
+                plan.global_vector = PCA(n_components=n_components).fit(binary_coords).components_.astype(np.float32)
+        elif scan_type == 'local_pca':
+            coords, vectors = local_pca_from_mask(binary_mask, patch_size, min_voxels=4, device=device)
+            if len(vectors) > 0:
+                vectors = vectors / (vectors.norm(dim=1, keepdim=True) + 1e-8)
+                plan.local_vectors = vectors.cpu().numpy()
+                plan.local_coords = coords.cpu().numpy()
+        else:
+            raise ValueError(f'scan plans are only defined for global_pca, multi_pca, local_pca and learned, got '
+                             f'{scan_type}')
+
+        if token_mask_dilation is not None:
+            token_mask = binary_mask > 0
+            if token_mask_dilation > 0 and token_mask.any():
+                token_mask = binary_dilation(token_mask, generate_binary_structure(3, 1),
+                                             iterations=token_mask_dilation)
+            plan.token_mask = token_mask
+            plan.token_mask_dilation = int(token_mask_dilation)
+        return plan
+
+    def is_valid_for(self, source_hash: str) -> bool:
+        return self.version == SCAN_PLAN_VERSION and self.source_hash == source_hash
+
+    @property
+    def is_empty(self) -> bool:
+        # a scan path can always be compiled, without a prior it is just not aligned to it
+        return self.global_vector is None and self.local_vectors is None and self.scan_path is None
+
+    def _normalized_global_vectors(self) -> torch.Tensor:
+        # exactly what UMambaEnc.set_global_pca_vectors stores in the layers
+        return torch.nn.functional.normalize(torch.from_numpy(self.global_vector).float(), dim=1)
+
+    def _global_vector_keys(self):
+        keys = [vector_key(v) for v in self._normalized_global_vectors()]
+        return keys[0] if len(keys) == 1 else keys
+
+    def precompute_scan_orders(self, spatial_shapes):
+        """
+        Compute the scan orders for inputs of the given spatial shapes (the patch size of the configuration). Orders
+        that are already present are not recomputed.
+        """
+        if self.scan_path is not None:
+            for shape in spatial_shapes:
+                shape = tuple(int(i) for i in shape)
+                if shape not in self.scan_path_orders:
+                    self.scan_path_orders[shape] = compile_scan_path(self.scan_path, shape, self.global_vector)
+            return
+        if self.global_vector is not None:
+            vectors = self._normalized_global_vectors()
+            for shape in spatial_shapes:
+                shape = tuple(int(i) for i in shape)
+                if shape not in self.global_scan_orders:
+                    orders = np.stack([pca_scan_order(shape, v)[0].int().numpy() for v in vectors])
+                    self.global_scan_orders[shape] = orders[0] if len(orders) == 1 else orders
+        if self.local_vectors is not None and self.local_key_map is None:
+            self.local_key_map = local_pca_key_map(self.reference_shape, torch.from_numpy(self.local_coords),
+                                                   torch.from_numpy(self.local_vectors).float(),
+                                                   self.patch_size).numpy()
+
+    def apply(self, network: torch.nn.Module, device=None):
+        """
+        Set the plan (its scan type, vectors and precomputed scan orders) in all MambaLayers of network (an unwrapped
+        UMambaEnc). The network may have been built with any scan type, e.g. the default 'x' of the predictor. Setting
+        vectors invalidates the cached scan orders of the layers, so only call this when the plan changed.
+        """
+        if self.scan_path is not None:
+            # only the compiled orders, the prior vector was used up compiling them
+            from nnunetv2.nets.mamba_layer import LearnedScan
+            network.set_learned_scan(LearnedScan(self.scan_path_orders, name=self.scan_path))
+            return
+        network.set_scan_type(self.scan_type)
+        if self.global_vector is not None:
+            network.set_global_pca_vectors(torch.from_numpy(self.global_vector).to(device))
+        if self.local_vectors is not None:
+            network.set_local_pca_vectors(torch.from_numpy(self.local_vectors).to(device),
+                                          torch.from_numpy(self.local_coords).to(device))
+            network.set_pca_patch_size(self.patch_size)
+            network.set_pca_reference_shape(self.reference_shape)
+        if self.token_mask is not None and hasattr(network, 'set_token_mask'):
+            # the mask lives in reference volume space, inputs are located in it like for the local PCA scan
+            network.set_pca_reference_shape(self.reference_shape)
+            network.set_token_mask(torch.from_numpy(self.token_mask).to(device))
+        if hasattr(network, 'set_precomputed_scan_orders') and (self.global_scan_orders or
+                                                                 self.local_key_map is not None):
+            network.set_precomputed_scan_orders(
+                self._global_vector_keys() if self.global_vector is not None else None,
+                self.global_scan_orders, self.local_key_map)
+
+    def state_dict(self) -> dict:
+        return {
+            'version': self.version,
+            'scan_type': self.scan_type,
+            'source_hash': self.source_hash,
+            'patch_size': self.patch_size,
+            'reference_shape': self.reference_shape,
+            'global_vector': self.global_vector,
+            'local_vectors': self.local_vectors,
+            'local_coords': self.local_coords,
+            'global_scan_orders': self.global_scan_orders,
+            'local_key_map': self.local_key_map,
+            # packed, this is a full resolution volume
+            'token_mask_packed': np.packbits(self.token_mask) if self.token_mask is not None else None,
+            'token_mask_dilation': self.token_mask_dilation,
+            'scan_path': self.scan_path,
+            'scan_path_orders': self.scan_path_orders,
+        }
+
+    @classmethod
+    def from_state_dict(cls, state: dict) -> 'ScanPlan':
+        token_mask = state.get('token_mask_packed')
+        if token_mask is not None:
+            shape = state['reference_shape']
+            token_mask = np.unpackbits(token_mask, count=int(np.prod(shape))).reshape(shape).astype(bool)
+        return cls(state['scan_type'], state['source_hash'], patch_size=state['patch_size'],
+                   reference_shape=state['reference_shape'], global_vector=state['global_vector'],
+                   local_vectors=state['local_vectors'], local_coords=state['local_coords'],
+                   version=state['version'], global_scan_orders=state.get('global_scan_orders'),
+                   local_key_map=state.get('local_key_map'), token_mask=token_mask,
+                   token_mask_dilation=state.get('token_mask_dilation'), scan_path=state.get('scan_path'),
+                   scan_path_orders=state.get('scan_path_orders'))